@@ -0,0 +1,106 @@
+"""
+Compares catalog query plans and timings before and after the catalog migration.
+
+A catalog with the previous schema (text latitude, longitude, and value count columns
+and no indexes) is seeded across many sessions, the common catalog queries are
+explained and timed, and the same queries are repeated after migrate_timeseries_catalog
+has converted the columns and created the indexes.
+"""
+
+import time
+import uuid
+from sqlalchemy import MetaData, Table, Column, Text, UniqueConstraint, text
+from common import setup_django, get_parser, seed_catalog
+
+
+QUERIES = {
+    "row by timeseries_id": (
+        "SELECT status FROM timeseries_catalog WHERE session_id = :session_id AND timeseries_id = :timeseries_id"
+    ),
+    "selected ready count": (
+        "SELECT count(*) FROM timeseries_catalog WHERE session_id = :session_id AND selected = :selected "
+        "AND status = 'Ready'"
+    ),
+    "page sorted by latitude": (
+        "SELECT timeseries_id, latitude FROM timeseries_catalog WHERE session_id = :session_id "
+        "ORDER BY latitude LIMIT 10 OFFSET 1000"
+    ),
+    "page sorted by value_count desc": (
+        "SELECT timeseries_id, value_count FROM timeseries_catalog WHERE session_id = :session_id "
+        "ORDER BY value_count DESC LIMIT 10"
+    ),
+}
+
+
+def legacy_catalog_table(model):
+    """
+    Builds the catalog table as declared by earlier versions of the app.
+    """
+
+    metadata = MetaData()
+    columns = [
+        Column(column.name, Text if column.name in model.NUMERIC_CATALOG_COLUMNS else column.type.__class__(),
+               primary_key=column.primary_key)
+        for column in model.TimeSeriesCatalog.__table__.columns
+    ]
+
+    return Table(
+        model.TimeSeriesCatalog.__tablename__, metadata, *columns,
+        UniqueConstraint("session_id", "site_code", "variable_code", name="_ts_result")
+    )
+
+
+def explain(engine, label, params, iterations):
+    """
+    Prints the plan and mean runtime of each benchmark query.
+    """
+
+    explain_prefix = "EXPLAIN ANALYZE " if engine.dialect.name == "postgresql" else "EXPLAIN QUERY PLAN "
+    print(f"\n===== {label} =====")
+    with engine.connect() as connection:
+        for name, sql in QUERIES.items():
+            plan = connection.execute(text(explain_prefix + sql), params).fetchall()
+            start = time.perf_counter()
+            for _ in range(iterations):
+                connection.execute(text(sql), params).fetchall()
+            mean_ms = (time.perf_counter() - start) / iterations * 1000
+            print(f"\n--- {name}: {mean_ms:.2f} ms/query")
+            for row in plan:
+                print("   ", " | ".join(str(x) for x in row))
+
+
+def main():
+    parser = get_parser(__doc__)
+    parser.add_argument("--sessions", type=int, default=100, help="Number of sessions the rows are spread over.")
+    parser.set_defaults(rows=1000000, iterations=20)
+    args = parser.parse_args()
+    setup_django()
+
+    from tethysapp.hydroshare_timeseries_manager import model
+
+    engine = model.configure_engine(args.url)
+    model.Base.metadata.drop_all(engine)
+    legacy_table = legacy_catalog_table(model)
+    legacy_table.create(engine)
+
+    session_ids = [str(uuid.uuid4()) for _ in range(args.sessions)]
+    for session_id in session_ids:
+        rows = seed_catalog(model, engine, session_id, args.rows // args.sessions, table=legacy_table)
+
+    params = {"session_id": session_ids[-1], "timeseries_id": rows[len(rows) // 2]["timeseries_id"], "selected": True}
+
+    explain(engine, "before migration", params, args.iterations)
+
+    start = time.perf_counter()
+    model.migrate_timeseries_catalog(engine)
+    print(f"\nmigration took {time.perf_counter() - start:.1f} s")
+
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as connection:
+            connection.execute(text("ANALYZE timeseries_catalog"))
+
+    explain(engine, "after migration", params, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
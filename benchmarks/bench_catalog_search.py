@@ -0,0 +1,48 @@
+"""
+Compares catalog search latency with the search index against ILIKE scans.
+
+One large session is seeded and each search term is run through the table query and
+select-by-search, first with the indexed search backend and then with the ILIKE
+fallback that was used before the search index existed.
+"""
+
+import uuid
+from common import setup_django, get_parser, reset_database, seed_catalog, timeit, report
+
+
+SEARCH_TERMS = ("Groundwater", "Site 42", "00060/DataType=Mean/99", "nothing matches this")
+
+
+def main():
+    parser = get_parser(__doc__)
+    parser.set_defaults(rows=100000, iterations=20)
+    args = parser.parse_args()
+    setup_django()
+
+    from tethysapp.hydroshare_timeseries_manager import model
+
+    engine = reset_database(model, args.url)
+    session_id = str(uuid.uuid4())
+    seed_catalog(model, engine, session_id, args.rows)
+
+    session = model.get_session()
+    indexed_backend = model._get_search_backend(session)
+    session.close()
+    print(f"search backend: {indexed_backend}")
+
+    for backend in (indexed_backend, "like"):
+        for search_term in SEARCH_TERMS:
+            model._search_backend = backend
+
+            def table_query():
+                model.get_timeseries_references(session_id, search_term, 10, 0, None, None)
+
+            def select_by_search():
+                model.update_timeseries_selections(session_id, None, search_term, True)
+
+            report(f"{backend} table query '{search_term}'", *timeit(table_query, args.iterations))
+            report(f"{backend} select by search '{search_term}'", *timeit(select_by_search, args.iterations))
+
+
+if __name__ == "__main__":
+    main()
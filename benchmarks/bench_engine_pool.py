@@ -0,0 +1,48 @@
+"""
+Compares catalog calls per second with the shared pooled engine against creating
+and disposing an engine for every call, which was the previous behavior.
+"""
+
+import uuid
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from common import setup_django, get_parser, reset_database, seed_catalog, timeit, report
+
+
+def main():
+    args = get_parser(__doc__).parse_args()
+    setup_django()
+
+    from tethysapp.hydroshare_timeseries_manager import model
+
+    engine = reset_database(model, args.url)
+    session_id = str(uuid.uuid4())
+    seed_catalog(model, engine, session_id, args.rows)
+
+    def per_call_engine():
+        Session = sessionmaker(bind=create_engine(args.url))
+        session = Session()
+        session.query(model.TimeSeriesCatalog.status).filter(
+            model.TimeSeriesCatalog.session_id == session_id
+        ).limit(10).all()
+        bind = session.get_bind()
+        session.close()
+        bind.dispose()
+
+    def pooled_engine():
+        session = model.get_session()
+        session.query(model.TimeSeriesCatalog.status).filter(
+            model.TimeSeriesCatalog.session_id == session_id
+        ).limit(10).all()
+        session.close()
+
+    def table_poll():
+        model.get_timeseries_references(session_id, "", 10, 0, None, None)
+
+    report("engine per call (previous)", *timeit(per_call_engine, args.iterations))
+    report("shared pooled engine", *timeit(pooled_engine, args.iterations))
+    report("get_timeseries_references (pooled)", *timeit(table_poll, args.iterations))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Reports compression ratio and throughput of the WaterML payload codecs.
+
+A synthetic WaterML 1.1 response of the requested size is encoded and decoded with
+each available codec, and parsed both from fully decoded bytes and from a
+decompressing stream. Only the payload codec module is imported, so this benchmark
+does not need a Tethys environment or a database.
+"""
+
+import os
+import sys
+import time
+import datetime
+from lxml import etree
+from common import get_parser
+
+
+def make_wml_payload(size_mb):
+    """
+    Generates a synthetic WaterML 1.1 timeSeriesResponse of roughly the given size.
+    """
+
+    header = (
+        '<timeSeriesResponse xmlns="http://www.cuahsi.org/waterML/1.1/">'
+        '<timeSeries><sourceInfo><siteName>Synthetic Site</siteName>'
+        '<siteCode network="NWISIV">01646500</siteCode></sourceInfo>'
+        '<variable><variableCode vocabulary="NWISIV">00060</variableCode>'
+        '<variableName>Discharge</variableName><noDataValue>-999999</noDataValue></variable>'
+        '<values>'
+    )
+    footer = '</values></timeSeries></timeSeriesResponse>'
+
+    start = datetime.datetime(2000, 1, 1)
+    values = []
+    size = len(header) + len(footer)
+    i = 0
+    while size < size_mb * 1024 * 1024:
+        value = (
+            f'<value censorCode="nc" dateTime="{(start + datetime.timedelta(minutes=15 * i)).isoformat()}" '
+            f'timeOffset="-05:00" methodCode="1" sourceCode="1" qualityControlLevelCode="1">'
+            f'{1000 + (i * 37) % 5000 / 10.0}</value>'
+        )
+        values.append(value)
+        size += len(value)
+        i += 1
+
+    return (header + "".join(values) + footer).encode("utf-8")
+
+
+def main():
+    parser = get_parser(__doc__)
+    parser.add_argument("--size-mb", type=float, default=20, help="Size of the synthetic payload in MB.")
+    parser.set_defaults(iterations=5)
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from tethysapp.hydroshare_timeseries_manager import payload_codec
+
+    wml_data = make_wml_payload(args.size_mb)
+    raw_mb = len(wml_data) / 1024 / 1024
+    print(f"payload size: {raw_mb:.1f} MB")
+
+    codecs = ["identity", "gzip"]
+    if payload_codec.zstandard is not None:
+        codecs.append("zstd")
+    else:
+        print("zstandard is not installed; skipping zstd")
+
+    for codec in codecs:
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            codec, encoded_data = payload_codec.encode_payload(wml_data, codec)
+        encode_seconds = (time.perf_counter() - start) / args.iterations
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            payload_codec.decode_payload(codec, encoded_data)
+        decode_seconds = (time.perf_counter() - start) / args.iterations
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            etree.fromstring(payload_codec.decode_payload(codec, encoded_data))
+        parse_bytes_seconds = (time.perf_counter() - start) / args.iterations
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            with payload_codec.open_payload_stream(codec, encoded_data) as wml_stream:
+                etree.parse(wml_stream)
+        parse_stream_seconds = (time.perf_counter() - start) / args.iterations
+
+        print(
+            f"{codec:<10} ratio {len(wml_data) / len(encoded_data):>6.2f}x "
+            f"stored {len(encoded_data) / 1024 / 1024:>7.2f} MB "
+            f"encode {raw_mb / encode_seconds:>8.1f} MB/s "
+            f"decode {raw_mb / decode_seconds:>8.1f} MB/s "
+            f"parse bytes {parse_bytes_seconds * 1000:>8.1f} ms "
+            f"parse stream {parse_stream_seconds * 1000:>8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Compares get_resource_metadata against the seven separate queries it replaced.
+
+One session is seeded with the requested number of selected Ready series, plus the
+same number of unselected series, and both implementations are timed against it.
+"""
+
+import uuid
+from common import setup_django, get_parser, reset_database, seed_catalog, timeit, report
+
+
+def legacy_get_resource_metadata(model, session_id):
+    """
+    Runs the queries get_resource_metadata issued before it used a single query.
+    """
+
+    catalog = model.TimeSeriesCatalog
+    session = model.get_session()
+    ready_filter = (catalog.session_id == session_id, catalog.selected == True, catalog.status == "Ready")
+
+    site_query = session.query(catalog.site_name).filter(*ready_filter).distinct()
+    site_names = site_query.limit(5).all()
+    site_count = site_query.count()
+    variable_query = session.query(catalog.variable_name).filter(*ready_filter).distinct()
+    variable_names = variable_query.limit(5).all()
+    variable_count = variable_query.count()
+    sample_mediums = session.query(catalog.sample_medium).filter(*ready_filter).distinct().limit(5).all()
+    start_date = session.query(catalog.begin_date).filter(*ready_filter).order_by(catalog.begin_date.asc()).first()
+    end_date = session.query(catalog.end_date).filter(*ready_filter).order_by(catalog.begin_date.desc()).first()
+    invalid_selected_count = session.query(catalog).filter(
+        catalog.session_id == session_id, catalog.selected == True, catalog.status != "Ready"
+    ).count()
+
+    session.close()
+
+    return site_names, site_count, variable_names, variable_count, sample_mediums, start_date, end_date, invalid_selected_count
+
+
+def main():
+    parser = get_parser(__doc__)
+    parser.set_defaults(rows=50000, iterations=20)
+    args = parser.parse_args()
+    setup_django()
+
+    from tethysapp.hydroshare_timeseries_manager import model
+
+    engine = reset_database(model, args.url)
+    session_id = str(uuid.uuid4())
+    seed_catalog(model, engine, session_id, args.rows * 2, selected_every=2)
+
+    def legacy_queries():
+        legacy_get_resource_metadata(model, session_id)
+
+    def single_query():
+        model.get_resource_metadata(session_id)
+
+    report(f"seven queries, {args.rows} selected (previous)", *timeit(legacy_queries, args.iterations))
+    report(f"single query, {args.rows} selected", *timeit(single_query, args.iterations))
+
+
+if __name__ == "__main__":
+    main()
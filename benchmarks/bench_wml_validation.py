@@ -0,0 +1,49 @@
+"""
+Reports WaterML validations per second with and without the compiled schema registry.
+
+Small synthetic WaterML 1.1 responses are validated the way validate_wml did before
+schemas were cached, compiling the XSD for every series, and with the schema returned
+by get_wml_schema. No database is needed.
+"""
+
+import io
+import time
+from lxml import etree
+from common import setup_django, get_parser
+from bench_payload_codec import make_wml_payload
+
+
+def main():
+    parser = get_parser(__doc__)
+    parser.add_argument("--size-kb", type=float, default=20, help="Size of each synthetic payload in KB.")
+    parser.set_defaults(iterations=500)
+    args = parser.parse_args()
+    setup_django()
+
+    from tethysapp.hydroshare_timeseries_manager import utilities
+
+    wml_data = make_wml_payload(args.size_kb / 1024)
+    workspace = utilities.get_app_workspace()
+    schema_path = f"{workspace}/wml_1_1_schema.xsd"
+
+    def compile_per_call():
+        wml_schema = etree.XMLSchema(etree.parse(schema_path))
+        wml_schema.validate(etree.parse(io.BytesIO(wml_data)))
+
+    def cached_schema():
+        wml_schema = utilities.get_wml_schema("WaterML 1.1", workspace)
+        wml_schema.validate(etree.parse(io.BytesIO(wml_data)))
+
+    print(f"payload size: {len(wml_data) / 1024:.1f} KB")
+
+    for label, function in (("compile per call (previous)", compile_per_call), ("cached schema", cached_schema)):
+        function()
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            function()
+        seconds = time.perf_counter() - start
+        print(f"{label:<30} {args.iterations / seconds:>10.1f} validations/s  {seconds / args.iterations * 1000:>8.3f} ms each")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,10 @@ from datetime import datetime
 from django.template.defaultfilters import slugify
 from django.http import JsonResponse
 from .model import get_timeseries_references, update_timeseries_selections, remove_timeseries_references, \
-                   get_timeseries_request_data, update_timeseries_reference, add_pending_timeseries, \
-                   get_pending_timeseries, remove_pending_timeseries, get_resource_metadata
-from .utilities import get_refts_from_hydroshare, add_refts_to_session, extract_soap_wml, validate_wml, \
-                       extract_rest_wml, download_soap_wml, download_rest_wml, get_app_workspace, \
-                       create_refts_file
+                   add_pending_timeseries_list, get_resource_metadata, prioritize_visible_timeseries, \
+                   prioritize_selected_timeseries, get_selected_timeseries_ids, update_timeseries_references
+from .utilities import get_refts_from_hydroshare, add_refts_to_session, get_app_workspace, create_refts_file
+from .jobs import enqueue_prepare_job, get_job_progress
 
 
 def update_table(request):
@@ -16,7 +15,8 @@ def update_table(request):
     Loads data for Datatables.
 
     This function handles Datatables server-side processing. Returns filtered paged results
-    to the client to be displayed to the user.
+    to the client to be displayed to the user. Pending time series on the returned page
+    are prepared first.
     """
 
     return_obj = {}
@@ -43,6 +43,7 @@ def update_table(request):
     order = request.POST.get('order[0][dir]')
     selected = request.POST.get('selected')
     timeseries_id = request.POST.get('timeseries_id')
+    seek_after = request.POST.get('seek-after')
 
     # ---------------------- #
     #   GETS FILTERED DATA   #
@@ -54,9 +55,12 @@ def update_table(request):
         length=length,
         offset=offset,
         column=column,
-        order=order
+        order=order,
+        seek_after=seek_after
     )
 
+    prioritize_visible_timeseries(session_id=session_id, timeseries_ids=[x[19] for x in results])
+
     # -------------------- #
     #   RETURNS RESPONSE   #
     # -------------------- #
@@ -75,7 +79,8 @@ def update_selections(request):
     Updates selected timeseries.
 
     This function toggles selected timeseries in a session. It can update one given a
-    timeseries ID, or more given a search value.
+    timeseries ID, or more given a search value. Selected time series that are still
+    pending are prepared before unselected ones.
     """
 
     return_obj = {}
@@ -109,6 +114,8 @@ def update_selections(request):
         selected=selected
     )
 
+    prioritize_selected_timeseries(session_id=session_id)
+
     # -------------------- #
     #   RETURNS RESPONSE   #
     # -------------------- #
@@ -211,12 +218,11 @@ def add_session_data(request):
     # ---------------------------------- #
 
     refts_id = str(uuid.uuid4())
-    for timeseries_id in timeseries_id_list:
-        add_pending_timeseries(
-            session_id=session_id,
-            refts_id=refts_id,
-            timeseries_id=timeseries_id
-        )
+    add_pending_timeseries_list(
+        session_id=session_id,
+        refts_id=refts_id,
+        timeseries_ids=timeseries_id_list
+    )
 
     # -------------------- #
     #   RETURNS RESPONSE   #
@@ -239,8 +245,11 @@ def prepare_session_data(request):
     """
     Prepares session data.
 
-    This function builds WaterOneFlow requests and begins downloading WaterML 
-    data for a batch of time series references.
+    This function queues a background job that builds WaterOneFlow requests and
+    downloads WaterML data for a batch of time series references, and returns
+    the job ID without waiting for the downloads. With refresh set, time series
+    prepared before only download their new values. A refresh without a REFTS ID
+    queues the selected time series of the session.
     """
 
     return_obj = {}
@@ -260,77 +269,90 @@ def prepare_session_data(request):
 
     session_id = request.POST.get('sessionId')
     refts_id = request.POST.get('reftsId')
+    refresh = request.POST.get('refresh') == "true"
 
-    # ----------------------------- #
-    #   PREPARES WATERML REQUESTS   #
-    # ----------------------------- #
+    # ------------------------------------ #
+    #   QUEUES SELECTED TIMESERIES AGAIN   #
+    # ------------------------------------ #
 
-    timeseries_id_list = list(sum(get_pending_timeseries(session_id, refts_id), ()))
-    remove_pending_timeseries(session_id, refts_id)
+    if refresh and not refts_id:
+        timeseries_ids = get_selected_timeseries_ids(session_id=session_id)
 
-    request_data_list = []
-    for timeseries_id in timeseries_id_list:
-        request_data = get_timeseries_request_data(session_id=session_id, timeseries_id=timeseries_id)
-        update_timeseries_reference(session_id=session_id, timeseries_id=timeseries_id, status="Downloading")
-        request_data_list.append(request_data)
+        if not timeseries_ids:
+            return_obj["success"] = False
+            return_obj["message"] = "No time series are selected."
 
-    soap_url_list = [
-        {
-            "timeseries_id": x[0],
-            "url": x[17],
-            "version": "1.1" if x[15] == "WaterML 1.1" else "1.0",
-            "location": x[8],
-            "variable": x[12],
-            "start_date": x[3],
-            "end_date": x[4],
-            "auth_token": ""
-        } for x in request_data_list if x[16] == "SOAP"
-    ]
+            return JsonResponse(return_obj)
 
-    rest_url_list = [
-        {
-            "timeseries_id": x[0],
-            "url": f"{x[17]}values/?site_code={x[8]}&variable_code={x[12]}&start_date={x[3]}&end_date={x[4]}"
-        } for x in request_data_list if x[16] == "REST"
-    ]
+        refts_id = str(uuid.uuid4())
+        update_timeseries_references(
+            session_id=session_id,
+            changes=[(timeseries_id, {"status": "Waiting"}) for timeseries_id in timeseries_ids]
+        )
+        add_pending_timeseries_list(
+            session_id=session_id,
+            refts_id=refts_id,
+            timeseries_ids=timeseries_ids
+        )
 
-    # ---------------------------------------------- #
-    #   DOWNLOADS, EXTRACTS, AND VALIDATES WATERML   #
-    # ---------------------------------------------- #
+    # ---------------------- #
+    #   QUEUES PREPARE JOB   #
+    # ---------------------- #
 
+    job_id = enqueue_prepare_job(session_id=session_id, refts_id=refts_id, refresh=refresh)
 
-    soap_response = download_soap_wml(soap_url_list)
-    rest_response = download_rest_wml(rest_url_list)
+    # -------------------- #
+    #   RETURNS RESPONSE   #
+    # -------------------- #
 
-    for result in soap_response:
-        soap_data = result[0]
-        request_data = get_timeseries_request_data(session_id=session_id, timeseries_id=result[1])
-        wml_version = request_data[15]
-        wml_data = extract_soap_wml(soap_data, wml_version, unzip=False)
+    return_obj["success"] = True
+    return_obj["job_id"] = job_id
+
+    return JsonResponse(return_obj)
 
-        update_timeseries_reference(session_id=session_id, timeseries_id=result[1], wml_data=wml_data, status="Validating")
 
-        if not validate_wml(session_id=session_id, timeseries_id=result[1], wml_version=wml_version):
-            update_timeseries_reference(session_id=session_id, timeseries_id=result[1], status="Failed")
-        else:
-            update_timeseries_reference(session_id=session_id, timeseries_id=result[1], status="Ready")
+def job_progress(request):
+    """
+    Gets the progress of a prepare job.
 
-    for result in rest_response:
-        rest_data = result[0]
-        wml_data = extract_rest_wml(rest_data, unzip=False)
+    This function reports how many time series of a queued import are done,
+    along with the job's throughput and estimated time remaining.
+    """
 
-        update_timeseries_reference(session_id=session_id, timeseries_id=result[1], wml_data=wml_data, status="Validating")
+    return_obj = {}
 
-        if not validate_wml(session_id=session_id, timeseries_id=result[1], wml_version="WaterML 1.1"):
-            update_timeseries_reference(session_id=session_id, timeseries_id=result[1], status="Failed")
-        else:
-            update_timeseries_reference(session_id=session_id, timeseries_id=result[1], status="Ready")
+    # -------------------- #
+    #   VERIFIES REQUEST   #
+    # -------------------- #
+
+    if not (request.is_ajax() and request.method == "POST"):
+        return_obj["error"] = "Unable to establish a secure connection with the server."
+
+        return JsonResponse(return_obj)
+
+    # -------------------------- #
+    #   GETS DATA FROM REQUEST   #
+    # -------------------------- #
+
+    session_id = request.POST.get('sessionId')
+    job_id = request.POST.get('jobId')
+
+    # --------------------- #
+    #   GETS JOB PROGRESS   #
+    # --------------------- #
+
+    progress = get_job_progress(session_id=session_id, job_id=job_id)
 
     # -------------------- #
     #   RETURNS RESPONSE   #
     # -------------------- #
 
-    return_obj["success"] = True
+    if progress is None:
+        return_obj["success"] = False
+        return_obj["message"] = "Job not found."
+    else:
+        return_obj["success"] = True
+        return_obj["progress"] = progress
 
     return JsonResponse(return_obj)
 
@@ -376,10 +398,6 @@ def update_resource_metadata(request):
         return_obj["message"] = "Please select at least one row."
         return JsonResponse(return_obj)
 
-    site_names = list(sum(site_names, ()))
-    variable_names = list(sum(variable_names, ()))
-    sample_mediums = list(sum(sample_mediums, ()))
-
     site_s = "s" if len(site_names) > 1 else ""
     date = datetime.today().strftime('%b %-d, %Y')
     if site_count > 5:
@@ -398,7 +416,7 @@ def update_resource_metadata(request):
         variables = ""
 
     res_title = f"Time series dataset created on {date} by the HydroShare Time Series Manager"
-    res_abstract = f"{variables} data collected from {start_date[0].strftime('%x')} to {end_date[0].strftime('%x')} at the following site{site_s}: {sites}. Data compiled by the HydroShare Time Series Manager on {date}"
+    res_abstract = f"{variables} data collected from {start_date.strftime('%x')} to {end_date.strftime('%x')} at the following site{site_s}: {sites}. Data compiled by the HydroShare Time Series Manager on {date}"
     res_keywords = site_names + variable_names + sample_mediums
     res_filename = slugify(f"{variable_names[0]}-at-{site_names[0]}")[0:40]
 
@@ -55,6 +55,11 @@ class HydroshareTimeseriesManager(TethysAppBase):
                 url='hydroshare-timeseries-manager/ajax/prepare-session-data',
                 controller='hydroshare_timeseries_manager.ajax_controllers.prepare_session_data'
             ),
+            UrlMap(
+                name='ajax_job_progress',
+                url='hydroshare-timeseries-manager/ajax/job-progress',
+                controller='hydroshare_timeseries_manager.ajax_controllers.job_progress'
+            ),
             UrlMap(
                 name='ajax_update_resource_metadata',
                 url='hydroshare-timeseries-manager/ajax/update-resource-metadata',
@@ -110,6 +115,138 @@ class HydroshareTimeseriesManager(TethysAppBase):
                 description='HydroServer URL',
                 required=True
             ),
+            CustomSetting(
+                name='db_pool_size',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Number of pooled database connections kept open per process (default 5)',
+                required=False
+            ),
+            CustomSetting(
+                name='db_max_overflow',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Number of database connections allowed beyond the pool size (default 10)',
+                required=False
+            ),
+            CustomSetting(
+                name='db_pool_recycle',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Seconds after which pooled database connections are recycled (default 1800)',
+                required=False
+            ),
+            CustomSetting(
+                name='db_pool_pre_ping',
+                type=CustomSetting.TYPE_BOOLEAN,
+                description='Test pooled database connections before use (default True)',
+                required=False
+            ),
+            CustomSetting(
+                name='wml_cache_ttl',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Seconds a downloaded WaterML response is reused across sessions (default 604800)',
+                required=False
+            ),
+            CustomSetting(
+                name='wml_cache_max_size',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Maximum size in MB of the shared WaterML cache (default 1024)',
+                required=False
+            ),
+            CustomSetting(
+                name='download_max_connections',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Maximum number of open connections for WaterML downloads (default 20)',
+                required=False
+            ),
+            CustomSetting(
+                name='download_max_connections_per_host',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Number of parallel downloads from a WaterOneFlow server the app starts with before adapting to the server (default 4)',
+                required=False
+            ),
+            CustomSetting(
+                name='download_max_host_concurrency',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Maximum number of parallel downloads from one WaterOneFlow server (default 50)',
+                required=False
+            ),
+            CustomSetting(
+                name='download_connect_timeout',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Seconds to wait for a connection to a WaterOneFlow server (default 10)',
+                required=False
+            ),
+            CustomSetting(
+                name='download_read_timeout',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Seconds to wait for data from a WaterOneFlow server before giving up (default 60)',
+                required=False
+            ),
+            CustomSetting(
+                name='download_max_retries',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Number of times a failed WaterML download is retried (default 3)',
+                required=False
+            ),
+            CustomSetting(
+                name='download_spool_threshold',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Size in MB above which a downloaded response is written to disk instead of kept in memory (default 8)',
+                required=False
+            ),
+            CustomSetting(
+                name='download_max_inflight',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Maximum MB of downloaded responses held in memory before new downloads wait (default 256)',
+                required=False
+            ),
+            CustomSetting(
+                name='download_session_max_requests',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Maximum number of downloads one session can run at once (default 10)',
+                required=False
+            ),
+            CustomSetting(
+                name='download_session_max_inflight',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Maximum MB of downloaded responses one session can hold in memory (default 64)',
+                required=False
+            ),
+            CustomSetting(
+                name='split_value_count',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Number of values above which a time series is downloaded in several date windows at once (default 100000)',
+                required=False
+            ),
+            CustomSetting(
+                name='job_backend',
+                type=CustomSetting.TYPE_STRING,
+                description='Where background import jobs run: "thread" or "process" (default thread)',
+                required=False
+            ),
+            CustomSetting(
+                name='job_workers',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Number of background import jobs run at once per web process (default 2)',
+                required=False
+            ),
+            CustomSetting(
+                name='job_chunk_size',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Number of time series an import job prepares between progress updates (default 50)',
+                required=False
+            ),
+            CustomSetting(
+                name='job_lease_seconds',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Seconds a worker holds a batch of time series before another worker may take it over (default 300)',
+                required=False
+            ),
+            CustomSetting(
+                name='validation_workers',
+                type=CustomSetting.TYPE_INTEGER,
+                description='Number of processes that extract and validate downloaded WaterML (default one per CPU core)',
+                required=False
+            ),
         )
 
         return custom_settings
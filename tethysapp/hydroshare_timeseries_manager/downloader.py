@@ -0,0 +1,1225 @@
+import io
+import os
+import mmap
+import time
+import atexit
+import random
+import socket
+import asyncio
+import tempfile
+import threading
+import collections
+import concurrent.futures
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig, ClientConnectionError, \
+                    ClientPayloadError
+from .app import HydroshareTimeseriesManager as app
+from .model import _get_setting, get_host_concurrency_limits, update_host_concurrency_limits, \
+                   record_download_queue_stats
+
+
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 4
+DEFAULT_MAX_HOST_CONCURRENCY = 50
+DEFAULT_SESSION_MAX_REQUESTS = 10
+DEFAULT_SESSION_MAX_INFLIGHT = 64
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_KEEPALIVE_TIMEOUT = 30
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_BASE = 0.5
+DEFAULT_BACKOFF_MAX = 30
+DEFAULT_RETRY_AFTER_MAX = 120
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET_TIMEOUT = 30
+DEFAULT_SPOOL_THRESHOLD = 8
+DEFAULT_MAX_INFLIGHT = 256
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+CONCURRENCY_DECREASE_FACTOR = 0.5
+SLOW_RESPONSE_FACTOR = 3.0
+LATENCY_SMOOTHING = 0.2
+QUEUE_STATS_INTERVAL = 5
+QUEUE_STATS_MAX_AGE = 30
+
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = (ClientConnectionError, ClientPayloadError, asyncio.TimeoutError)
+
+_download_engine = None
+_download_engine_lock = threading.Lock()
+
+
+# ------------------------- #
+#   BACKGROUND EVENT LOOP   #
+# ------------------------- #
+
+class BackgroundEventLoop:
+    """
+    Long-lived asyncio event loop running in a dedicated daemon thread.
+
+    Request threads never create or set their own event loops. They submit coroutines
+    to this loop and wait on the returned futures, so state owned by the loop, such as
+    pooled connections, DNS results, and TLS sessions, persists across requests.
+    """
+
+    def __init__(self, name="hydroshare-timeseries-manager-loop"):
+
+        self.loop = asyncio.new_event_loop()
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """
+        Schedules a coroutine on the loop and returns a concurrent.futures.Future.
+        """
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def submit_held(self, coroutine, release):
+        """
+        Schedules a coroutine whose result holds resources, like submit.
+
+        Cancelling the returned future cancels the coroutine. If the coroutine has
+        already returned when the future is cancelled, its result is passed to release
+        instead of being dropped.
+        """
+
+        future = concurrent.futures.Future()
+
+        def deliver(task):
+            if not future.set_running_or_notify_cancel():
+                if not task.cancelled() and task.exception() is None:
+                    release(task.result())
+            elif task.cancelled():
+                future.set_exception(concurrent.futures.CancelledError())
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def start():
+            if future.cancelled():
+                coroutine.close()
+                return
+            task = self.loop.create_task(coroutine)
+            task.add_done_callback(deliver)
+            future.add_done_callback(
+                lambda _: future.cancelled() and self.loop.call_soon_threadsafe(task.cancel)
+            )
+
+        self.loop.call_soon_threadsafe(start)
+
+        return future
+
+    def run(self, coroutine, timeout=None):
+        """
+        Runs a coroutine on the loop and waits for its result.
+        """
+
+        return self.submit(coroutine).result(timeout)
+
+    def stop(self):
+        """
+        Stops the loop, waits for its thread to exit, and closes it.
+        """
+
+        if self.loop.is_closed():
+            return
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+# ------------------- #
+#   CIRCUIT BREAKER   #
+# ------------------- #
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request to a host whose circuit is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker.
+
+    After a number of consecutive failed requests the circuit opens and requests to the
+    host fail immediately instead of waiting to time out. Once the reset timeout has
+    passed, one trial request is let through; it closes the circuit if it succeeds and
+    reopens it if it fails. Breakers are only used from the background loop thread.
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_BREAKER_THRESHOLD, reset_timeout=DEFAULT_BREAKER_RESET_TIMEOUT):
+
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_count = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    def check(self):
+        """
+        Raises CircuitOpenError if the circuit is open, without claiming the trial request.
+        """
+
+        if self.opened_at is None:
+            return
+
+        if time.monotonic() - self.opened_at < self.reset_timeout or self.trial_in_progress:
+            raise CircuitOpenError(
+                f"Circuit open after {self.failure_count} consecutive failures; "
+                f"retrying the server in {max(0, self.reset_timeout - (time.monotonic() - self.opened_at)):.0f}s"
+            )
+
+    def before_request(self):
+        """
+        Raises CircuitOpenError if a request to the host should not be sent.
+
+        Returns True if the request is the trial request of a half-open circuit.
+        """
+
+        self.check()
+
+        if self.opened_at is None:
+            return False
+
+        self.trial_in_progress = True
+
+        return True
+
+    def release_trial(self):
+        """
+        Lets another trial request through after one ended without reaching the server.
+        """
+
+        self.trial_in_progress = False
+
+    def record_success(self):
+        self.failure_count = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    def record_failure(self, trial=False):
+        """
+        Records a failed request.
+
+        The circuit opens when the failures first reach the threshold and reopens when
+        the trial request fails. Failures of requests sent before the circuit opened do
+        not push back the trial.
+        """
+
+        self.failure_count += 1
+        if trial:
+            self.trial_in_progress = False
+            self.opened_at = time.monotonic()
+        elif self.opened_at is None and self.failure_count >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+# ----------------------------- #
+#   FAIR SHARING OF DOWNLOADS   #
+# ----------------------------- #
+
+class SessionDownloadQueue:
+    """
+    Downloads of one session waiting for, or holding, a download slot.
+
+    The queue also counts the response bytes the session holds in memory, so it can
+    be used as a byte budget by ResponseBuffer.
+    """
+
+    def __init__(self, scheduler, weight=1):
+
+        self.scheduler = scheduler
+        self.weight = weight
+        self.waiters = collections.deque()
+        self.in_flight = 0
+        self.held_bytes = 0
+        self.deficit = 0
+
+    def can_send(self):
+        return self.in_flight < self.scheduler.session_max_requests and \
+            self.held_bytes < self.scheduler.session_max_bytes
+
+    def hold(self, byte_count):
+        self.held_bytes += byte_count
+
+    def release(self, byte_count):
+        self.held_bytes -= byte_count
+        self.scheduler.dispatch()
+
+
+class FairScheduler:
+    """
+    Shares the engine's download slots between sessions with deficit round robin.
+
+    Each session has its own queue of waiting downloads. Whenever a slot is free, the
+    scheduler visits the sessions with waiting downloads in turn and lets each send as
+    many downloads as its deficit allows, adding its weight to the deficit on every
+    visit. A session with thousands of queued downloads therefore gets the same share
+    of slots as one with ten. A session is skipped while it has its maximum number of
+    downloads running or holds its maximum bytes in memory. Schedulers are only used
+    from the background loop thread.
+    """
+
+    def __init__(self, slots, session_max_requests, session_max_bytes):
+
+        self.slots = slots
+        self.session_max_requests = session_max_requests
+        self.session_max_bytes = session_max_bytes
+        self.in_use = 0
+        self.sessions = {}
+        self.active_sessions = collections.deque()
+
+    def get_session_queue(self, session_key):
+        """
+        Gets the download queue of a session.
+        """
+
+        if session_key not in self.sessions:
+            self.sessions[session_key] = SessionDownloadQueue(self)
+
+        return self.sessions[session_key]
+
+    async def acquire(self, session_key):
+        """
+        Waits until the session's turn to send a download.
+        """
+
+        session_queue = self.get_session_queue(session_key)
+        waiter = asyncio.get_event_loop().create_future()
+        session_queue.waiters.append(waiter)
+        if session_key not in self.active_sessions:
+            self.active_sessions.append(session_key)
+        self.dispatch()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter in session_queue.waiters:
+                session_queue.waiters.remove(waiter)
+            elif waiter.done() and not waiter.cancelled():
+                self.release(session_key)
+            raise
+
+    def release(self, session_key):
+        """
+        Gives back the slot of a finished download.
+        """
+
+        session_queue = self.sessions[session_key]
+        session_queue.in_flight -= 1
+        self.in_use -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        """
+        Hands free slots to waiting downloads, visiting sessions in turn.
+        """
+
+        while self.in_use < self.slots and self.active_sessions:
+            dispatched = False
+
+            for _ in range(len(self.active_sessions)):
+                session_key = self.active_sessions[0]
+                session_queue = self.sessions[session_key]
+
+                if session_queue.can_send():
+                    session_queue.deficit += session_queue.weight
+                    while session_queue.deficit >= 1 and session_queue.waiters and \
+                            self.in_use < self.slots and session_queue.can_send():
+                        waiter = session_queue.waiters.popleft()
+                        if waiter.done():
+                            continue
+                        waiter.set_result(None)
+                        session_queue.deficit -= 1
+                        session_queue.in_flight += 1
+                        self.in_use += 1
+                        dispatched = True
+
+                if not session_queue.waiters:
+                    session_queue.deficit = 0
+                    self.active_sessions.popleft()
+                else:
+                    self.active_sessions.rotate(-1)
+
+                if self.in_use >= self.slots:
+                    break
+
+            if not dispatched:
+                break
+
+        for session_key in [x for x, y in self.sessions.items() if not y.waiters and not y.in_flight and not y.held_bytes]:
+            del self.sessions[session_key]
+
+    def get_stats(self):
+        """
+        Gets the number of queued and running downloads and the bytes held in memory
+        by each session.
+        """
+
+        return {
+            session_key: {
+                "queued": len(session_queue.waiters),
+                "in_flight": session_queue.in_flight,
+                "bytes_in_flight": session_queue.held_bytes
+            } for session_key, session_queue in self.sessions.items()
+        }
+
+
+class QueueStatsRecorder:
+    """
+    Records the per-session download queues of an engine in the app database.
+
+    Progress can be polled from any web process, and with the process job backend the
+    downloads run in worker processes, so each engine records its queues where every
+    process can read them. The stats are checked every few seconds and written when
+    they change. While downloads are queued they are also rewritten every half of
+    QUEUE_STATS_MAX_AGE, so readers can ignore stats left by a process that stopped.
+    An idle engine writes nothing.
+    """
+
+    def __init__(self, download_engine, interval=QUEUE_STATS_INTERVAL):
+
+        self.download_engine = download_engine
+        self.interval = interval
+        self.process_key = f"{socket.gethostname()}:{os.getpid()}"
+        self.recorded_stats = {}
+        self.recorded_at = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.record(self.download_engine.get_queue_stats())
+            except Exception:
+                pass
+
+    def record(self, queue_stats):
+        """
+        Writes the queue stats if they changed or are about to go stale.
+        """
+
+        if queue_stats == self.recorded_stats and \
+                (not queue_stats or time.monotonic() - self.recorded_at < QUEUE_STATS_MAX_AGE / 2):
+            return
+
+        record_download_queue_stats(self.process_key, queue_stats)
+        self.recorded_stats = queue_stats
+        self.recorded_at = time.monotonic()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops recording and clears the stats recorded by this process.
+        """
+
+        self.stopped.set()
+        self.thread.join()
+        try:
+            self.record({})
+        except Exception:
+            pass
+
+
+# ------------------------ #
+#   ADAPTIVE CONCURRENCY   #
+# ------------------------ #
+
+class AdaptiveConcurrencyLimit:
+    """
+    Per-host concurrency limit that adapts to the server (AIMD).
+
+    Each healthy response raises the limit by one over the current limit, so the limit
+    grows by about one for every round of requests. Timeouts, connection errors,
+    retryable statuses such as 503, and responses much slower than the host's typical
+    time to headers cut the limit in half, at most once per typical response time so
+    that a burst of failures from requests sent together counts once. The limit stays
+    between one and the engine's maximum. Limits are only used from the background
+    loop thread.
+    """
+
+    def __init__(self, limit, max_limit, latency=None):
+
+        self.limit = min(float(max_limit), max(1.0, float(limit)))
+        self.max_limit = max_limit
+        self.latency = latency
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        self.last_decrease = 0.0
+
+    async def acquire(self):
+        """
+        Waits until another request may be sent to the host.
+        """
+
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        for _ in range(int(self.limit) - self.in_flight):
+            if not self.waiters:
+                break
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def record_success(self, latency):
+        """
+        Records a response and its time to headers in seconds.
+        """
+
+        if self.latency is not None and latency > self.latency * SLOW_RESPONSE_FACTOR:
+            self._decrease()
+        else:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+
+        self.latency = latency if self.latency is None else \
+            (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * latency
+        self._wake_waiters()
+
+    def record_failure(self):
+        """
+        Records a timeout, connection error, or retryable status.
+        """
+
+        self._decrease()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease < (self.latency or 1.0):
+            return
+
+        self.last_decrease = now
+        self.limit = max(1.0, self.limit * CONCURRENCY_DECREASE_FACTOR)
+
+
+class RetryableStatusError(Exception):
+    """
+    Raised for HTTP responses that are worth retrying, such as 503 Service Unavailable.
+    """
+
+    def __init__(self, status, reason, retry_after=None):
+        super().__init__(f"HTTP {status} {reason or ''}".strip())
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header into a number of seconds, or None if it is missing or invalid.
+    """
+
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+# ---------------------- #
+#   RESPONSE BUFFERING   #
+# ---------------------- #
+
+class SpooledResponse:
+    """
+    Response body that was written to a temporary file.
+
+    Only the path and size of the file are kept, so the response can be handed to a
+    validation worker process. The file is deleted with discard once the body is no
+    longer needed.
+    """
+
+    def __init__(self, path, size):
+
+        self.path = path
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def open(self):
+        """
+        Opens the body as a read-only memory map, which can be read like a file.
+        """
+
+        with open(self.path, "rb") as spool_file:
+            return mmap.mmap(spool_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def discard(self):
+        """
+        Deletes the temporary file.
+        """
+
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def open_response(response_data):
+    """
+    Opens a downloaded response body, held in memory or spooled to disk, as a file.
+    """
+
+    if isinstance(response_data, SpooledResponse):
+        return response_data.open()
+
+    return io.BytesIO(response_data)
+
+
+class ByteBudget:
+    """
+    Limits the number of downloaded bytes held in memory.
+
+    Bytes are held from the time they are read until the response is released, or
+    until the response is spooled to disk. New downloads wait while the limit is
+    reached. Downloads already running are not paused, so the limit can be exceeded by
+    up to one spool threshold per open connection. Budgets are only used from the
+    background loop thread.
+    """
+
+    def __init__(self, max_bytes):
+
+        self.max_bytes = max_bytes
+        self.held_bytes = 0
+        self.room = None
+
+    async def wait(self):
+        """
+        Waits until the bytes held in memory are under the limit.
+        """
+
+        if self.room is None:
+            self.room = asyncio.Event()
+
+        while self.held_bytes >= self.max_bytes:
+            self.room.clear()
+            await self.room.wait()
+
+    def hold(self, byte_count):
+        self.held_bytes += byte_count
+
+    def release(self, byte_count):
+        self.held_bytes -= byte_count
+        if self.room is not None and self.held_bytes < self.max_bytes:
+            self.room.set()
+
+
+class ResponseBuffer:
+    """
+    Collects a response body as it is downloaded.
+
+    The body is kept in memory until it passes the spool threshold, after which it is
+    moved to a temporary file in the spool directory and the rest of the body is
+    written there. Bytes held in memory are counted against each of the byte budgets,
+    such as the engine's budget and the budget of the session that sent the request.
+    """
+
+    def __init__(self, byte_budgets, spool_threshold, spool_dir):
+
+        self.byte_budgets = byte_budgets
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.buffer = bytearray()
+        self.spool_file = None
+        self.size = 0
+
+    def write(self, chunk):
+        self.size += len(chunk)
+
+        if self.spool_file is None and self.size > self.spool_threshold:
+            self.spool_file = tempfile.NamedTemporaryFile(
+                dir=self.spool_dir, prefix="wml-", suffix=".download", delete=False
+            )
+            self.spool_file.write(self.buffer)
+            self._release(len(self.buffer))
+            self.buffer = bytearray()
+
+        if self.spool_file is not None:
+            self.spool_file.write(chunk)
+        else:
+            self.buffer += chunk
+            for byte_budget in self.byte_budgets:
+                byte_budget.hold(len(chunk))
+
+    def _release(self, byte_count):
+        for byte_budget in self.byte_budgets:
+            byte_budget.release(byte_count)
+
+    def finish(self):
+        """
+        Returns the body, as bytes or as a SpooledResponse, and the bytes still held in memory.
+        """
+
+        if self.spool_file is not None:
+            self.spool_file.close()
+            return SpooledResponse(self.spool_file.name, self.size), 0
+
+        return bytes(self.buffer), len(self.buffer)
+
+    def discard(self):
+        """
+        Drops a body that was only partly downloaded.
+        """
+
+        self._release(len(self.buffer))
+        self.buffer = bytearray()
+
+        if self.spool_file is not None:
+            self.spool_file.close()
+            SpooledResponse(self.spool_file.name, self.size).discard()
+
+
+# ------------------- #
+#   DOWNLOAD ENGINE   #
+# ------------------- #
+
+class DownloadEngine:
+    """
+    Shared HTTP client for WaterOneFlow downloads.
+
+    The engine keeps one aiohttp session whose connector caps the total number of open
+    connections. Requests beyond that limit wait for a free connection instead of
+    opening new sockets, and idle connections are kept alive and reused by later
+    downloads. The number of requests sent to each host at once is set by an adaptive
+    limit, which starts at the per-host connection setting, grows while the server
+    answers quickly, and backs off when it slows down or fails. Learned limits are
+    stored with save_host_limits and loaded when the engine is created.
+
+    Connection errors, timeouts, and retryable HTTP statuses are retried with
+    exponential backoff and full jitter, honoring Retry-After when the server sends it.
+    Each host has a circuit breaker so that requests fail fast while its server is down.
+
+    Response bodies are read in chunks. Bodies larger than the spool threshold are
+    written to temporary files instead of being held in memory, and new downloads wait
+    while the bytes held in memory by the engine are over its in-flight limit.
+
+    Downloads are admitted by a fair scheduler that gives every session an equal
+    share of the engine's connections, with per-session caps on running downloads and
+    bytes held in memory, so a large import cannot starve small ones.
+    """
+
+    def __init__(self, max_connections=None, max_connections_per_host=None, connect_timeout=None,
+                 read_timeout=None, max_retries=None, keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                 backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX,
+                 breaker_threshold=DEFAULT_BREAKER_THRESHOLD, breaker_reset_timeout=DEFAULT_BREAKER_RESET_TIMEOUT,
+                 spool_threshold=None, max_inflight_bytes=None, spool_dir=None, max_host_concurrency=None,
+                 session_max_requests=None, session_max_inflight_bytes=None):
+
+        self.max_connections = int(
+            max_connections if max_connections is not None else
+            _get_setting("download_max_connections", DEFAULT_MAX_CONNECTIONS)
+        )
+        self.max_connections_per_host = int(
+            max_connections_per_host if max_connections_per_host is not None else
+            _get_setting("download_max_connections_per_host", DEFAULT_MAX_CONNECTIONS_PER_HOST)
+        )
+        self.connect_timeout = float(
+            connect_timeout if connect_timeout is not None else
+            _get_setting("download_connect_timeout", DEFAULT_CONNECT_TIMEOUT)
+        )
+        self.read_timeout = float(
+            read_timeout if read_timeout is not None else
+            _get_setting("download_read_timeout", DEFAULT_READ_TIMEOUT)
+        )
+        self.max_retries = int(
+            max_retries if max_retries is not None else
+            _get_setting("download_max_retries", DEFAULT_MAX_RETRIES)
+        )
+        self.keepalive_timeout = keepalive_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_timeout = breaker_reset_timeout
+        self.circuit_breakers = {}
+        self.max_host_concurrency = int(
+            max_host_concurrency if max_host_concurrency is not None else
+            _get_setting("download_max_host_concurrency", DEFAULT_MAX_HOST_CONCURRENCY)
+        )
+        self.host_limits = {}
+        try:
+            self.learned_host_limits = get_host_concurrency_limits()
+        except Exception:
+            # The engine still works without learned limits, e.g. before the app
+            # database has been initialized.
+            self.learned_host_limits = {}
+        self.spool_threshold = int(
+            spool_threshold if spool_threshold is not None else
+            _get_setting("download_spool_threshold", DEFAULT_SPOOL_THRESHOLD) * 1024 * 1024
+        )
+        self.max_inflight_bytes = int(
+            max_inflight_bytes if max_inflight_bytes is not None else
+            _get_setting("download_max_inflight", DEFAULT_MAX_INFLIGHT) * 1024 * 1024
+        )
+        self.spool_dir = spool_dir or os.path.join(app.get_app_workspace().path, "downloads")
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.byte_budget = ByteBudget(self.max_inflight_bytes)
+        self.session_max_requests = int(
+            session_max_requests if session_max_requests is not None else
+            _get_setting("download_session_max_requests", DEFAULT_SESSION_MAX_REQUESTS)
+        )
+        self.session_max_inflight_bytes = int(
+            session_max_inflight_bytes if session_max_inflight_bytes is not None else
+            _get_setting("download_session_max_inflight", DEFAULT_SESSION_MAX_INFLIGHT) * 1024 * 1024
+        )
+        self.scheduler = FairScheduler(self.max_connections, self.session_max_requests, self.session_max_inflight_bytes)
+
+        self.background_loop = BackgroundEventLoop()
+        self.pid = self.background_loop.pid
+        self.client_session = None
+        self.queue_stats_recorder = QueueStatsRecorder(self)
+        self.queue_stats_recorder.start()
+
+    def _get_client_session(self):
+        """
+        Gets the pooled client session, creating it on the engine's event loop.
+
+        The session is only used from coroutines running on the background loop, so it
+        is never shared between event loops.
+        """
+
+        if self.client_session is None or self.client_session.closed:
+            trace_config = TraceConfig()
+            trace_config.on_connection_queued_start.append(self._on_connection_queued_start)
+            trace_config.on_connection_queued_end.append(self._on_connection_queued_end)
+            trace_config.on_connection_create_start.append(self._on_connection_create_start)
+            trace_config.on_connection_create_end.append(self._on_connection_create_end)
+            trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+
+            self.client_session = ClientSession(
+                connector=TCPConnector(
+                    limit=self.max_connections,
+                    limit_per_host=self.max_host_concurrency,
+                    keepalive_timeout=self.keepalive_timeout
+                ),
+                timeout=ClientTimeout(
+                    total=None,
+                    sock_connect=self.connect_timeout,
+                    sock_read=self.read_timeout
+                ),
+                trace_configs=[trace_config]
+            )
+
+        return self.client_session
+
+    @staticmethod
+    async def _on_connection_queued_start(client_session, trace_config_ctx, params):
+        trace_config_ctx.trace_request_ctx["_queued_start"] = time.perf_counter()
+
+    @staticmethod
+    async def _on_connection_queued_end(client_session, trace_config_ctx, params):
+        timing = trace_config_ctx.trace_request_ctx
+        timing["queued"] = time.perf_counter() - timing.pop("_queued_start")
+
+    @staticmethod
+    async def _on_connection_create_start(client_session, trace_config_ctx, params):
+        trace_config_ctx.trace_request_ctx["_connect_start"] = time.perf_counter()
+
+    @staticmethod
+    async def _on_connection_create_end(client_session, trace_config_ctx, params):
+        timing = trace_config_ctx.trace_request_ctx
+        timing["connect"] = time.perf_counter() - timing.pop("_connect_start")
+
+    @staticmethod
+    async def _on_connection_reuseconn(client_session, trace_config_ctx, params):
+        trace_config_ctx.trace_request_ctx["reused"] = True
+
+    def get_circuit_breaker(self, url):
+        """
+        Gets the circuit breaker for the host of a URL.
+        """
+
+        host = urlsplit(url).netloc
+        if host not in self.circuit_breakers:
+            self.circuit_breakers[host] = CircuitBreaker(self.breaker_threshold, self.breaker_reset_timeout)
+
+        return self.circuit_breakers[host]
+
+    def get_host_limit(self, url):
+        """
+        Gets the adaptive concurrency limit for the host of a URL.
+
+        Hosts start from their stored limit, or from the per-host connection setting if
+        the engine has not learned one yet.
+        """
+
+        host = urlsplit(url).netloc
+        if host not in self.host_limits:
+            concurrency_limit, latency = self.learned_host_limits.get(host, (self.max_connections_per_host, None))
+            self.host_limits[host] = AdaptiveConcurrencyLimit(concurrency_limit, self.max_host_concurrency, latency)
+
+        return self.host_limits[host]
+
+    def save_host_limits(self):
+        """
+        Stores the concurrency limits learned so far, so later runs start from them.
+        """
+
+        host_limits = {
+            host: (host_limit.limit, host_limit.latency) for host, host_limit in dict(self.host_limits).items()
+        }
+        update_host_concurrency_limits(host_limits)
+        self.learned_host_limits.update(host_limits)
+
+    def get_backoff(self, attempt, retry_after=None):
+        """
+        Gets the delay in seconds before retrying after a failed attempt.
+
+        The delay is drawn uniformly between zero and an exponentially growing cap. A
+        Retry-After value from the server is used as a lower bound.
+        """
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, DEFAULT_RETRY_AFTER_MAX))
+
+        return delay
+
+    async def fetch(self, download_request, hold=False):
+        """
+        Downloads one request, retrying transient failures.
+
+        Returns a tuple of the response body, the timeseries ID, and a dictionary of
+        timings in seconds: time spent waiting for memory, for the session's turn, and
+        for a connection, time spent connecting, time to the response headers, and total
+        time. The timings also record the number of attempts and the session of the
+        request. Failed requests return an empty body and record the cause of the last
+        failure in the timings.
+
+        The body is bytes, or a SpooledResponse if it was larger than the spool
+        threshold. If hold is set, a body kept in memory counts against the engine's
+        and the session's in-flight limits until the result is released.
+        """
+
+        circuit_breaker = self.get_circuit_breaker(download_request["url"])
+        host_limit = self.get_host_limit(download_request["url"])
+        session_key = download_request.get("session_id") or ""
+        start = time.perf_counter()
+        await self.byte_budget.wait()
+        budget_wait = time.perf_counter() - start
+
+        response_data, timing, attempt = await self._fetch_with_retries(
+            download_request, circuit_breaker, host_limit, session_key
+        )
+
+        timing["attempts"] = attempt
+        timing["queued"] += budget_wait
+        timing["elapsed"] = time.perf_counter() - start
+
+        if not hold:
+            self._release_bytes(session_key, timing.pop("buffered"))
+
+        return (response_data, download_request["timeseries_id"], timing,)
+
+    async def _fetch_with_retries(self, download_request, circuit_breaker, host_limit, session_key):
+        """
+        Sends the attempts of a request until one succeeds or retrying is pointless.
+
+        Each attempt first waits for a slot of the host's concurrency limit and then for
+        the session's turn in the fair scheduler, and gives both back before backing off.
+        A session whose requests wait on a throttled host therefore holds no scheduler
+        slots that sessions downloading from other hosts could use. The circuit breaker is
+        checked again once both slots are held, so attempts that were waiting when the
+        circuit opened fail without being sent. Returns the response body, the timings
+        of the last attempt, and the number of attempts.
+        """
+
+        attempt = 0
+
+        while True:
+            attempt += 1
+            try:
+                circuit_breaker.check()
+                limit_start = time.perf_counter()
+                await host_limit.acquire()
+                try:
+                    await self.scheduler.acquire(session_key)
+                    limit_wait = time.perf_counter() - limit_start
+                    try:
+                        # The circuit may have opened while the request waited for its slots.
+                        trial = circuit_breaker.before_request()
+                        response_data, timing, retryable, retry_after = await self._fetch_once(download_request)
+                    finally:
+                        self.scheduler.release(session_key)
+                finally:
+                    host_limit.release()
+            except CircuitOpenError as err:
+                last_error = timing["error"] if attempt > 1 else None
+                response_data, timing = b"", self._new_timing(download_request)
+                timing["error"] = f"{type(err).__name__}: {err}" + (f" (last error: {last_error})" if last_error else "")
+                break
+
+            if retryable:
+                host_limit.record_failure()
+            elif timing["status"] is not None:
+                host_limit.record_success(timing["headers"] - timing["queued"])
+
+            timing["queued"] += limit_wait
+
+            if not retryable:
+                if timing["status"] is not None:
+                    # The server answered, so the host is up even if this request failed.
+                    circuit_breaker.record_success()
+                elif trial:
+                    circuit_breaker.release_trial()
+                break
+
+            circuit_breaker.record_failure(trial)
+
+            if attempt > self.max_retries:
+                break
+
+            await asyncio.sleep(self.get_backoff(attempt - 1, retry_after))
+
+        return response_data, timing, attempt
+
+    def _release_bytes(self, session_key, byte_count):
+        self.byte_budget.release(byte_count)
+        if session_key in self.scheduler.sessions:
+            self.scheduler.sessions[session_key].release(byte_count)
+
+    @staticmethod
+    def _new_timing(download_request):
+        return {
+            "url": download_request["url"],
+            "status": None,
+            "bytes": 0,
+            "queued": 0.0,
+            "connect": 0.0,
+            "headers": None,
+            "elapsed": None,
+            "reused": False,
+            "attempts": 0,
+            "buffered": 0,
+            "session_id": download_request.get("session_id"),
+            "error": None
+        }
+
+    async def _fetch_once(self, download_request):
+        """
+        Sends one attempt of a request.
+
+        Returns the response body, the timings, whether the attempt failed in a way that
+        is worth retrying, and the number of seconds the server asked to wait with
+        Retry-After, if any.
+        """
+
+        timing = self._new_timing(download_request)
+        retryable = False
+        retry_after = None
+        start = time.perf_counter()
+
+        try:
+            async with self._get_client_session().request(
+                    download_request.get("method", "GET"),
+                    download_request["url"],
+                    headers=download_request.get("headers"),
+                    data=download_request.get("data"),
+                    trace_request_ctx=timing
+                ) as response:
+                timing["headers"] = time.perf_counter() - start
+                timing["status"] = response.status
+                if response.status in RETRYABLE_STATUSES:
+                    raise RetryableStatusError(
+                        response.status, response.reason, parse_retry_after(response.headers.get("Retry-After"))
+                    )
+                if response.status >= 400:
+                    await response.read()
+                    response_data = b""
+                    timing["error"] = f"HTTP {response.status} {response.reason or ''}".strip()
+                else:
+                    response_data, timing["buffered"] = await self._read_body(response, download_request)
+        except RetryableStatusError as err:
+            response_data = b""
+            timing["error"] = str(err)
+            retryable = True
+            retry_after = err.retry_after
+        except RETRYABLE_ERRORS as err:
+            response_data = b""
+            timing["error"] = f"{type(err).__name__}: {err}" if str(err) else type(err).__name__
+            retryable = True
+        except Exception as err:
+            response_data = b""
+            timing["error"] = f"{type(err).__name__}: {err}"
+
+        timing["bytes"] = len(response_data)
+        timing.pop("_queued_start", None)
+        timing.pop("_connect_start", None)
+
+        return response_data, timing, retryable, retry_after
+
+    async def _read_body(self, response, download_request):
+        """
+        Reads a response body in chunks, spooling it to disk once it passes the threshold.
+
+        Returns the body and the number of its bytes held in memory. A body that fails
+        partway is dropped before the error is raised.
+        """
+
+        byte_budgets = (self.byte_budget, self.scheduler.get_session_queue(download_request.get("session_id") or ""))
+        response_buffer = ResponseBuffer(byte_budgets, self.spool_threshold, self.spool_dir)
+
+        try:
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                response_buffer.write(chunk)
+        except BaseException:
+            response_buffer.discard()
+            raise
+
+        return response_buffer.finish()
+
+    async def fetch_all(self, download_requests):
+        """
+        Downloads a list of requests concurrently within the engine's connection limits.
+        """
+
+        return await asyncio.gather(*[self.fetch(download_request) for download_request in download_requests])
+
+    def submit(self, download_requests):
+        """
+        Schedules a list of requests on the background loop.
+
+        Returns a concurrent.futures.Future whose result is the list of download results.
+        Calls from any number of request threads run concurrently on the same loop and
+        share the same connection pool and limits.
+        """
+
+        return self.background_loop.submit(self.fetch_all(download_requests))
+
+    def submit_each(self, download_requests):
+        """
+        Schedules each request on the background loop separately.
+
+        Returns one concurrent.futures.Future per request, so callers can start working
+        on a response as soon as it arrives instead of waiting for the whole list. Each
+        result holds its share of the in-flight limit until it is released. Cancelling a
+        future cancels its download and releases its result if it has one.
+        """
+
+        return [
+            self.background_loop.submit_held(self.fetch(download_request, hold=True), self.release)
+            for download_request in download_requests
+        ]
+
+    def download(self, download_requests):
+        """
+        Downloads a list of requests and returns their results in order.
+        """
+
+        return self.submit(download_requests).result()
+
+    def release(self, result, keep_body=False):
+        """
+        Releases a download result once its body is no longer needed.
+
+        Returns the bytes the body held in memory to the engine's and the session's
+        in-flight limits and deletes the temporary file of a spooled body, unless
+        keep_body is set. Can be called from any thread, and more than once for the
+        same result.
+        """
+
+        buffered = result[2].pop("buffered", 0)
+        if buffered and not self.background_loop.loop.is_closed():
+            self.background_loop.loop.call_soon_threadsafe(
+                self._release_bytes, result[2]["session_id"] or "", buffered
+            )
+
+        if isinstance(result[0], SpooledResponse) and not keep_body:
+            result[0].discard()
+
+    def get_queue_stats(self):
+        """
+        Gets the number of queued and running downloads and the bytes held in memory
+        for each session with downloads in the engine.
+        """
+
+        async def get_stats():
+            return self.scheduler.get_stats()
+
+        return self.background_loop.run(get_stats())
+
+    def close(self):
+        """
+        Closes pooled connections and stops the background loop and the queue stats
+        recorder.
+        """
+
+        if self.background_loop.loop.is_closed():
+            return
+
+        self.queue_stats_recorder.stop()
+        if self.client_session is not None and not self.client_session.closed:
+            self.background_loop.run(self.client_session.close())
+        self.background_loop.stop()
+
+
+def get_download_engine():
+    """
+    Gets the download engine shared by the process.
+
+    The engine is created the first time it is needed and closed when the process exits.
+    A process forked from one that already had an engine creates its own, since the
+    background thread does not survive the fork.
+    """
+
+    global _download_engine
+
+    if _download_engine is None or _download_engine.pid != os.getpid():
+        with _download_engine_lock:
+            if _download_engine is None or _download_engine.pid != os.getpid():
+                _download_engine = DownloadEngine()
+                atexit.register(_download_engine.close)
+
+    return _download_engine
+
+
+def summarize_timings(results):
+    """
+    Summarizes the timings of a list of download results.
+
+    Returns the number of requests, failed requests, bytes downloaded, and the mean
+    and maximum total time per request in seconds.
+    """
+
+    timings = [result[2] for result in results]
+    elapsed = [timing["elapsed"] for timing in timings]
+
+    return {
+        "requests": len(timings),
+        "failed": len([timing for timing in timings if timing["error"] is not None]),
+        "bytes": sum(timing["bytes"] for timing in timings),
+        "mean_elapsed": sum(elapsed) / len(elapsed) if elapsed else 0.0,
+        "max_elapsed": max(elapsed) if elapsed else 0.0
+    }
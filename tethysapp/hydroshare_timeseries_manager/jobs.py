@@ -0,0 +1,731 @@
+import os
+import math
+import time
+import uuid
+import atexit
+import datetime
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor, as_completed, wait, \
+                               FIRST_COMPLETED
+from .model import _get_setting, get_timeseries_request_data, update_timeseries_references, \
+                   get_wml_cache_key, load_cached_wml, add_cached_wml, \
+                   get_wml_series_key, get_wml_series_states, update_wml_series_states, \
+                   add_prepare_job, update_prepare_job, get_prepare_job, count_pending_timeseries, \
+                   claim_pending_timeseries, renew_pending_lease, complete_pending_timeseries, \
+                   release_pending_timeseries, fail_abandoned_pending_timeseries, renew_prepare_job_leases, \
+                   claim_orphaned_prepare_jobs, get_recorded_download_queue_stats, DEFAULT_LEASE_SECONDS
+from .utilities import build_soap_request, build_rest_request, prepare_wml, prepare_wml_windows, split_time_window, \
+                       load_wml_schemas, get_app_workspace
+from .downloader import get_download_engine, summarize_timings, QUEUE_STATS_MAX_AGE
+
+
+DEFAULT_JOB_BACKEND = "thread"
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_JOB_CHUNK_SIZE = 50
+DEFAULT_VALIDATION_WORKERS = os.cpu_count() or 1
+VALIDATION_QUEUE_FACTOR = 2
+WRITE_BATCH_SIZE = 25
+DEFAULT_SPLIT_VALUE_COUNT = 100000
+RECOVERY_INTERVAL_SECONDS = 30
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+_validation_pool = None
+_validation_pool_pid = None
+_validation_pool_lock = threading.Lock()
+_job_worker_count = None
+_last_recovery = 0.0
+_recovery_lock = threading.Lock()
+
+
+# ------------- #
+#   JOB QUEUE   #
+# ------------- #
+
+class JobQueue:
+    """
+    Local queue that runs jobs outside of the request cycle.
+
+    The thread backend runs jobs in a pool of threads in the web process. The process
+    backend runs them in a pool of worker processes, which keeps CPU-heavy parsing and
+    validation off the web process. Neither backend needs an external broker; job
+    state lives in the app database, so any web process can report progress.
+
+    While a job has workers queued or running in the pool, the queue renews the job's
+    lease from a background thread. If the process dies, the lease lapses and another
+    process recovers the job; see recover_prepare_jobs.
+    """
+
+    def __init__(self, backend=None, max_workers=None, lease_seconds=None):
+
+        self.backend = backend or _get_setting("job_backend", DEFAULT_JOB_BACKEND)
+        self.max_workers = int(max_workers or _get_setting("job_workers", DEFAULT_JOB_WORKERS))
+        self.lease_seconds = int(lease_seconds or _get_setting("job_lease_seconds", DEFAULT_LEASE_SECONDS))
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.active_jobs = collections.Counter()
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self._renew_leases, daemon=True)
+
+        if self.backend not in ("process", "thread"):
+            raise ValueError(f"Unknown job backend: {self.backend}")
+
+        self.executor = self._create_executor()
+        self.heartbeat.start()
+
+    def _create_executor(self):
+        if self.backend == "process":
+            return ProcessPoolExecutor(
+                max_workers=self.max_workers, initializer=_init_job_worker, initargs=(self.max_workers,)
+            )
+        else:
+            return ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="hydroshare-timeseries-manager-job"
+            )
+
+    def _renew_leases(self):
+        while not self.stopped.wait(max(1.0, self.lease_seconds / 3)):
+            with self.lock:
+                job_ids = list(self.active_jobs)
+            if job_ids:
+                try:
+                    renew_prepare_job_leases(job_ids, self.lease_seconds)
+                except Exception:
+                    pass
+
+    def _finish_job_worker(self, job_id):
+        with self.lock:
+            self.active_jobs[job_id] -= 1
+            if self.active_jobs[job_id] <= 0:
+                del self.active_jobs[job_id]
+
+    def submit(self, function, *args):
+        """
+        Queues a job and returns a concurrent.futures.Future for it.
+
+        A process pool breaks for good when one of its workers dies; it is replaced
+        with a new pool so later jobs can still run.
+        """
+
+        with self.lock:
+            try:
+                return self.executor.submit(function, *args)
+            except BrokenExecutor:
+                self.executor = self._create_executor()
+                return self.executor.submit(function, *args)
+
+    def submit_job_worker(self, job_id, function, *args):
+        """
+        Queues a worker of a job and keeps the job's lease alive until it finishes.
+        """
+
+        job_future = self.submit(function, *args)
+
+        with self.lock:
+            self.active_jobs[job_id] += 1
+
+        job_future.add_done_callback(lambda _: self._finish_job_worker(job_id))
+
+        return job_future
+
+    def shutdown(self, wait=False):
+        """
+        Stops accepting jobs.
+        """
+
+        self.stopped.set()
+        self.executor.shutdown(wait=wait)
+
+
+def get_job_queue():
+    """
+    Gets the job queue shared by the process.
+    """
+
+    global _job_queue
+
+    if _job_queue is None or _job_queue.pid != os.getpid():
+        with _job_queue_lock:
+            if _job_queue is None or _job_queue.pid != os.getpid():
+                _job_queue = JobQueue()
+                atexit.register(_job_queue.shutdown)
+
+    return _job_queue
+
+
+def _init_job_worker(job_worker_count):
+    """
+    Marks a process as a worker of a process backend job queue with job_worker_count
+    workers.
+    """
+
+    global _job_worker_count
+
+    _job_worker_count = job_worker_count
+
+
+def get_validation_workers():
+    """
+    Gets the number of validation workers for a pool in this process.
+
+    Jobs of the process backend each run in their own worker process with their own
+    validation pool, so the validation workers setting is divided between the job
+    workers instead of each of them starting one validation worker per core.
+    """
+
+    validation_workers = int(_get_setting("validation_workers", DEFAULT_VALIDATION_WORKERS))
+
+    if _job_worker_count:
+        return max(1, validation_workers // _job_worker_count)
+
+    return validation_workers
+
+
+def get_validation_pool():
+    """
+    Gets the pool that extracts and validates downloaded WaterML.
+
+    Parsing and schema validation are CPU-bound, so they run in worker processes, one
+    per core by default; see get_validation_workers. Each worker compiles the WaterML
+    schemas when it starts.
+    """
+
+    global _validation_pool, _validation_pool_pid
+
+    if _validation_pool is None or _validation_pool_pid != os.getpid():
+        with _validation_pool_lock:
+            if _validation_pool is None or _validation_pool_pid != os.getpid():
+                _validation_pool = ProcessPoolExecutor(
+                    max_workers=get_validation_workers(), initializer=load_wml_schemas,
+                    initargs=(get_app_workspace(),)
+                )
+                _validation_pool_pid = os.getpid()
+                atexit.register(_validation_pool.shutdown, wait=False)
+
+    return _validation_pool
+
+
+class LeaseHeartbeat:
+    """
+    Renews the lease on a batch of claimed timeseries while it is processed.
+
+    The lease is renewed from a background thread every third of the lease period, so
+    a batch that takes longer than one lease is not claimed by another worker, while a
+    worker that dies stops renewing and its batch is requeued when the lease expires.
+    """
+
+    def __init__(self, lease_token, lease_seconds):
+
+        self.lease_token = lease_token
+        self.lease_seconds = lease_seconds
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(max(1.0, self.lease_seconds / 3)):
+            try:
+                renew_pending_lease(self.lease_token, self.lease_seconds)
+            except Exception:
+                pass
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+
+# ---------------- #
+#   PREPARE JOBS   #
+# ---------------- #
+
+def enqueue_prepare_job(session_id, refts_id, refresh=False):
+    """
+    Queues a job that prepares the pending timeseries of a REFTS import.
+
+    Large imports are drained by several workers at once, up to the size of the job
+    pool; each worker claims its own batches. With refresh set, series prepared before
+    only download values newer than their last one. Returns the ID of the new job.
+    """
+
+    job_id = str(uuid.uuid4())
+    total_count = count_pending_timeseries(session_id, refts_id)
+    chunk_size = int(_get_setting("job_chunk_size", DEFAULT_JOB_CHUNK_SIZE))
+
+    add_prepare_job(
+        job_id=job_id, session_id=session_id, refts_id=refts_id, total_count=total_count, refresh=refresh,
+        lease_seconds=get_job_queue().lease_seconds
+    )
+
+    for _ in range(max(1, min(get_job_queue().max_workers, math.ceil(total_count / chunk_size)))):
+        submit_prepare_worker(job_id, session_id, refts_id, refresh)
+
+    return job_id
+
+
+def recover_prepare_jobs():
+    """
+    Queues the workers of prepare jobs left behind by a crashed or stopped process.
+
+    Unfinished jobs whose lease has expired are claimed by this process and get as
+    many workers as a new job with the same number of pending timeseries. A recovered
+    job with nothing left to claim is completed by its first worker. Returns the IDs
+    of the recovered jobs.
+    """
+
+    job_queue = get_job_queue()
+    chunk_size = int(_get_setting("job_chunk_size", DEFAULT_JOB_CHUNK_SIZE))
+
+    recovered_job_ids = []
+    for job_id, session_id, refts_id, refresh in claim_orphaned_prepare_jobs(job_queue.lease_seconds):
+        pending_count = count_pending_timeseries(session_id, refts_id)
+        for _ in range(max(1, min(job_queue.max_workers, math.ceil(pending_count / chunk_size)))):
+            submit_prepare_worker(job_id, session_id, refts_id, refresh)
+        recovered_job_ids.append(job_id)
+
+    return recovered_job_ids
+
+
+def _recover_prepare_jobs_periodically():
+    """
+    Runs recover_prepare_jobs at most once per recovery interval in this process.
+    """
+
+    global _last_recovery
+
+    with _recovery_lock:
+        if time.monotonic() - _last_recovery < RECOVERY_INTERVAL_SECONDS:
+            return
+        _last_recovery = time.monotonic()
+
+    try:
+        recover_prepare_jobs()
+    except Exception:
+        pass
+
+
+def submit_prepare_worker(job_id, session_id, refts_id, refresh=False):
+    """
+    Queues a worker of a prepare job.
+
+    The worker prepares one batch at a time. After each batch it is queued again at
+    the back of the job queue, so jobs from different sessions take turns in the pool
+    instead of the first large import holding every worker until it is done.
+    """
+
+    def submit_next_batch(job_future):
+        if not job_future.cancelled() and job_future.exception() is None and job_future.result():
+            submit_prepare_worker(job_id, session_id, refts_id, refresh)
+
+    try:
+        job_future = get_job_queue().submit_job_worker(job_id, run_prepare_job, job_id, session_id, refts_id, refresh)
+    except RuntimeError:
+        # The job queue has been shut down because the process is exiting.
+        return
+
+    job_future.add_done_callback(submit_next_batch)
+
+
+def run_prepare_job(job_id, session_id, refts_id, refresh=False, chunk_size=None, lease_seconds=None):
+    """
+    Runs one batch of a prepare job.
+
+    The worker claims a batch of pending timeseries under a lease, keeps the lease
+    alive while it prepares the batch, and removes the batch from the queue once it is
+    done. A batch that raises is prepared again one timeseries at a time, and only the
+    timeseries that still raise are marked Failed. Returns True if
+    the worker should be queued again for another batch. When nothing is left to
+    claim, the job is marked Complete once the queue is empty; batches still leased by
+    other workers are finished by those workers.
+    """
+
+    chunk_size = int(chunk_size or _get_setting("job_chunk_size", DEFAULT_JOB_CHUNK_SIZE))
+    lease_seconds = int(lease_seconds or _get_setting("job_lease_seconds", DEFAULT_LEASE_SECONDS))
+
+    try:
+        update_prepare_job(job_id=job_id, status="Running")
+
+        lease_token, timeseries_ids = claim_pending_timeseries(
+            session_id=session_id, refts_id=refts_id, limit=chunk_size, lease_seconds=lease_seconds
+        )
+
+        if not timeseries_ids:
+            failed_count = fail_abandoned_pending_timeseries(session_id=session_id, refts_id=refts_id)
+            if failed_count:
+                update_prepare_job(job_id=job_id, failed_count=failed_count)
+            if count_pending_timeseries(session_id=session_id, refts_id=refts_id) == 0:
+                update_prepare_job(job_id=job_id, status="Complete")
+            return False
+
+        try:
+            with LeaseHeartbeat(lease_token, lease_seconds):
+                try:
+                    result = prepare_timeseries(session_id, timeseries_ids, refresh)
+                except Exception as err:
+                    update_prepare_job(job_id=job_id, status_details=f"{type(err).__name__}: {err}")
+                    result = _prepare_each_timeseries(session_id, timeseries_ids, refresh)
+        except Exception as err:
+            release_pending_timeseries(lease_token)
+            update_prepare_job(job_id=job_id, status_details=f"{type(err).__name__}: {err}")
+            return True
+
+        complete_pending_timeseries(lease_token)
+        update_prepare_job(
+            job_id=job_id,
+            ready_count=result["ready"],
+            failed_count=result["failed"],
+            bytes_downloaded=result["downloads"]["bytes"]
+        )
+    except Exception as err:
+        update_prepare_job(job_id=job_id, status="Failed", status_details=f"{type(err).__name__}: {err}")
+        return False
+
+    return True
+
+
+def _prepare_each_timeseries(session_id, timeseries_id_list, refresh=False):
+    """
+    Prepares a batch one timeseries at a time after the whole batch raised.
+
+    A timeseries that still raises on its own is marked Failed with its error.
+    """
+
+    counts = {"ready": 0, "failed": 0, "bytes": 0}
+    for timeseries_id in timeseries_id_list:
+        try:
+            result = prepare_timeseries(session_id, [timeseries_id], refresh)
+        except Exception as err:
+            update_timeseries_references(session_id, [(timeseries_id, {
+                "status": "Failed",
+                "status_details": f"{type(err).__name__}: {err}"
+            })])
+            counts["failed"] += 1
+            continue
+        counts["ready"] += result["ready"]
+        counts["failed"] += result["failed"]
+        counts["bytes"] += result["downloads"]["bytes"]
+
+    return {
+        "ready": counts["ready"],
+        "failed": counts["failed"],
+        "downloads": {"bytes": counts["bytes"]}
+    }
+
+
+def prepare_timeseries(session_id, timeseries_id_list, refresh=False):
+    """
+    Downloads, extracts, and validates WaterML for a list of timeseries references.
+
+    Cached responses are reused, and with refresh set, series prepared before only
+    download values newer than their last one. Returns the number of Ready and Failed
+    timeseries and a summary of the download timings.
+    """
+
+    # ----------------------------- #
+    #   PREPARES WATERML REQUESTS   #
+    # ----------------------------- #
+
+    request_data_list = []
+    for timeseries_id in timeseries_id_list:
+        request_data = get_timeseries_request_data(session_id=session_id, timeseries_id=timeseries_id)
+        if request_data is not None:
+            request_data_list.append(request_data)
+
+    # ---------------------------------- #
+    #   LOADS CACHED WATERML RESPONSES   #
+    # ---------------------------------- #
+
+    request_keys = {
+        x[0]: get_wml_cache_key(x[17], x[8], x[12], x[3], x[4], x[15], x[16]) for x in request_data_list
+    }
+    series_info = {
+        x[0]: (get_wml_series_key(x[17], x[8], x[12], x[15], x[16]), x[3]) for x in request_data_list
+    }
+
+    series_states = {}
+    if refresh:
+        stored_states = get_wml_series_states([x[0] for x in series_info.values()])
+        series_states = {
+            timeseries_id: stored_states[series_key] for timeseries_id, (series_key, begin_date) in series_info.items()
+            if series_key in stored_states and stored_states[series_key].begin_date == begin_date and
+            stored_states[series_key].last_value_date is not None
+        }
+
+    # Refreshed payloads extend past the requested end date, so they are neither read
+    # from nor added to the request cache. Series without a state are downloaded again
+    # on refresh rather than served a cached response that may be out of date.
+    request_keys = {x: request_key for x, request_key in request_keys.items() if x not in series_states}
+
+    if refresh:
+        cached_timeseries_ids = set()
+    else:
+        cached_timeseries_ids = set(load_cached_wml(session_id=session_id, request_keys=request_keys))
+
+    request_data_list = [x for x in request_data_list if x[0] not in cached_timeseries_ids]
+    wml_versions = {x[0]: x[15] if x[16] == "SOAP" else "WaterML 1.1" for x in request_data_list}
+    service_types = {x[0]: x[16] for x in request_data_list}
+
+    update_timeseries_references(
+        session_id=session_id,
+        changes=[(x[0], {"status": "Downloading"}) for x in request_data_list]
+    )
+
+    split_value_count = int(_get_setting("split_value_count", DEFAULT_SPLIT_VALUE_COUNT))
+
+    download_requests = []
+    window_indexes = []
+    window_counts = {}
+    for x in request_data_list:
+        if x[0] in series_states:
+            time_windows = [(
+                series_states[x[0]].last_value_date + datetime.timedelta(seconds=1),
+                datetime.datetime.now().replace(microsecond=0)
+            )]
+        else:
+            time_windows = split_time_window(x[3], x[4], x[5], split_value_count)
+        window_counts[x[0]] = len(time_windows)
+        for window_index, (start_date, end_date) in enumerate(time_windows):
+            if x[16] == "SOAP":
+                download_requests.append(build_soap_request({
+                    "timeseries_id": x[0],
+                    "session_id": session_id,
+                    "url": x[17],
+                    "version": "1.1" if x[15] == "WaterML 1.1" else "1.0",
+                    "location": x[8],
+                    "variable": x[12],
+                    "start_date": start_date,
+                    "end_date": end_date,
+                    "auth_token": ""
+                }))
+            elif x[16] == "REST":
+                download_requests.append(build_rest_request({
+                    "timeseries_id": x[0],
+                    "session_id": session_id,
+                    "url": f"{x[17]}values/?site_code={x[8]}&variable_code={x[12]}&start_date={start_date}&end_date={end_date}"
+                }))
+            else:
+                continue
+            window_indexes.append(window_index)
+
+    # ---------------------------------------------- #
+    #   DOWNLOADS, EXTRACTS, AND VALIDATES WATERML   #
+    # ---------------------------------------------- #
+
+    download_engine = get_download_engine()
+    download_futures = download_engine.submit_each(download_requests)
+    window_indexes = dict(zip(download_futures, window_indexes))
+
+    validation_pool = get_validation_pool()
+    validation_queue_size = get_validation_workers() * VALIDATION_QUEUE_FACTOR
+    workspace = get_app_workspace()
+
+    download_results = []
+    window_results = {}
+    validation_futures = {}
+    prepared_results = []
+    counts = {"ready": len(cached_timeseries_ids), "failed": 0}
+    pending_downloads = set(download_futures)
+
+    try:
+        for download_future in as_completed(download_futures):
+            pending_downloads.discard(download_future)
+            result = download_future.result()
+            download_results.append(result)
+            timeseries_id = result[1]
+
+            window_results.setdefault(timeseries_id, {})[window_indexes[download_future]] = result
+            if len(window_results[timeseries_id]) < window_counts[timeseries_id]:
+                # Windows waiting for the rest of their timeseries do not count against the
+                # in-flight limit, so they cannot hold back the downloads they wait for.
+                download_engine.release(result, keep_body=True)
+                continue
+
+            results = [x[1] for x in sorted(window_results[timeseries_id].items())]
+            errors = [x[2]["error"] for x in results if x[2]["error"] is not None]
+
+            if errors:
+                for x in results:
+                    download_engine.release(x)
+                del window_results[timeseries_id]
+                prepared_results.append((timeseries_id, None, False, f"Download failed: {errors[0]}", None))
+            else:
+                if len(validation_futures) >= validation_queue_size:
+                    done, _ = wait(validation_futures, return_when=FIRST_COMPLETED)
+                    prepared_results.extend(_collect_prepared_results(validation_futures, done))
+
+                if timeseries_id in series_states:
+                    validation_future = validation_pool.submit(
+                        prepare_wml_windows, [x[0] for x in results], service_types[timeseries_id],
+                        wml_versions[timeseries_id], workspace,
+                        (series_states[timeseries_id].codec, series_states[timeseries_id].wml_data)
+                    )
+                elif len(results) == 1:
+                    validation_future = validation_pool.submit(
+                        prepare_wml, results[0][0], service_types[timeseries_id], wml_versions[timeseries_id],
+                        workspace
+                    )
+                else:
+                    validation_future = validation_pool.submit(
+                        prepare_wml_windows, [x[0] for x in results], service_types[timeseries_id],
+                        wml_versions[timeseries_id], workspace
+                    )
+                del window_results[timeseries_id]
+                validation_future.add_done_callback(
+                    lambda _, results=results: [download_engine.release(x) for x in results]
+                )
+                validation_futures[validation_future] = timeseries_id
+
+            if len(prepared_results) >= WRITE_BATCH_SIZE:
+                _write_prepared_results(session_id, prepared_results, request_keys, series_info, counts, refresh)
+                prepared_results = []
+
+        for validation_future in as_completed(list(validation_futures)):
+            prepared_results.extend(_collect_prepared_results(validation_futures, [validation_future]))
+
+            if len(prepared_results) >= WRITE_BATCH_SIZE:
+                _write_prepared_results(session_id, prepared_results, request_keys, series_info, counts, refresh)
+                prepared_results = []
+
+        _write_prepared_results(session_id, prepared_results, request_keys, series_info, counts, refresh)
+    finally:
+        # Nothing is left over unless the batch failed part way. Downloads that already
+        # finished are released here; cancelled downloads and validations release their
+        # responses themselves.
+        for download_future in pending_downloads:
+            if not download_future.cancel() and download_future.exception() is None:
+                download_engine.release(download_future.result())
+        for window_result in window_results.values():
+            for result in window_result.values():
+                download_engine.release(result)
+        for validation_future in validation_futures:
+            validation_future.cancel()
+
+    download_engine.save_host_limits()
+
+    return {
+        "ready": counts["ready"],
+        "failed": counts["failed"],
+        "downloads": summarize_timings(download_results)
+    }
+
+
+def _collect_prepared_results(validation_futures, done):
+    """
+    Removes finished validation futures and returns their prepared results.
+    """
+
+    prepared_results = []
+    for validation_future in done:
+        timeseries_id = validation_futures.pop(validation_future)
+        try:
+            wml_data, valid, status_details, wml_summary = validation_future.result()
+        except Exception as err:
+            wml_data, valid, status_details, wml_summary = \
+                None, False, f"Validation failed: {type(err).__name__}: {err}", None
+        prepared_results.append((timeseries_id, wml_data, valid, status_details, wml_summary))
+
+    return prepared_results
+
+
+def _write_prepared_results(session_id, prepared_results, request_keys, series_info, counts, refresh=False):
+    """
+    Stores a batch of prepared timeseries.
+
+    Each payload is written together with its final status in one transaction, and
+    valid payloads are added to the WaterML cache and recorded as the state of their
+    series. In refresh mode, the catalog end date and value count of valid timeseries
+    are updated from their payloads; refreshed payloads have no request key and are
+    only stored with their series state.
+    """
+
+    if not prepared_results:
+        return
+
+    changes = []
+    for timeseries_id, wml_data, valid, status_details, wml_summary in prepared_results:
+        fields = {
+            "wml_data": wml_data,
+            "status": "Ready" if valid else "Failed",
+            "status_details": status_details
+        }
+        if refresh and valid and wml_summary and wml_summary["last_value_date"] is not None:
+            fields["end_date"] = wml_summary["last_value_date"]
+            fields["value_count"] = wml_summary["value_count"]
+        changes.append((timeseries_id, fields))
+
+    update_timeseries_references(session_id=session_id, changes=changes)
+
+    add_cached_wml({
+        request_keys[timeseries_id]: wml_data for timeseries_id, wml_data, valid, _, _ in prepared_results
+        if valid and timeseries_id in request_keys
+    })
+
+    update_wml_series_states({
+        series_info[timeseries_id][0]: {
+            "begin_date": series_info[timeseries_id][1],
+            "last_value_date": wml_summary["last_value_date"],
+            "value_count": wml_summary["value_count"],
+            "wml_data": wml_data
+        } for timeseries_id, wml_data, valid, _, wml_summary in prepared_results
+        if valid and wml_summary and wml_summary["last_value_date"] is not None
+    })
+
+    ready_count = len([x for x in prepared_results if x[2]])
+    counts["ready"] += ready_count
+    counts["failed"] += len(prepared_results) - ready_count
+
+
+def get_job_progress(session_id, job_id):
+    """
+    Gets the progress of a prepare job.
+
+    Returns the job status and counts, the throughput in timeseries and bytes per
+    second since the job started, the estimated seconds remaining, and the session's
+    downloads queued and running in every process, as last recorded by their download
+    engines, or None if the job does not exist.
+    Polling progress also recovers jobs orphaned by a crashed process.
+    """
+
+    _recover_prepare_jobs_periodically()
+
+    prepare_job = get_prepare_job(session_id=session_id, job_id=job_id)
+
+    if prepare_job is None:
+        return None
+
+    completed_count = prepare_job.ready_count + prepare_job.failed_count
+
+    if prepare_job.date_started is not None:
+        elapsed = ((prepare_job.date_finished or datetime.datetime.now()) - prepare_job.date_started).total_seconds()
+    else:
+        elapsed = 0.0
+
+    throughput = completed_count / elapsed if elapsed > 0 else 0.0
+    byte_throughput = prepare_job.bytes_downloaded / elapsed if elapsed > 0 else 0.0
+
+    if prepare_job.status == "Running" and throughput > 0:
+        eta = max(0, prepare_job.total_count - completed_count) / throughput
+    elif prepare_job.status in ("Complete", "Failed"):
+        eta = 0.0
+    else:
+        eta = None
+
+    return {
+        "job_id": prepare_job.job_id,
+        "refts_id": prepare_job.refts_id,
+        "status": prepare_job.status,
+        "status_details": prepare_job.status_details,
+        "total": prepare_job.total_count,
+        "completed": completed_count,
+        "ready": prepare_job.ready_count,
+        "failed": prepare_job.failed_count,
+        "percent": round(100.0 * completed_count / prepare_job.total_count, 1) if prepare_job.total_count else 100.0,
+        "elapsed": elapsed,
+        "throughput": throughput,
+        "bytes_per_second": byte_throughput,
+        "eta": eta,
+        "download_queue": get_recorded_download_queue_stats(session_id, QUEUE_STATS_MAX_AGE)
+    }
@@ -1,12 +1,60 @@
+import io
+import os
+import csv
+import math
+import uuid
+import pickle
+import hashlib
+import time
 import datetime
+import threading
+import contextlib
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Text, Boolean, DateTime, Integer, PickleType, UniqueConstraint, and_, or_, desc, asc
+from sqlalchemy import Column, Text, Boolean, DateTime, Integer, Float, LargeBinary, UniqueConstraint, Index, and_, \
+                       or_, desc, asc, create_engine, bindparam, inspect, text, true, case, func, select, \
+                       literal_column, literal, null, distinct, union_all, not_, nullsfirst, nullslast
+from sqlalchemy.types import Numeric
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from .app import HydroshareTimeseriesManager as app
+from .payload_codec import encode_payload, decode_payload, open_payload_stream
 
 
 # DB Engine, sessionmaker, and base
 Base = declarative_base()
 
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_RECYCLE = 1800
+DEFAULT_POOL_PRE_PING = True
+
+BULK_INSERT_BATCH_SIZE = 1000
+BULK_COPY_THRESHOLD = 5000
+BULK_INSERT_COLUMNS = (
+    "session_id", "timeseries_id", "status", "status_details", "selected", "date_created",
+    "begin_date", "end_date", "value_count", "sample_medium", "site_name", "site_code",
+    "latitude", "longitude", "variable_name", "variable_code", "method_description",
+    "method_link", "network_name", "ref_type", "return_type", "service_type", "url"
+)
+
+DEFAULT_WML_CACHE_TTL = 7 * 24 * 60 * 60
+DEFAULT_LEASE_SECONDS = 300
+MAX_CLAIM_ATTEMPTS = 3
+PRIORITY_DEFAULT = 0
+PRIORITY_SELECTED = 1
+PRIORITY_VISIBLE = 2
+DEFAULT_WML_CACHE_MAX_SIZE = 1024
+WML_CACHE_EVICTION_INTERVAL = 300
+
+_engine = None
+_engine_pid = None
+_session_factory = None
+_engine_lock = threading.Lock()
+_last_eviction = 0.0
+_eviction_lock = threading.Lock()
+
+
 def init_hydroshare_timeseries_manager_db(engine, first_time):
     """
     Initializes Database
@@ -15,6 +63,342 @@ def init_hydroshare_timeseries_manager_db(engine, first_time):
     # Create tables
     Base.metadata.create_all(engine)
 
+    # Upgrade tables created by earlier versions of the app
+    if not first_time:
+        migrate_timeseries_payloads(engine)
+        migrate_timeseries_catalog(engine)
+        migrate_pending_timeseries(engine)
+        migrate_prepare_jobs(engine)
+
+    # Create the catalog search index
+    create_catalog_search_index(engine)
+
+
+# ----------------------- #
+#   SCHEMA MIGRATIONS     #
+# ----------------------- #
+
+NUMERIC_CATALOG_COLUMNS = {
+    "latitude": float,
+    "longitude": float,
+    "value_count": int
+}
+
+
+def _to_number(value, number_type):
+    """
+    Converts a catalog value to a number, or None if it is missing, not numeric, or not
+    finite.
+    """
+
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+
+    return number_type(number) if math.isfinite(number) else None
+
+
+def migrate_timeseries_catalog(engine):
+    """
+    Upgrades an existing timeseries catalog table.
+
+    Earlier versions of the app stored latitude, longitude, and value count as text and
+    declared no indexes. This function converts those columns to numeric types,
+    discarding values that are not numeric, and creates any missing catalog indexes.
+    It is safe to run repeatedly.
+    """
+
+    inspector = inspect(engine)
+    table = TimeSeriesCatalog.__table__
+
+    if table.name not in inspector.get_table_names():
+        return
+
+    column_types = {column["name"]: column["type"] for column in inspector.get_columns(table.name)}
+    text_columns = [
+        column_name for column_name in NUMERIC_CATALOG_COLUMNS
+        if not isinstance(column_types.get(column_name), (Numeric, Integer))
+    ]
+
+    if text_columns and engine.dialect.name == "postgresql":
+        alter_clauses = []
+        for column_name in text_columns:
+            if NUMERIC_CATALOG_COLUMNS[column_name] is int:
+                alter_clauses.append(
+                    f"ALTER COLUMN {column_name} TYPE integer USING CASE "
+                    f"WHEN {column_name} ~ '^\\s*[0-9]+(\\.0*)?\\s*$' THEN {column_name}::numeric::integer END"
+                )
+            else:
+                alter_clauses.append(
+                    f"ALTER COLUMN {column_name} TYPE double precision USING CASE "
+                    f"WHEN {column_name} ~ '^\\s*[-+]?([0-9]+\\.?[0-9]*|\\.[0-9]+)([eE][-+]?[0-9]+)?\\s*$' "
+                    f"THEN {column_name}::double precision END"
+                )
+        with engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {table.name} " + ", ".join(alter_clauses)))
+
+    elif text_columns:
+        # Databases without ALTER COLUMN support get the table rebuilt with the new types.
+        legacy_name = f"_{table.name}_legacy"
+        with engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {table.name} RENAME TO {legacy_name}"))
+            table.create(connection)
+            legacy_rows = connection.execute(text(f"SELECT * FROM {legacy_name}")).fetchall()
+            if legacy_rows:
+                rows = []
+                for legacy_row in legacy_rows:
+                    row = {key: value for key, value in dict(legacy_row).items() if key in table.c}
+                    for column_name, number_type in NUMERIC_CATALOG_COLUMNS.items():
+                        row[column_name] = _to_number(row[column_name], number_type)
+                    rows.append(row)
+                connection.execute(
+                    text(
+                        f"INSERT INTO {table.name} ({', '.join(rows[0])}) "
+                        f"VALUES ({', '.join(':' + column_name for column_name in rows[0])})"
+                    ),
+                    rows
+                )
+            connection.execute(text(f"DROP TABLE {legacy_name}"))
+
+    existing_indexes = {index["name"] for index in inspect(engine).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in existing_indexes:
+            index.create(engine)
+
+
+def migrate_timeseries_payloads(engine, batch_size=100):
+    """
+    Moves WaterML payloads out of the timeseries catalog table.
+
+    Earlier versions of the app stored pickled WaterML in a wml_data column of the
+    catalog. This function copies those payloads into the timeseries payload table in
+    batches, compressing them, and then drops the column. It also adds the codec
+    columns to payload tables created before payloads were compressed. It is safe to
+    run repeatedly.
+    """
+
+    inspector = inspect(engine)
+    catalog_name = TimeSeriesCatalog.__tablename__
+
+    _add_missing_columns(engine, TimeSeriesPayload.__table__, ("codec", "raw_size", "stored_size"))
+
+    if catalog_name not in inspector.get_table_names():
+        return
+    if "wml_data" not in {column["name"] for column in inspector.get_columns(catalog_name)}:
+        return
+
+    last_id = 0
+    while True:
+        with engine.begin() as connection:
+            legacy_rows = connection.execute(
+                text(
+                    f"SELECT id, session_id, timeseries_id, wml_data FROM {catalog_name} "
+                    f"WHERE id > :last_id AND wml_data IS NOT NULL ORDER BY id LIMIT :batch_size"
+                ),
+                {"last_id": last_id, "batch_size": batch_size}
+            ).fetchall()
+            if not legacy_rows:
+                break
+            last_id = legacy_rows[-1][0]
+            payloads = []
+            for legacy_row in legacy_rows:
+                try:
+                    wml_data = pickle.loads(legacy_row[3])
+                except Exception:
+                    continue
+                if isinstance(wml_data, bytes):
+                    codec, encoded_data = encode_payload(wml_data)
+                    payloads.append({
+                        "session_id": legacy_row[1],
+                        "timeseries_id": legacy_row[2],
+                        "wml_data": encoded_data,
+                        "codec": codec,
+                        "raw_size": len(wml_data),
+                        "stored_size": len(encoded_data)
+                    })
+            if payloads:
+                connection.execute(
+                    TimeSeriesPayload.__table__.delete().where(
+                        TimeSeriesPayload.timeseries_id.in_([x["timeseries_id"] for x in payloads])
+                    )
+                )
+                connection.execute(TimeSeriesPayload.__table__.insert(), payloads)
+
+    with engine.begin() as connection:
+        try:
+            connection.execute(text(f"ALTER TABLE {catalog_name} DROP COLUMN wml_data"))
+        except Exception:
+            # Older SQLite versions cannot drop columns, so the legacy payloads are cleared instead.
+            connection.execute(text(f"UPDATE {catalog_name} SET wml_data = NULL"))
+
+
+def migrate_pending_timeseries(engine):
+    """
+    Upgrades an existing pending timeseries table.
+
+    Adds the lease and priority columns and the indexes used to claim pending
+    timeseries. Rows queued by earlier versions of the app start out unclaimed, with
+    the default priority. It is safe to run repeatedly.
+    """
+
+    table = PendingTimeSeries.__table__
+
+    _add_missing_columns(engine, table, ("lease_token", "lease_expires", "attempts", "priority"))
+
+    if table.name not in inspect(engine).get_table_names():
+        return
+
+    existing_indexes = {index["name"] for index in inspect(engine).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in existing_indexes:
+            index.create(engine)
+
+
+def migrate_prepare_jobs(engine):
+    """
+    Upgrades an existing prepare jobs table.
+
+    Adds the lease and refresh columns used to recover jobs after a crash. Jobs queued
+    by earlier versions of the app have no lease and are recovered by the next sweep if
+    they still have pending timeseries. It is safe to run repeatedly.
+    """
+
+    _add_missing_columns(engine, PrepareJob.__table__, ("lease_expires", "refresh"))
+
+
+def _add_missing_columns(engine, table, column_names):
+    """
+    Adds nullable columns from a table declaration that are missing in the database.
+    """
+
+    inspector = inspect(engine)
+
+    if table.name not in inspector.get_table_names():
+        return
+
+    existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+    with engine.begin() as connection:
+        for column_name in column_names:
+            if column_name not in existing_columns:
+                column_type = table.c[column_name].type.compile(dialect=engine.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_name} {column_type}"))
+
+
+# --------------------------- #
+#   DB ENGINE AND SESSIONS    #
+# --------------------------- #
+
+def _get_setting(name, default):
+    """
+    Gets an optional app custom setting, falling back to a default value.
+    """
+
+    try:
+        value = app.get_custom_setting(name)
+    except Exception:
+        value = None
+
+    return default if value is None else value
+
+
+def configure_engine(database_url, pool_size=None, max_overflow=None, pool_recycle=None, pool_pre_ping=None):
+    """
+    Creates the shared engine and session factory.
+
+    The engine is created once per process and reused by every catalog and pending
+    queue action, so connections are pooled instead of being opened and disposed on
+    each call. Pool options that are not given are read from the app custom settings.
+    Any previously configured engine is disposed.
+    """
+
+    global _engine, _engine_pid, _session_factory, _search_backend
+
+    pool_size = pool_size if pool_size is not None else _get_setting("db_pool_size", DEFAULT_POOL_SIZE)
+    max_overflow = max_overflow if max_overflow is not None else _get_setting("db_max_overflow", DEFAULT_MAX_OVERFLOW)
+    pool_recycle = pool_recycle if pool_recycle is not None else _get_setting("db_pool_recycle", DEFAULT_POOL_RECYCLE)
+    pool_pre_ping = pool_pre_ping if pool_pre_ping is not None else _get_setting("db_pool_pre_ping", DEFAULT_POOL_PRE_PING)
+
+    engine_options = {
+        "pool_pre_ping": bool(pool_pre_ping),
+        "pool_recycle": int(pool_recycle)
+    }
+
+    # SQLite databases use a file-level pool that does not accept size options.
+    if not str(database_url).startswith("sqlite"):
+        engine_options["pool_size"] = int(pool_size)
+        engine_options["max_overflow"] = int(max_overflow)
+
+    engine = create_engine(database_url, **engine_options)
+
+    # Connections inherited from a parent process are left for the parent to close.
+    if _engine_pid == os.getpid():
+        if _session_factory is not None:
+            _session_factory.remove()
+        if _engine is not None:
+            _engine.dispose()
+
+    _session_factory = scoped_session(sessionmaker(bind=engine))
+    _engine = engine
+    _engine_pid = os.getpid()
+    _search_backend = None
+
+    return _engine
+
+
+def get_engine():
+    """
+    Gets the shared database engine.
+
+    The engine is created lazily from the app persistent store URL the first time
+    it is needed, and again in any worker process forked after it was created.
+    """
+
+    if _engine is None or _engine_pid != os.getpid():
+        with _engine_lock:
+            if _engine is None or _engine_pid != os.getpid():
+                configure_engine(
+                    app.get_persistent_store_database("hydroshare_timeseries_manager", as_url=True)
+                )
+
+    return _engine
+
+
+def get_session():
+    """
+    Gets a database session.
+
+    Sessions are scoped to the current thread and draw connections from the shared
+    engine pool. Closing the session returns its connection to the pool.
+    """
+
+    if _session_factory is None or _engine_pid != os.getpid():
+        get_engine()
+
+    return _session_factory()
+
+
+@contextlib.contextmanager
+def session_scope():
+    """
+    Runs a model action in the thread's database session.
+
+    The session is committed if the action succeeds and rolled back if it raises, and
+    is removed from the thread either way. A failed statement therefore cannot leave
+    the thread's session in a rolled back or aborted transaction for later actions.
+    """
+
+    session = get_session()
+
+    try:
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        _session_factory.remove()
+
 
 # ---------------------- #
 #   TABLE DECLARATIONS   #
@@ -33,17 +417,16 @@ class TimeSeriesCatalog(Base):
     timeseries_id = Column(Text)
     status = Column(Text)
     status_details = Column(Text)
-    wml_data = Column(PickleType)
     selected = Column(Boolean)
     date_created = Column(DateTime)
     begin_date = Column(DateTime)
     end_date = Column(DateTime)
-    value_count = Column(Text)
+    value_count = Column(Integer)
     sample_medium = Column(Text)
     site_name = Column(Text)
     site_code = Column(Text)
-    latitude = Column(Text)
-    longitude = Column(Text)
+    latitude = Column(Float)
+    longitude = Column(Float)
     variable_name = Column(Text)
     variable_code = Column(Text)
     method_description = Column(Text)
@@ -54,15 +437,213 @@ class TimeSeriesCatalog(Base):
     service_type = Column(Text)
     url = Column(Text)
 
-    # Constraints
+    # Constraints and Indexes
     __table_args__ = (
     	UniqueConstraint("session_id", "site_code", "variable_code", name="_ts_result"),
+        Index("ix_timeseries_catalog_session_timeseries", "session_id", "timeseries_id"),
+        Index("ix_timeseries_catalog_session_selected_status", "session_id", "selected", "status"),
+        Index("ix_timeseries_catalog_session_latitude", "session_id", "latitude"),
+        Index("ix_timeseries_catalog_session_longitude", "session_id", "longitude"),
+        Index("ix_timeseries_catalog_session_value_count", "session_id", "value_count"),
+        Index("ix_timeseries_catalog_session_begin_date", "session_id", "begin_date"),
+        Index("ix_timeseries_catalog_session_end_date", "session_id", "end_date"),
+    )
+
+
+class TimeSeriesPayload(Base):
+    """
+    TimeSeriesPayload SQLAlchemy DB Model
+
+    WaterML payloads are kept out of the catalog table so that catalog queries never
+    read payload bytes. Payloads are only loaded through get_wml_data or get_wml_stream,
+    and are stored compressed with the codec recorded alongside them.
+    """
+
+    __tablename__ = "timeseries_payloads"
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    session_id = Column(Text)
+    timeseries_id = Column(Text)
+    wml_data = Column(LargeBinary)
+    codec = Column(Text)
+    raw_size = Column(Integer)
+    stored_size = Column(Integer)
+
+    # Constraints
+    __table_args__ = (
+        UniqueConstraint("timeseries_id", name="_ts_payload"),
+    )
+
+
+class PrepareJob(Base):
+    """
+    PrepareJob SQLAlchemy DB Model
+
+    Tracks a background job that downloads and validates the pending timeseries of a
+    REFTS import.
+    """
+
+    __tablename__ = "prepare_jobs"
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Text)
+    session_id = Column(Text)
+    refts_id = Column(Text)
+    status = Column(Text)
+    status_details = Column(Text)
+    refresh = Column(Boolean)
+    total_count = Column(Integer)
+    ready_count = Column(Integer)
+    failed_count = Column(Integer)
+    bytes_downloaded = Column(Integer)
+    date_created = Column(DateTime)
+    date_started = Column(DateTime)
+    date_finished = Column(DateTime)
+    lease_expires = Column(DateTime)
+
+    # Constraints and Indexes
+    __table_args__ = (
+        UniqueConstraint("job_id", name="_prepare_job"),
+        Index("ix_prepare_jobs_session", "session_id"),
+    )
+
+
+class WmlCachePayload(Base):
+    """
+    WmlCachePayload SQLAlchemy DB Model
+
+    Validated WaterML payloads shared by every session. Payloads are addressed by the
+    SHA-256 hash of their uncompressed bytes, so identical responses are stored once.
+    """
+
+    __tablename__ = "wml_cache_payloads"
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    payload_hash = Column(Text)
+    wml_data = Column(LargeBinary)
+    codec = Column(Text)
+    raw_size = Column(Integer)
+    stored_size = Column(Integer)
+    date_created = Column(DateTime)
+    last_accessed = Column(DateTime)
+
+    # Constraints and Indexes
+    __table_args__ = (
+        UniqueConstraint("payload_hash", name="_wml_cache_payload_hash"),
+        Index("ix_wml_cache_payloads_last_accessed", "last_accessed"),
+    )
+
+
+class WmlCacheEntry(Base):
+    """
+    WmlCacheEntry SQLAlchemy DB Model
+
+    Maps a WaterOneFlow request key to the hash of the payload it returned.
+    """
+
+    __tablename__ = "wml_cache_entries"
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    request_key = Column(Text)
+    payload_hash = Column(Text)
+    date_created = Column(DateTime)
+
+    # Constraints and Indexes
+    __table_args__ = (
+        UniqueConstraint("request_key", name="_wml_cache_request_key"),
+        Index("ix_wml_cache_entries_payload_hash", "payload_hash"),
+        Index("ix_wml_cache_entries_date_created", "date_created"),
+    )
+
+
+class WmlSeriesState(Base):
+    """
+    WmlSeriesState SQLAlchemy DB Model
+
+    Remembers the last prepared WaterML of a series, identified by its service URL,
+    site, variable, and return and service types, so a refresh only has to download
+    values newer than the last one. The payload itself is kept in the WaterML cache.
+    """
+
+    __tablename__ = "wml_series_states"
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    series_key = Column(Text)
+    begin_date = Column(DateTime)
+    last_value_date = Column(DateTime)
+    value_count = Column(Integer)
+    payload_hash = Column(Text)
+    date_updated = Column(DateTime)
+
+    # Constraints and Indexes
+    __table_args__ = (
+        UniqueConstraint("series_key", name="_wml_series_key"),
+        Index("ix_wml_series_states_payload_hash", "payload_hash"),
+    )
+
+
+class HostConcurrencyLimit(Base):
+    """
+    HostConcurrencyLimit SQLAlchemy DB Model
+
+    Concurrency limits learned by the download engine for each WaterOneFlow server,
+    kept so the engine does not have to learn them again after a restart.
+    """
+
+    __tablename__ = "host_concurrency_limits"
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    host = Column(Text)
+    concurrency_limit = Column(Float)
+    latency = Column(Float)
+    date_updated = Column(DateTime)
+
+    # Constraints and Indexes
+    __table_args__ = (
+        UniqueConstraint("host", name="_host_concurrency_limit"),
+    )
+
+
+class DownloadQueueStats(Base):
+    """
+    DownloadQueueStats SQLAlchemy DB Model
+
+    Downloads queued and running for each session in the download engine of each
+    process, so any process can report them.
+    """
+
+    __tablename__ = "download_queue_stats"
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    process_key = Column(Text)
+    session_id = Column(Text)
+    queued = Column(Integer)
+    in_flight = Column(Integer)
+    bytes_in_flight = Column(Integer)
+    date_updated = Column(DateTime)
+
+    # Constraints and Indexes
+    __table_args__ = (
+        UniqueConstraint("process_key", "session_id", name="_download_queue_stats"),
+        Index("ix_download_queue_stats_session", "session_id"),
     )
 
 
 class PendingTimeSeries(Base):
     """
     PendingTimeSeries SQLAlchemy DB Model
+
+    Pending timeseries form a work queue. A worker claims rows by setting a lease token
+    and expiry, renews the lease while it works, and deletes the rows when it is done.
+    Rows whose lease has expired can be claimed again by any worker. Rows with a higher
+    priority are claimed first.
     """
 
     __tablename__ = "pending_timeseries"
@@ -72,10 +653,177 @@ class PendingTimeSeries(Base):
     session_id = Column(Text)
     timeseries_id = Column(Text)
     refts_id = Column(Text)
+    lease_token = Column(Text)
+    lease_expires = Column(DateTime)
+    attempts = Column(Integer)
+    priority = Column(Integer)
 
-    # Constraints
+    # Constraints and Indexes
     __table_args__ = (
         UniqueConstraint("session_id", "timeseries_id", "refts_id", name="_ts_refts"),
+        Index("ix_pending_timeseries_session_priority", "session_id", "priority"),
+        Index("ix_pending_timeseries_refts_lease", "session_id", "refts_id", "lease_expires"),
+        Index("ix_pending_timeseries_lease_token", "lease_token"),
+    )
+
+
+# -------------------- #
+#   CATALOG SEARCH     #
+# -------------------- #
+
+SEARCH_COLUMNS = (
+    "status",
+    "site_name",
+    "site_code",
+    "variable_name",
+    "variable_code",
+    "sample_medium",
+    "network_name",
+    "service_type",
+    "ref_type",
+    "return_type"
+)
+SEARCH_SEPARATOR = " | "
+SEARCH_INDEX_NAME = "ix_timeseries_catalog_search_trgm"
+SEARCH_TABLE_NAME = "timeseries_catalog_search"
+SEARCH_MIN_LENGTH = 3
+
+_search_backend = None
+
+
+def _search_document_sql(prefix=""):
+    """
+    Builds the SQL expression that joins a row's searchable columns into one string.
+    """
+
+    return f" || '{SEARCH_SEPARATOR}' || ".join(
+        f"coalesce({prefix}{column_name}, '')" for column_name in SEARCH_COLUMNS
+    )
+
+
+def create_catalog_search_index(engine):
+    """
+    Creates the catalog search index.
+
+    On PostgreSQL, a pg_trgm GIN index over the joined searchable columns serves the
+    substring searches used by the table and select-by-search. On SQLite, an FTS5
+    trigram table kept in sync with the catalog by triggers is used instead. Other
+    databases, or databases where the index cannot be created, fall back to ILIKE scans.
+    """
+
+    global _search_backend
+
+    table_name = TimeSeriesCatalog.__tablename__
+
+    if engine.dialect.name == "postgresql":
+        try:
+            with engine.begin() as connection:
+                connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                connection.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS {SEARCH_INDEX_NAME} ON {table_name} "
+                    f"USING gin (({_search_document_sql()}) gin_trgm_ops)"
+                ))
+        except Exception:
+            pass
+
+    elif engine.dialect.name == "sqlite":
+        try:
+            with engine.begin() as connection:
+                search_table_exists = connection.execute(
+                    text("SELECT name FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                    {"name": SEARCH_TABLE_NAME}
+                ).fetchone()
+                if not search_table_exists:
+                    connection.execute(text(
+                        f"CREATE VIRTUAL TABLE {SEARCH_TABLE_NAME} USING fts5(document, tokenize = 'trigram')"
+                    ))
+                    connection.execute(text(
+                        f"INSERT INTO {SEARCH_TABLE_NAME} (rowid, document) "
+                        f"SELECT id, {_search_document_sql()} FROM {table_name}"
+                    ))
+                connection.execute(text(
+                    f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE_NAME}_insert AFTER INSERT ON {table_name} BEGIN "
+                    f"INSERT INTO {SEARCH_TABLE_NAME} (rowid, document) VALUES (new.id, {_search_document_sql('new.')}); "
+                    f"END"
+                ))
+                connection.execute(text(
+                    f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE_NAME}_update "
+                    f"AFTER UPDATE OF {', '.join(SEARCH_COLUMNS)} ON {table_name} BEGIN "
+                    f"DELETE FROM {SEARCH_TABLE_NAME} WHERE rowid = old.id; "
+                    f"INSERT INTO {SEARCH_TABLE_NAME} (rowid, document) VALUES (new.id, {_search_document_sql('new.')}); "
+                    f"END"
+                ))
+                connection.execute(text(
+                    f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE_NAME}_delete AFTER DELETE ON {table_name} BEGIN "
+                    f"DELETE FROM {SEARCH_TABLE_NAME} WHERE rowid = old.id; "
+                    f"END"
+                ))
+        except Exception:
+            pass
+
+    _search_backend = None
+
+
+def _get_search_backend(session):
+    """
+    Detects which search index is available in the catalog database.
+    """
+
+    global _search_backend
+
+    if _search_backend is None:
+        dialect_name = session.get_bind().dialect.name
+        if dialect_name == "postgresql":
+            index_exists = session.execute(
+                text("SELECT 1 FROM pg_indexes WHERE indexname = :name"),
+                {"name": SEARCH_INDEX_NAME}
+            ).fetchone()
+            _search_backend = "trigram" if index_exists else "like"
+        elif dialect_name == "sqlite":
+            table_exists = session.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {"name": SEARCH_TABLE_NAME}
+            ).fetchone()
+            _search_backend = "fts5" if table_exists else "like"
+        else:
+            _search_backend = "like"
+
+    return _search_backend
+
+
+def catalog_search_filter(session, search_value):
+    """
+    Builds a filter clause matching catalog rows that contain a search value.
+
+    A row matches when any searchable column contains the search value, ignoring case.
+    The clause uses the search index created by create_catalog_search_index when one
+    is available.
+    """
+
+    search_backend = _get_search_backend(session)
+    escaped_value = search_value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+    if search_backend == "trigram":
+        return literal_column(f"({_search_document_sql(TimeSeriesCatalog.__tablename__ + '.')})").ilike(
+            f"%{escaped_value}%", escape="\\"
+        )
+
+    if search_backend == "fts5" and len(search_value) >= SEARCH_MIN_LENGTH:
+        return TimeSeriesCatalog.id.in_(
+            select([literal_column("rowid")]).select_from(
+                text(SEARCH_TABLE_NAME)
+            ).where(
+                text(f"{SEARCH_TABLE_NAME} MATCH :search_query").bindparams(
+                    search_query='"' + search_value.replace('"', '""') + '"'
+                )
+            )
+        )
+
+    return or_(
+        *[
+            getattr(TimeSeriesCatalog, column_name).ilike(f"%{escaped_value}%", escape="\\")
+            for column_name in SEARCH_COLUMNS
+        ]
     )
 
 
@@ -84,633 +832,1728 @@ class PendingTimeSeries(Base):
 # ------------------------------ #
 
 
-def add_timeseries_reference(session_id, timeseries_id, begin_date, end_date, value_count, 
-        sample_medium, site_name, site_code, latitude, longitude, variable_name, variable_code, 
-        method_description, method_link, network_name, ref_type, return_type, service_type, 
-        url, status="Waiting", status_details="None", wml_data="None", selected=False):
+def add_timeseries_reference(session_id, timeseries_id, begin_date, end_date, value_count, 
+        sample_medium, site_name, site_code, latitude, longitude, variable_name, variable_code, 
+        method_description, method_link, network_name, ref_type, return_type, service_type, 
+        url, status="Waiting", status_details="None", wml_data="None", selected=False):
+    """
+    Creates a new timeseries reference.
+
+    This function will create a new timeseries reference in the timeseries
+    catalog.
+    """
+
+    with session_scope() as session:
+        new_timeseries_reference = TimeSeriesCatalog(
+            session_id=session_id,
+            timeseries_id=timeseries_id,
+            status=status,
+            status_details=status_details,
+            selected=selected,
+            date_created=datetime.datetime.now(),
+            begin_date=begin_date,
+            end_date=end_date,
+            value_count=value_count,
+            sample_medium=sample_medium,
+            site_name=site_name,
+            site_code=site_code,
+            latitude=latitude,
+            longitude=longitude,
+            variable_name=variable_name,
+            variable_code=variable_code,
+            method_description=method_description,
+            method_link=method_link,
+            network_name=network_name,
+            ref_type=ref_type,
+            return_type=return_type,
+            service_type=service_type,
+            url=url
+        )
+
+        session.add(new_timeseries_reference)
+
+        if isinstance(wml_data, bytes):
+            _store_wml_data(session, session_id, {timeseries_id: wml_data})
+
+
+def add_timeseries_references(session_id, timeseries_references, batch_size=BULK_INSERT_BATCH_SIZE):
+    """
+    Creates many timeseries references at once.
+
+    This function inserts a list of timeseries reference dictionaries (keyed by catalog
+    column name) into the timeseries catalog in batched multi-row statements, or with
+    COPY on PostgreSQL for large lists. References that duplicate an existing
+    (session_id, site_code, variable_code) row are skipped. Returns the timeseries IDs
+    that were created.
+    """
+
+    now = datetime.datetime.now()
+    rows = []
+    for timeseries_reference in timeseries_references:
+        row = {"status": "Waiting", "status_details": "None", "selected": False}
+        row.update(timeseries_reference)
+        row.update(session_id=session_id, date_created=now)
+        rows.append(row)
+
+    if not rows:
+        return []
+
+    with session_scope() as session:
+        dialect = session.get_bind().dialect
+
+        if dialect.name == "postgresql" and dialect.driver == "psycopg2" and len(rows) >= BULK_COPY_THRESHOLD:
+            created_ids = _copy_timeseries_references(session, rows)
+        elif dialect.name == "postgresql":
+            created_ids = []
+            for i in range(0, len(rows), batch_size):
+                created_ids.extend(x[0] for x in session.execute(
+                    pg_insert(TimeSeriesCatalog.__table__).values(
+                        rows[i:i + batch_size]
+                    ).on_conflict_do_nothing(
+                        constraint="_ts_result"
+                    ).returning(
+                        TimeSeriesCatalog.timeseries_id
+                    )
+                ))
+        else:
+            created_ids = _insert_new_timeseries_references(session, session_id, rows)
+
+    return created_ids
+
+
+def _copy_timeseries_references(session, rows):
+    """
+    Bulk loads timeseries references on PostgreSQL with COPY.
+
+    Rows are copied into a temporary staging table and then moved into the catalog with
+    a single INSERT ... SELECT that skips duplicates and returns the created IDs. The
+    csv writer quotes missing values like empty strings, so the numeric columns are
+    copied with FORCE_NULL to load them as NULL.
+    """
+
+    columns = [column for column in BULK_INSERT_COLUMNS if column in rows[0]]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    for row in rows:
+        writer.writerow([row.get(column) for column in columns])
+    buffer.seek(0)
+
+    column_list = ", ".join(columns)
+    null_columns = ", ".join(column for column in columns if column in NUMERIC_CATALOG_COLUMNS)
+    copy_options = f", FORCE_NULL ({null_columns})" if null_columns else ""
+    cursor = session.connection().connection.cursor()
+    cursor.execute(
+        "CREATE TEMP TABLE _timeseries_catalog_ingest "
+        "(LIKE timeseries_catalog INCLUDING DEFAULTS) ON COMMIT DROP"
+    )
+    cursor.copy_expert(
+        f"COPY _timeseries_catalog_ingest ({column_list}) FROM STDIN WITH (FORMAT csv{copy_options})",
+        buffer
+    )
+    cursor.execute(
+        f"INSERT INTO timeseries_catalog ({column_list}) "
+        f"SELECT {column_list} FROM _timeseries_catalog_ingest "
+        f"ON CONFLICT ON CONSTRAINT _ts_result DO NOTHING "
+        f"RETURNING timeseries_id"
+    )
+    created_ids = [x[0] for x in cursor.fetchall()]
+    cursor.close()
+
+    return created_ids
+
+
+def _insert_new_timeseries_references(session, session_id, rows):
+    """
+    Bulk inserts timeseries references on databases without an upsert clause.
+
+    Duplicates are removed against the session's existing rows and within the list
+    itself before a single executemany insert.
+    """
+
+    existing_keys = set(
+        session.query(
+            TimeSeriesCatalog.site_code,
+            TimeSeriesCatalog.variable_code
+        ).filter(
+            TimeSeriesCatalog.session_id == session_id
+        ).all()
+    )
+
+    new_rows = []
+    for row in rows:
+        key = (row.get("site_code"), row.get("variable_code"))
+        if key not in existing_keys:
+            existing_keys.add(key)
+            new_rows.append(row)
+
+    if new_rows:
+        session.execute(TimeSeriesCatalog.__table__.insert(), new_rows)
+
+    return [row["timeseries_id"] for row in new_rows]
+
+
+def get_timeseries_references(session_id, search_value, length, offset, column, order, seek_after=None):
+    """
+    Gets a filtered list of timeseries references.
+
+    This function will generate a filtered list of timeseries references belonging to a session
+    given a search value. The length, offset, and order of the list can also be specified.
+    If seek_after is given the timeseries ID of the last row on the previous page, the
+    page starts after that row instead of at the offset, unless that row is gone.
+    """
+
+    sortable_columns = [
+        "status", 
+        "site_name",
+        "site_code",
+        "latitude", 
+        "longitude",
+        "variable_name",
+        "variable_code",
+        "sample_medium",
+        "begin_date",
+        "end_date",
+        "value_count",
+        "method_link",
+        "method_description",
+        "network_name",
+        "url",
+        "service_type",
+        "ref_type",
+        "return_type"
+    ]
+
+    page_columns = [
+        "status",
+        "status",
+        "site_name",
+        "site_code",
+        "latitude",
+        "longitude",
+        "variable_name",
+        "variable_code",
+        "sample_medium",
+        "begin_date",
+        "end_date",
+        "value_count",
+        "method_link",
+        "method_description",
+        "network_name",
+        "url",
+        "service_type",
+        "ref_type",
+        "return_type",
+        "timeseries_id",
+        "selected"
+    ]
+
+    if order in ("asc", "desc"):
+        sort_column = sortable_columns[int(column)]
+    else:
+        sort_column = "timeseries_id"
+    sort_direction = desc if order == "desc" else asc
+
+    with session_scope() as session:
+        if search_value:
+            search_match = catalog_search_filter(session, search_value)
+
+        count_columns = [
+            func.count(TimeSeriesCatalog.id),
+            func.sum(case([(TimeSeriesCatalog.selected == True, 1)], else_=0))
+        ]
+
+        if search_value:
+            count_columns.append(
+                session.query(
+                    func.count(TimeSeriesCatalog.id)
+                ).filter(
+                    TimeSeriesCatalog.session_id == session_id,
+                    search_match
+                ).as_scalar()
+            )
+
+        query_counts = session.\
+            query(
+                *count_columns
+            ).filter(
+                TimeSeriesCatalog.session_id == session_id
+            ).one()
+
+        full_query_count, selected_query_count = query_counts[:2]
+        filtered_query_count = query_counts[2] if search_value else full_query_count
+
+        paginated_query = session.\
+            query(
+                *[getattr(TimeSeriesCatalog, x) for x in page_columns]
+            ).filter(
+                TimeSeriesCatalog.session_id == session_id
+            )
+
+        if search_value:
+            paginated_query = paginated_query.filter(search_match)
+
+        sort_attribute = getattr(TimeSeriesCatalog, sort_column)
+
+        if seek_after:
+            anchor = session.\
+                query(
+                    sort_attribute,
+                    TimeSeriesCatalog.id
+                ).filter(
+                    TimeSeriesCatalog.session_id == session_id,
+                    TimeSeriesCatalog.timeseries_id == seek_after
+                ).first()
+        else:
+            anchor = None
+
+        # Rows with an empty sort value come last in ascending order and first in descending order.
+        if anchor is not None:
+            anchor_value, anchor_id = anchor
+            seek_operator = "__lt__" if order == "desc" else "__gt__"
+            next_in_group = getattr(TimeSeriesCatalog.id, seek_operator)(anchor_id)
+            if anchor_value is None:
+                seek_filter = and_(sort_attribute.is_(None), next_in_group)
+                if order == "desc":
+                    seek_filter = or_(seek_filter, sort_attribute.isnot(None))
+            else:
+                seek_filter = or_(
+                    getattr(sort_attribute, seek_operator)(anchor_value),
+                    and_(sort_attribute == anchor_value, next_in_group)
+                )
+                if order != "desc":
+                    seek_filter = or_(seek_filter, sort_attribute.is_(None))
+            paginated_query = paginated_query.filter(seek_filter)
+
+        null_order = nullsfirst if order == "desc" else nullslast
+        paginated_query = paginated_query.order_by(
+            null_order(sort_direction(sort_attribute)),
+            sort_direction(TimeSeriesCatalog.id)
+        )
+
+        if anchor is None:
+            paginated_query = paginated_query.offset(offset)
+
+        paginated_query = paginated_query.limit(length)
+
+        query_results = [tuple(x) for x in paginated_query.all()]
+
+    return full_query_count, int(filtered_query_count or 0), int(selected_query_count or 0), query_results
+
+
+def update_timeseries_selections(session_id, timeseries_id, search_value, selected):
+    """
+    Updates selected value of one or more timeseries references.
+
+    This function can update the 'selected' value of a single timeseries reference, given a timeseries ID,
+    or of many values, given a search query.
+    """
+
+    with session_scope() as session:
+        full_query = session.\
+            query(
+                TimeSeriesCatalog
+            ).filter(
+                TimeSeriesCatalog.session_id == session_id
+            )
+
+        if timeseries_id:
+            filtered_query = full_query.filter(
+                TimeSeriesCatalog.timeseries_id == timeseries_id
+            )
+        elif search_value:
+            filtered_query = full_query.filter(
+                catalog_search_filter(session, search_value)
+            )
+        else:
+            filtered_query = full_query
+
+        filtered_query.update({TimeSeriesCatalog.selected: selected}, synchronize_session=False)
+
+
+def remove_timeseries_references(session_id, selected, timeseries_id):
+    """
+    Removes timeseries references from session.
+
+    This function can remove one or more timeseries references from a session.
+    It can either remove one timeseries, all selected timeseries, or all timeseries
+    in the session.
+    Their stored payloads and any pending prepare work are removed with them.
+    """
+
+    with session_scope() as session:
+        full_query = session.\
+            query(
+                TimeSeriesCatalog
+            ).filter(
+                TimeSeriesCatalog.session_id == session_id
+            )
+
+        if timeseries_id:
+            filtered_query = full_query.filter(
+                TimeSeriesCatalog.timeseries_id == timeseries_id
+            )
+        elif selected is True:
+            filtered_query = full_query.filter(
+                TimeSeriesCatalog.selected == True
+            )
+        else:
+            filtered_query = full_query
+
+        session.query(
+            TimeSeriesPayload
+        ).filter(
+            TimeSeriesPayload.session_id == session_id,
+            TimeSeriesPayload.timeseries_id.in_(
+                filtered_query.with_entities(TimeSeriesCatalog.timeseries_id).subquery()
+            )
+        ).delete(synchronize_session=False)
+
+        session.query(
+            PendingTimeSeries
+        ).filter(
+            PendingTimeSeries.session_id == session_id,
+            PendingTimeSeries.timeseries_id.in_(
+                filtered_query.with_entities(TimeSeriesCatalog.timeseries_id).subquery()
+            )
+        ).delete(synchronize_session=False)
+
+        filtered_query.delete(synchronize_session=False)
+
+
+def get_selected_timeseries_ids(session_id):
+    """
+    Gets the timeseries IDs of the selected timeseries references of a session.
+    """
+
+    with session_scope() as session:
+        timeseries_ids = [x[0] for x in session.execute(_selected_timeseries_ids(session_id)).fetchall()]
+
+    return timeseries_ids
+
+
+def get_timeseries_request_data(session_id, timeseries_id):
+    """
+    Gets all metadata for a specific timeseries.
+
+    This function will return necessary data for building
+    a WaterOneFlow request for a given timeseries.
+    Returns None if the timeseries is no longer in the session.
+    """
+
+    with session_scope() as session:
+        full_query = session.\
+            query(
+                TimeSeriesCatalog.timeseries_id,
+                TimeSeriesCatalog.selected,
+                TimeSeriesCatalog.status,
+                TimeSeriesCatalog.begin_date,
+                TimeSeriesCatalog.end_date,
+                TimeSeriesCatalog.value_count,
+                TimeSeriesCatalog.sample_medium,
+                TimeSeriesCatalog.site_name,
+                TimeSeriesCatalog.site_code,
+                TimeSeriesCatalog.latitude,
+                TimeSeriesCatalog.longitude,
+                TimeSeriesCatalog.variable_name,
+                TimeSeriesCatalog.variable_code,
+                TimeSeriesCatalog.network_name,
+                TimeSeriesCatalog.ref_type,
+                TimeSeriesCatalog.return_type,
+                TimeSeriesCatalog.service_type,
+                TimeSeriesCatalog.url
+            ).filter(
+                TimeSeriesCatalog.session_id == session_id,
+            )
+
+        filtered_query = full_query.filter(
+            TimeSeriesCatalog.timeseries_id == timeseries_id
+        ).one_or_none()
+
+    return filtered_query
+
+
+def update_timeseries_reference(session_id, timeseries_id, status=None, status_details=None,
+        wml_data=None, selected=None, begin_date=None, end_date=None, value_count=None, 
+        sample_medium=None, site_name=None, site_code=None, latitude=None, longitude=None, 
+        variable_name=None, variable_code=None, method_description=None, method_link=None, 
+        network_name=None, ref_type=None, return_type=None, service_type=None, url=None):
+    """
+    Updates values of a timeseries reference.
+
+    This function can update any parameter for a time series
+    reference in the time series catalog.
+    """
+
+    fields = {
+        "status": status,
+        "status_details": status_details,
+        "wml_data": wml_data,
+        "selected": selected,
+        "begin_date": begin_date,
+        "end_date": end_date,
+        "value_count": value_count,
+        "sample_medium": sample_medium,
+        "site_name": site_name,
+        "site_code": site_code,
+        "latitude": latitude,
+        "longitude": longitude,
+        "variable_name": variable_name,
+        "variable_code": variable_code,
+        "method_description": method_description,
+        "method_link": method_link,
+        "network_name": network_name,
+        "ref_type": ref_type,
+        "return_type": return_type,
+        "service_type": service_type,
+        "url": url
+    }
+
+    update_timeseries_references(session_id, [(timeseries_id, fields)])
+
+
+def update_timeseries_references(session_id, changes):
+    """
+    Updates values of many timeseries references.
+
+    This function takes a list of (timeseries_id, fields) pairs, where fields is a
+    dictionary of catalog column names to new values. Fields set to None are left
+    unchanged. Each reference is updated with a single UPDATE, and references that
+    change the same set of fields are sent together with executemany.
+    """
+
+    change_groups = {}
+    payloads = {}
+    for timeseries_id, fields in changes:
+        fields = {key: value for key, value in fields.items() if value is not None}
+        if "wml_data" in fields:
+            payloads[timeseries_id] = fields.pop("wml_data")
+        if fields:
+            change_groups.setdefault(tuple(sorted(fields)), []).append(
+                dict({f"_{key}": value for key, value in fields.items()}, _timeseries_id=timeseries_id)
+            )
+
+    if not change_groups and not payloads:
+        return
+
+    table = TimeSeriesCatalog.__table__
+    with session_scope() as session:
+        if payloads:
+            _store_wml_data(session, session_id, payloads)
+
+        for field_names, parameters in change_groups.items():
+            statement = table.update().where(
+                and_(
+                    table.c.session_id == session_id,
+                    table.c.timeseries_id == bindparam("_timeseries_id")
+                )
+            ).values(
+                {field_name: bindparam(f"_{field_name}", type_=table.c[field_name].type) for field_name in field_names}
+            )
+            session.execute(statement, parameters)
+
+
+def get_wml_data(session_id, timeseries_id):
+    """
+    Gets WaterML data from a timeseries reference.
+
+    This function will retrieve a stored WaterML data object for
+    a timeseries reference.
+    """
+
+    with session_scope() as session:
+        payload = session.\
+            query(
+                TimeSeriesPayload.codec,
+                TimeSeriesPayload.wml_data
+            ).filter(
+                and_(
+                    TimeSeriesPayload.session_id == session_id,
+                    TimeSeriesPayload.timeseries_id == timeseries_id
+                )
+            ).one_or_none()
+
+    if payload is None:
+        return (None,)
+
+    return (decode_payload(payload.codec, payload.wml_data),)
+
+
+def get_wml_stream(session_id, timeseries_id):
+    """
+    Gets WaterML data from a timeseries reference as a stream.
+
+    This function returns a file-like object that decompresses the stored WaterML
+    data as it is read, or None if the timeseries has no WaterML data.
+    """
+
+    with session_scope() as session:
+        payload = session.\
+            query(
+                TimeSeriesPayload.codec,
+                TimeSeriesPayload.wml_data
+            ).filter(
+                and_(
+                    TimeSeriesPayload.session_id == session_id,
+                    TimeSeriesPayload.timeseries_id == timeseries_id
+                )
+            ).one_or_none()
+
+    if payload is None or payload.wml_data is None:
+        return None
+
+    return open_payload_stream(payload.codec, payload.wml_data)
+
+
+def get_wml_storage_stats(session_id):
+    """
+    Gets WaterML storage statistics for a session.
+
+    Returns the number of stored payloads and their total uncompressed and stored sizes
+    in bytes.
+    """
+
+    with session_scope() as session:
+        payload_count, raw_size, stored_size = session.\
+            query(
+                func.count(TimeSeriesPayload.id),
+                func.sum(TimeSeriesPayload.raw_size),
+                func.sum(TimeSeriesPayload.stored_size)
+            ).filter(
+                TimeSeriesPayload.session_id == session_id
+            ).one()
+
+    return payload_count, int(raw_size or 0), int(stored_size or 0)
+
+
+def _store_wml_data(session, session_id, payloads, batch_size=500):
+    """
+    Writes WaterML payloads for a set of timeseries references.
+
+    Payloads is a dictionary of timeseries IDs to WaterML bytes. Payloads are
+    compressed with the default payload codec, and existing payloads for those
+    timeseries are replaced. The caller commits the session.
+    """
+
+    table = TimeSeriesPayload.__table__
+    timeseries_ids = list(payloads)
+
+    rows = []
+    for timeseries_id, wml_data in payloads.items():
+        codec, encoded_data = encode_payload(wml_data)
+        rows.append({
+            "session_id": session_id,
+            "timeseries_id": timeseries_id,
+            "wml_data": encoded_data,
+            "codec": codec,
+            "raw_size": len(wml_data),
+            "stored_size": len(encoded_data)
+        })
+
+    for i in range(0, len(timeseries_ids), batch_size):
+        session.execute(
+            table.delete().where(
+                table.c.timeseries_id.in_(timeseries_ids[i:i + batch_size])
+            )
+        )
+
+    session.execute(table.insert(), rows)
+
+
+def get_resource_metadata(session_id):
+    """
+    Gets default resource metadata for the selected timeseries references.
+
+    This function reads the selected rows of a session once, through a common table
+    expression, and returns in a single query the first five site names, variable names,
+    and sample mediums of the selected Ready rows, the number of distinct sites and
+    variables, the date range, and the number of selected rows that are not Ready.
+    """
+
+    table = TimeSeriesCatalog.__table__
+
+    selected_rows = select([
+        table.c.site_name,
+        table.c.variable_name,
+        table.c.sample_medium,
+        table.c.begin_date,
+        table.c.end_date,
+        case([(table.c.status == "Ready", 1)], else_=0).label("ready")
+    ]).where(
+        and_(
+            table.c.session_id == session_id,
+            table.c.selected == true()
+        )
+    ).cte("selected_rows")
+
+    summary_query = select([
+        literal("summary").label("kind"),
+        null().label("name"),
+        func.count(distinct(case([(selected_rows.c.ready == 1, selected_rows.c.site_name)]))).label("site_count"),
+        func.count(distinct(case([(selected_rows.c.ready == 1, selected_rows.c.variable_name)]))).label("variable_count"),
+        func.sum(1 - selected_rows.c.ready).label("invalid_count"),
+        func.min(case([(selected_rows.c.ready == 1, selected_rows.c.begin_date)])).label("begin_date"),
+        func.max(case([(selected_rows.c.ready == 1, selected_rows.c.end_date)])).label("end_date")
+    ])
+
+    name_queries = []
+    for kind in ("site_name", "variable_name", "sample_medium"):
+        first_names = select([
+            selected_rows.c[kind].label("name")
+        ]).where(
+            selected_rows.c.ready == 1
+        ).distinct().order_by(
+            selected_rows.c[kind]
+        ).limit(5).alias(f"first_{kind}s")
+        name_queries.append(
+            select([
+                literal(kind).label("kind"),
+                first_names.c.name,
+                null().label("site_count"),
+                null().label("variable_count"),
+                null().label("invalid_count"),
+                null().label("begin_date"),
+                null().label("end_date")
+            ])
+        )
+
+    with session_scope() as session:
+        metadata_rows = session.execute(union_all(summary_query, *name_queries)).fetchall()
+
+    summary = next(x for x in metadata_rows if x[0] == "summary")
+    site_names = [x[1] for x in metadata_rows if x[0] == "site_name"]
+    variable_names = [x[1] for x in metadata_rows if x[0] == "variable_name"]
+    sample_mediums = [x[1] for x in metadata_rows if x[0] == "sample_medium"]
+
+    return site_names, summary[2], variable_names, summary[3], sample_mediums, summary[5], summary[6], int(summary[4] or 0)
+
+
+def get_refts(session_id):
+    """
+
+    """
+
+    with session_scope() as session:
+        refts = session.\
+            query(
+                TimeSeriesCatalog.site_name,
+                TimeSeriesCatalog.site_code,
+                TimeSeriesCatalog.latitude,
+                TimeSeriesCatalog.longitude,
+                TimeSeriesCatalog.variable_name,
+                TimeSeriesCatalog.variable_code,
+                TimeSeriesCatalog.sample_medium,
+                TimeSeriesCatalog.begin_date,
+                TimeSeriesCatalog.end_date,
+                TimeSeriesCatalog.value_count,
+                TimeSeriesCatalog.method_link,
+                TimeSeriesCatalog.method_description,
+                TimeSeriesCatalog.network_name,
+                TimeSeriesCatalog.url,
+                TimeSeriesCatalog.service_type,
+                TimeSeriesCatalog.ref_type,
+                TimeSeriesCatalog.return_type
+            ).filter(
+                and_(
+                    TimeSeriesCatalog.session_id == session_id,
+                    TimeSeriesCatalog.selected == True
+                )
+            ).all()
+
+    return refts
+
+
+# ----------------------- #
+#   PREPARE JOB ACTIONS   #
+# ----------------------- #
+
+def add_prepare_job(job_id, session_id, refts_id, total_count, refresh=False, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Adds a queued prepare job, leased to the process that queues it.
+    """
+
+    with session_scope() as session:
+        now = datetime.datetime.now()
+        new_prepare_job = PrepareJob(
+            job_id=job_id,
+            session_id=session_id,
+            refts_id=refts_id,
+            status="Queued",
+            status_details="None",
+            refresh=refresh,
+            total_count=total_count,
+            ready_count=0,
+            failed_count=0,
+            bytes_downloaded=0,
+            date_created=now,
+            lease_expires=now + datetime.timedelta(seconds=lease_seconds)
+        )
+
+        session.add(new_prepare_job)
+
+
+def update_prepare_job(job_id, status=None, status_details=None, ready_count=0, failed_count=0,
+                       bytes_downloaded=0):
+    """
+    Updates the status and progress of a prepare job.
+
+    Counts are added to the job's running totals in the same UPDATE, so workers
+    reporting progress at the same time do not overwrite each other. The start and
+    finish times are set when the job moves to Running and to Complete or Failed.
+    """
+
+    table = PrepareJob.__table__
+    values = {
+        "ready_count": table.c.ready_count + ready_count,
+        "failed_count": table.c.failed_count + failed_count,
+        "bytes_downloaded": table.c.bytes_downloaded + bytes_downloaded
+    }
+    if status is not None:
+        values["status"] = status
+        if status == "Running":
+            values["date_started"] = func.coalesce(table.c.date_started, datetime.datetime.now())
+        elif status in ("Complete", "Failed"):
+            values["date_finished"] = datetime.datetime.now()
+    if status_details is not None:
+        values["status_details"] = status_details
+
+    with session_scope() as session:
+        session.execute(
+            table.update().where(table.c.job_id == job_id).values(values)
+        )
+
+
+def get_prepare_job(session_id, job_id):
+    """
+    Gets a prepare job of a session.
+    """
+
+    with session_scope() as session:
+        prepare_job = session.\
+            query(
+                PrepareJob.job_id,
+                PrepareJob.refts_id,
+                PrepareJob.status,
+                PrepareJob.status_details,
+                PrepareJob.total_count,
+                PrepareJob.ready_count,
+                PrepareJob.failed_count,
+                PrepareJob.bytes_downloaded,
+                PrepareJob.date_created,
+                PrepareJob.date_started,
+                PrepareJob.date_finished
+            ).filter(
+                and_(
+                    PrepareJob.session_id == session_id,
+                    PrepareJob.job_id == job_id
+                )
+            ).one_or_none()
+
+    return prepare_job
+
+
+def renew_prepare_job_leases(job_ids, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Extends the leases of the prepare jobs that a process still has workers for.
+    """
+
+    table = PrepareJob.__table__
+
+    with session_scope() as session:
+        session.execute(
+            table.update().where(
+                table.c.job_id.in_(list(job_ids))
+            ).values(
+                lease_expires=datetime.datetime.now() + datetime.timedelta(seconds=lease_seconds)
+            )
+        )
+
+
+def claim_orphaned_prepare_jobs(lease_seconds=DEFAULT_LEASE_SECONDS):
     """
-    Creates a new timeseries reference.
+    Claims the unfinished prepare jobs whose lease has expired.
 
-    This function will create a new timeseries reference in the timeseries
-    catalog.
+    A job's lease lapses when the process that ran its workers has crashed or exited,
+    or when its last worker stopped while timeseries were still pending. Each job is
+    leased to the caller with a conditional UPDATE, so only one process recovers it.
+    Returns the job ID, session ID, REFTS ID, and refresh flag of each claimed job.
     """
 
-    Session = app.get_persistent_store_database(
-        "hydroshare_timeseries_manager", 
-        as_sessionmaker=True
-    )
+    table = PrepareJob.__table__
+    now = datetime.datetime.now()
 
-    session = Session()
-
-    new_timeseries_reference = TimeSeriesCatalog(
-        session_id=session_id,
-        timeseries_id=timeseries_id,
-        status=status,
-        status_details=status_details,
-        selected=selected,
-        date_created=datetime.datetime.now(),
-        wml_data=wml_data,
-        begin_date=begin_date,
-        end_date=end_date,
-        value_count=value_count,
-        sample_medium=sample_medium,
-        site_name=site_name,
-        site_code=site_code,
-        latitude=latitude,
-        longitude=longitude,
-        variable_name=variable_name,
-        variable_code=variable_code,
-        method_description=method_description,
-        method_link=method_link,
-        network_name=network_name,
-        ref_type=ref_type,
-        return_type=return_type,
-        service_type=service_type,
-        url=url
+    orphaned = and_(
+        table.c.status.in_(("Queued", "Running")),
+        or_(table.c.lease_expires == None, table.c.lease_expires < now)
     )
 
-    session.add(new_timeseries_reference)
+    with session_scope() as session:
+        candidates = session.execute(
+            select([table.c.job_id, table.c.session_id, table.c.refts_id, table.c.refresh]).where(orphaned)
+        ).fetchall()
+
+        claimed_jobs = []
+        for job_id, session_id, refts_id, refresh in candidates:
+            result = session.execute(
+                table.update().where(
+                    and_(
+                        table.c.job_id == job_id,
+                        orphaned
+                    )
+                ).values(
+                    lease_expires=now + datetime.timedelta(seconds=lease_seconds)
+                )
+            )
+            if result.rowcount:
+                claimed_jobs.append((job_id, session_id, refts_id, bool(refresh)))
+
+    return claimed_jobs
 
-    session.commit()
-    session.close()
 
+# ------------------------- #
+#   WATERML CACHE ACTIONS   #
+# ------------------------- #
 
-def get_timeseries_references(session_id, search_value, length, offset, column, order):
+def get_wml_cache_key(url, site_code, variable_code, begin_date, end_date, return_type, service_type):
     """
-    Gets a filtered list of timeseries references.
+    Builds the cache key of a WaterOneFlow request.
 
-    This function will generate a filtered list of timeseries references belonging to a session
-    given a search value. The length, offset, and order of the list can also be specified.
+    The key identifies a request across sessions, so any two timeseries references
+    that would send the same request share a key.
     """
 
-    Session = app.get_persistent_store_database(
-        "hydroshare_timeseries_manager", 
-        as_sessionmaker=True
-    )
+    request_fields = (url, site_code, variable_code, begin_date, end_date, return_type, service_type)
 
-    session = Session()
+    return hashlib.sha256(
+        "\n".join("" if field is None else str(field) for field in request_fields).encode("utf-8")
+    ).hexdigest()
 
-    sortable_columns = [
-        "status", 
-        "site_name",
-        "site_code",
-        "latitude", 
-        "longitude",
-        "variable_name",
-        "variable_code",
-        "sample_medium",
-        "begin_date",
-        "end_date",
-        "value_count",
-        "method_link",
-        "method_description",
-        "network_name",
-        "url",
-        "service_type",
-        "ref_type",
-        "return_type"
-    ]
 
-    full_query = session.\
-        query(
-            TimeSeriesCatalog.status,
-            TimeSeriesCatalog.status,
-            TimeSeriesCatalog.site_name,
-            TimeSeriesCatalog.site_code,
-            TimeSeriesCatalog.latitude,
-            TimeSeriesCatalog.longitude,
-            TimeSeriesCatalog.variable_name,
-            TimeSeriesCatalog.variable_code,
-            TimeSeriesCatalog.sample_medium,
-            TimeSeriesCatalog.begin_date,
-            TimeSeriesCatalog.end_date,
-            TimeSeriesCatalog.value_count,
-            TimeSeriesCatalog.method_link,
-            TimeSeriesCatalog.method_description,
-            TimeSeriesCatalog.network_name,
-            TimeSeriesCatalog.url,
-            TimeSeriesCatalog.service_type,
-            TimeSeriesCatalog.ref_type,
-            TimeSeriesCatalog.return_type,
-            TimeSeriesCatalog.timeseries_id,
-            TimeSeriesCatalog.selected
-        ).filter(
-            TimeSeriesCatalog.session_id == session_id
-        )
+def load_cached_wml(session_id, request_keys, ttl=None):
+    """
+    Fills timeseries references from the WaterML cache.
 
-    if search_value != "":
-        filtered_query = full_query.filter(
-            or_(
-                TimeSeriesCatalog.status.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.site_name.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.site_code.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.variable_name.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.variable_code.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.sample_medium.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.network_name.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.service_type.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.ref_type.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.return_type.ilike(f"%{search_value}%"),
+    Request keys is a dictionary of timeseries IDs to cache keys. Cached payloads that
+    have not expired are copied into the session without being recompressed and the
+    references are marked Ready, since only validated payloads are cached. Returns the
+    list of timeseries IDs that were served from the cache.
+    """
+
+    if not request_keys:
+        return []
+
+    ttl = int(ttl if ttl is not None else _get_setting("wml_cache_ttl", DEFAULT_WML_CACHE_TTL))
+    now = datetime.datetime.now()
+
+    with session_scope() as session:
+        cached_payloads = {}
+        key_list = list(set(request_keys.values()))
+        for i in range(0, len(key_list), 500):
+            cached_query = session.\
+                query(
+                    WmlCacheEntry.request_key,
+                    WmlCachePayload.payload_hash,
+                    WmlCachePayload.codec,
+                    WmlCachePayload.wml_data,
+                    WmlCachePayload.raw_size,
+                    WmlCachePayload.stored_size
+                ).join(
+                    WmlCachePayload, WmlCachePayload.payload_hash == WmlCacheEntry.payload_hash
+                ).filter(
+                    and_(
+                        WmlCacheEntry.request_key.in_(key_list[i:i + 500]),
+                        WmlCacheEntry.date_created >= now - datetime.timedelta(seconds=ttl)
+                    )
+                )
+            cached_payloads.update({x.request_key: x for x in cached_query.all()})
+
+        hits = {
+            timeseries_id: cached_payloads[request_key]
+            for timeseries_id, request_key in request_keys.items() if request_key in cached_payloads
+        }
+
+        if not hits:
+            return []
+
+        payload_table = TimeSeriesPayload.__table__
+        catalog_table = TimeSeriesCatalog.__table__
+        cache_table = WmlCachePayload.__table__
+        timeseries_ids = list(hits)
+
+        for i in range(0, len(timeseries_ids), 500):
+            session.execute(
+                payload_table.delete().where(
+                    payload_table.c.timeseries_id.in_(timeseries_ids[i:i + 500])
+                )
             )
-        )
-    else:
-        filtered_query = full_query
 
-    if order == "asc":
-        ordered_query = filtered_query.order_by(
-            asc(getattr(TimeSeriesCatalog, sortable_columns[int(column)]))
+        session.execute(
+            payload_table.insert(),
+            [
+                {
+                    "session_id": session_id,
+                    "timeseries_id": timeseries_id,
+                    "wml_data": cached_payload.wml_data,
+                    "codec": cached_payload.codec,
+                    "raw_size": cached_payload.raw_size,
+                    "stored_size": cached_payload.stored_size
+                } for timeseries_id, cached_payload in hits.items()
+            ]
         )
-    elif order == "desc":
-        ordered_query = filtered_query.order_by(
-            desc(getattr(TimeSeriesCatalog, sortable_columns[int(column)]))
-        )
-    else:
-        ordered_query = filtered_query.order_by(
-            asc(TimeSeriesCatalog.timeseries_id)
-        )
-
-    paginated_query = ordered_query.offset(offset).limit(length)
 
-    selected_query = full_query.filter(
-        TimeSeriesCatalog.selected == True
-    )
-
-    full_query_count = full_query.count()
-    filtered_query_count = filtered_query.count()
-    selected_query_count = selected_query.count()
-    query_results = paginated_query.all()
+        session.execute(
+            catalog_table.update().where(
+                and_(
+                    catalog_table.c.session_id == session_id,
+                    catalog_table.c.timeseries_id == bindparam("_timeseries_id")
+                )
+            ).values(status="Ready"),
+            [{"_timeseries_id": timeseries_id} for timeseries_id in timeseries_ids]
+        )
 
-    engine = session.get_bind()
-    session.close()
-    engine.dispose()
+        session.execute(
+            cache_table.update().where(
+                cache_table.c.payload_hash == bindparam("_payload_hash")
+            ).values(last_accessed=now),
+            [{"_payload_hash": payload_hash} for payload_hash in {x.payload_hash for x in hits.values()}]
+        )
 
-    return full_query_count, filtered_query_count, selected_query_count, query_results
+    return timeseries_ids
 
 
-def update_timeseries_selections(session_id, timeseries_id, search_value, selected):
+def add_cached_wml(payloads):
     """
-    Updates selected value of one or more timeseries references.
+    Adds validated WaterML payloads to the cache.
 
-    This function can update the 'selected' value of a single timeseries reference, given a timeseries ID,
-    or of many values, given a search query.
+    Payloads is a dictionary of cache keys to uncompressed WaterML bytes. Payloads
+    already in the cache are not stored again; their request keys are pointed at the
+    existing copy. The cache is evicted after the new payloads are added, at most once
+    per eviction interval in each process.
     """
 
-    Session = app.get_persistent_store_database(
-        "hydroshare_timeseries_manager", 
-        as_sessionmaker=True
-    )
+    payloads = {request_key: wml_data for request_key, wml_data in payloads.items() if wml_data}
 
-    session = Session()
+    if not payloads:
+        return
 
-    full_query = session.\
-        query(
-            TimeSeriesCatalog
-        ).filter(
-            TimeSeriesCatalog.session_id == session_id
-        )
+    now = datetime.datetime.now()
+    payload_hashes = {request_key: hashlib.sha256(wml_data).hexdigest() for request_key, wml_data in payloads.items()}
 
-    if timeseries_id:
-        filtered_query = full_query.filter(
-            TimeSeriesCatalog.timeseries_id == timeseries_id
-        )
-    elif search_value != "":
-        filtered_query = full_query.filter(
-            or_(
-                TimeSeriesCatalog.status.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.site_name.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.site_code.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.variable_name.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.variable_code.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.sample_medium.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.network_name.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.service_type.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.ref_type.ilike(f"%{search_value}%"),
-                TimeSeriesCatalog.return_type.ilike(f"%{search_value}%"),
+    with session_scope() as session:
+        entry_table = WmlCacheEntry.__table__
+
+        _store_cache_payloads(session, payloads.values(), now)
+
+        session.execute(
+            entry_table.delete().where(
+                entry_table.c.request_key.in_(list(payload_hashes))
             )
         )
-    else:
-        filtered_query = full_query
+        # Another process may cache the same request at the same time; its entry is kept.
+        _insert_ignoring_conflicts(
+            session,
+            entry_table,
+            "_wml_cache_request_key",
+            [
+                {
+                    "request_key": request_key,
+                    "payload_hash": payload_hash,
+                    "date_created": now
+                } for request_key, payload_hash in payload_hashes.items()
+            ]
+        )
+
+    _evict_wml_cache_periodically()
 
-    filtered_query.update({TimeSeriesCatalog.selected: selected}, synchronize_session='fetch')
 
-    session.commit()
+def _insert_ignoring_conflicts(session, table, constraint, rows):
+    """
+    Inserts rows into a table, skipping rows that violate the named unique constraint.
+    """
+
+    dialect_name = session.bind.dialect.name
 
-    engine = session.get_bind()
-    session.close()
-    engine.dispose()
+    if dialect_name == "postgresql":
+        insert_statement = pg_insert(table).on_conflict_do_nothing(constraint=constraint)
+    elif dialect_name == "sqlite":
+        insert_statement = table.insert().prefix_with("OR IGNORE")
+    else:
+        insert_statement = table.insert()
 
+    session.execute(insert_statement, rows)
 
 
-def remove_timeseries_references(session_id, selected, timeseries_id):
+def _store_cache_payloads(session, wml_data_list, now):
     """
-    Removes timeseries references from session.
+    Adds WaterML payloads to the cache payload table by hash.
 
-    This function can remove one or more timeseries references from a session.
-    It can either remove one timeseries, all selected timeseries, or all timeseries
-    in the session.
+    Payloads already in the table, or stored by another process at the same time, are
+    not stored again.
     """
 
-    Session = app.get_persistent_store_database(
-        "hydroshare_timeseries_manager", 
-        as_sessionmaker=True
-    )
+    payloads = {hashlib.sha256(wml_data).hexdigest(): wml_data for wml_data in wml_data_list}
 
-    session = Session()
+    if not payloads:
+        return
 
-    full_query = session.\
+    existing_query = session.\
         query(
-            TimeSeriesCatalog
+            WmlCachePayload.payload_hash
         ).filter(
-            TimeSeriesCatalog.session_id == session_id
+            WmlCachePayload.payload_hash.in_(list(payloads))
         )
+    existing_hashes = {x[0] for x in existing_query.all()}
 
-    if timeseries_id:
-        filtered_query = full_query.filter(
-            TimeSeriesCatalog.timeseries_id == timeseries_id
-        )
-    elif selected is True:
-        filtered_query = full_query.filter(
-            TimeSeriesCatalog.selected == True
-        )
-    else:
-        filtered_query = full_query
+    new_payloads = []
+    for payload_hash, wml_data in payloads.items():
+        if payload_hash not in existing_hashes:
+            codec, encoded_data = encode_payload(wml_data)
+            new_payloads.append({
+                "payload_hash": payload_hash,
+                "wml_data": encoded_data,
+                "codec": codec,
+                "raw_size": len(wml_data),
+                "stored_size": len(encoded_data),
+                "date_created": now,
+                "last_accessed": now
+            })
+
+    if not new_payloads:
+        return
 
-    filtered_query.delete()
+    _insert_ignoring_conflicts(session, WmlCachePayload.__table__, "_wml_cache_payload_hash", new_payloads)
 
-    session.commit()
 
-    engine = session.get_bind()
-    session.close()
-    engine.dispose()
+def _evict_wml_cache_periodically():
+    """
+    Runs evict_wml_cache at most once per eviction interval in this process.
+    """
 
+    global _last_eviction
 
-def get_timeseries_request_data(session_id, timeseries_id):
+    with _eviction_lock:
+        if time.monotonic() - _last_eviction < WML_CACHE_EVICTION_INTERVAL:
+            return
+        _last_eviction = time.monotonic()
+
+    evict_wml_cache()
+
+
+def evict_wml_cache(ttl=None, max_size=None):
     """
-    Gets all metadata for a specific timeseries.
+    Removes expired and least recently used payloads from the WaterML cache.
 
-    This function will return necessary data for building
-    a WaterOneFlow request for a given timeseries.
+    Request keys older than the TTL (in seconds) are removed along with any payloads
+    no longer referenced by a key or a series state. If the remaining payloads take up more than the
+    maximum size (in MB), the least recently used payloads are removed until the
+    cache fits.
     """
 
-    Session = app.get_persistent_store_database(
-        "hydroshare_timeseries_manager", 
-        as_sessionmaker=True
-    )
+    ttl = int(ttl if ttl is not None else _get_setting("wml_cache_ttl", DEFAULT_WML_CACHE_TTL))
+    max_size = int(max_size if max_size is not None else _get_setting("wml_cache_max_size", DEFAULT_WML_CACHE_MAX_SIZE))
+    max_bytes = max_size * 1024 * 1024
 
-    session = Session()
+    entry_table = WmlCacheEntry.__table__
+    cache_table = WmlCachePayload.__table__
+    state_table = WmlSeriesState.__table__
 
-    full_query = session.\
-        query(
-            TimeSeriesCatalog.timeseries_id,
-            TimeSeriesCatalog.selected,
-            TimeSeriesCatalog.status,
-            TimeSeriesCatalog.begin_date,
-            TimeSeriesCatalog.end_date,
-            TimeSeriesCatalog.value_count,
-            TimeSeriesCatalog.sample_medium,
-            TimeSeriesCatalog.site_name,
-            TimeSeriesCatalog.site_code,
-            TimeSeriesCatalog.latitude,
-            TimeSeriesCatalog.longitude,
-            TimeSeriesCatalog.variable_name,
-            TimeSeriesCatalog.variable_code,
-            TimeSeriesCatalog.network_name,
-            TimeSeriesCatalog.ref_type,
-            TimeSeriesCatalog.return_type,
-            TimeSeriesCatalog.service_type,
-            TimeSeriesCatalog.url
-        ).filter(
-            TimeSeriesCatalog.session_id == session_id,
+    with session_scope() as session:
+        session.execute(
+            entry_table.delete().where(
+                entry_table.c.date_created < datetime.datetime.now() - datetime.timedelta(seconds=ttl)
+            )
+        )
+        session.execute(
+            cache_table.delete().where(
+                and_(
+                    ~cache_table.c.payload_hash.in_(select([entry_table.c.payload_hash])),
+                    ~cache_table.c.payload_hash.in_(select([state_table.c.payload_hash]))
+                )
+            )
         )
 
-    filtered_query = full_query.filter(
-        TimeSeriesCatalog.timeseries_id == timeseries_id
-    ).one()
+        cache_size = session.query(func.sum(WmlCachePayload.stored_size)).scalar() or 0
+
+        if cache_size > max_bytes:
+            evicted_hashes = []
+            lru_payloads = session.\
+                query(
+                    WmlCachePayload.payload_hash,
+                    WmlCachePayload.stored_size
+                ).order_by(
+                    asc(WmlCachePayload.last_accessed)
+                ).all()
+            for payload_hash, stored_size in lru_payloads:
+                if cache_size <= max_bytes:
+                    break
+                evicted_hashes.append(payload_hash)
+                cache_size -= stored_size or 0
+
+            for i in range(0, len(evicted_hashes), 500):
+                session.execute(
+                    entry_table.delete().where(entry_table.c.payload_hash.in_(evicted_hashes[i:i + 500]))
+                )
+                session.execute(
+                    state_table.delete().where(state_table.c.payload_hash.in_(evicted_hashes[i:i + 500]))
+                )
+                session.execute(
+                    cache_table.delete().where(cache_table.c.payload_hash.in_(evicted_hashes[i:i + 500]))
+                )
+
+
+def get_wml_series_key(url, site_code, variable_code, return_type, service_type):
+    """
+    Builds the key of a series for incremental refresh.
 
-    engine = session.get_bind()
-    session.close()
-    engine.dispose()
+    Unlike the cache key, the series key leaves out the requested dates, so every
+    request for the same series shares it.
+    """
 
-    return filtered_query
+    series_fields = (url, site_code, variable_code, return_type, service_type)
 
+    return hashlib.sha256(
+        "\n".join("" if field is None else str(field) for field in series_fields).encode("utf-8")
+    ).hexdigest()
 
-def update_timeseries_reference(session_id, timeseries_id, status=None, status_details=None,
-        wml_data=None, selected=None, begin_date=None, end_date=None, value_count=None, 
-        sample_medium=None, site_name=None, site_code=None, latitude=None, longitude=None, 
-        variable_name=None, variable_code=None, method_description=None, method_link=None, 
-        network_name=None, ref_type=None, return_type=None, service_type=None, url=None):
+
+def get_wml_series_states(series_keys):
     """
-    Updates values of a timeseries reference.
+    Gets the stored state of a list of series.
 
-    This function can update any parameter for a time series
-    reference in the time series catalog.
+    Returns a dictionary of series keys to rows with the begin date, last value date,
+    and value count of the series and the codec and stored bytes of its last payload.
+    Series without a state, or whose payload has been evicted, are left out.
     """
 
-    Session = app.get_persistent_store_database(
-        "hydroshare_timeseries_manager", 
-        as_sessionmaker=True
-    )
+    series_keys = list(set(series_keys))
+
+    if not series_keys:
+        return {}
+
+    with session_scope() as session:
+        series_states = {}
+        for i in range(0, len(series_keys), 500):
+            state_query = session.\
+                query(
+                    WmlSeriesState.series_key,
+                    WmlSeriesState.begin_date,
+                    WmlSeriesState.last_value_date,
+                    WmlSeriesState.value_count,
+                    WmlCachePayload.codec,
+                    WmlCachePayload.wml_data
+                ).join(
+                    WmlCachePayload, WmlCachePayload.payload_hash == WmlSeriesState.payload_hash
+                ).filter(
+                    WmlSeriesState.series_key.in_(series_keys[i:i + 500])
+                )
+            series_states.update({x.series_key: x for x in state_query.all()})
+
+    return series_states
+
+
+def update_wml_series_states(series_states):
+    """
+    Records the state of prepared series.
 
-    session = Session()
+    Series states is a dictionary of series keys to dictionaries with the begin date,
+    last value date, value count, and uncompressed WaterML of the series. The payload
+    is stored in the WaterML cache by hash, without a request key, in the same
+    transaction as the state. Existing states are replaced.
+    """
 
-    timeseries_reference = session.\
-        query(
-            TimeSeriesCatalog
-        ).filter(
-            and_(
-                TimeSeriesCatalog.session_id == session_id,
-                TimeSeriesCatalog.timeseries_id == timeseries_id
+    if not series_states:
+        return
+
+    now = datetime.datetime.now()
+    state_table = WmlSeriesState.__table__
+    series_keys = list(series_states)
+
+    state_rows = []
+    for series_key, series_state in series_states.items():
+        series_state = dict(series_state)
+        wml_data = series_state.pop("wml_data")
+        state_rows.append(dict(
+            series_state, series_key=series_key, payload_hash=hashlib.sha256(wml_data).hexdigest(), date_updated=now
+        ))
+
+    with session_scope() as session:
+        try:
+            _store_cache_payloads(session, [x["wml_data"] for x in series_states.values()], now)
+            for i in range(0, len(series_keys), 500):
+                session.execute(
+                    state_table.delete().where(state_table.c.series_key.in_(series_keys[i:i + 500]))
+                )
+            session.execute(state_table.insert(), state_rows)
+            session.commit()
+        except IntegrityError:
+            # Another worker recorded the same series at the same time.
+            session.rollback()
+
+
+# ------------------------------------ #
+#   HOST CONCURRENCY LIMIT ACTIONS     #
+# ------------------------------------ #
+
+def get_host_concurrency_limits():
+    """
+    Gets the learned concurrency limits of every WaterOneFlow server.
+
+    Returns a dictionary of hosts to their concurrency limit and typical time to the
+    response headers in seconds.
+    """
+
+    with session_scope() as session:
+        limit_query = session.\
+            query(
+                HostConcurrencyLimit.host,
+                HostConcurrencyLimit.concurrency_limit,
+                HostConcurrencyLimit.latency
             )
-        )
+        host_limits = {x.host: (x.concurrency_limit, x.latency) for x in limit_query.all()}
 
-    if status is not None : timeseries_reference.update({TimeSeriesCatalog.status: status})
-    if status_details is not None : timeseries_reference.update({TimeSeriesCatalog.status_details: status_details})
-    if wml_data is not None : timeseries_reference.update({TimeSeriesCatalog.wml_data: wml_data})
-    if selected is not None : timeseries_reference.update({TimeSeriesCatalog.selected: selected})
-    if begin_date is not None : timeseries_reference.update({TimeSeriesCatalog.begin_date: begin_date})
-    if end_date is not None : timeseries_reference.update({TimeSeriesCatalog.end_date: end_date})
-    if value_count is not None : timeseries_reference.update({TimeSeriesCatalog.value_count: value_count})
-    if sample_medium is not None : timeseries_reference.update({TimeSeriesCatalog.sample_medium: sample_medium})
-    if site_name is not None : timeseries_reference.update({TimeSeriesCatalog.site_name: site_name})
-    if site_code is not None : timeseries_reference.update({TimeSeriesCatalog.site_code: site_code})
-    if latitude is not None : timeseries_reference.update({TimeSeriesCatalog.latitude: latitude})
-    if longitude is not None : timeseries_reference.update({TimeSeriesCatalog.longitude: longitude})
-    if variable_name is not None : timeseries_reference.update({TimeSeriesCatalog.variable_name: variable_name})
-    if variable_code is not None : timeseries_reference.update({TimeSeriesCatalog.variable_code: variable_code})
-    if method_description is not None : timeseries_reference.update({TimeSeriesCatalog.method_description: method_description})
-    if method_link is not None : timeseries_reference.update({TimeSeriesCatalog.method_link: method_link})
-    if network_name is not None : timeseries_reference.update({TimeSeriesCatalog.network_name: network_name})
-    if ref_type is not None : timeseries_reference.update({TimeSeriesCatalog.ref_type: ref_type})
-    if return_type is not None : timeseries_reference.update({TimeSeriesCatalog.return_type: return_type})
-    if service_type is not None : timeseries_reference.update({TimeSeriesCatalog.service_type: service_type})
-    if url is not None : timeseries_reference.update({TimeSeriesCatalog.url: url})
-
-    session.commit()
-
-    engine = session.get_bind()
-    session.close()
-    engine.dispose()
+    return host_limits
 
 
-def get_wml_data(session_id, timeseries_id):
+def update_host_concurrency_limits(host_limits):
     """
-    Gets WaterML data from a timeseries reference.
+    Stores learned concurrency limits.
 
-    This function will retrieve a stored WaterML data object for
-    a timeseries reference.
+    Host limits is a dictionary of hosts to their concurrency limit and typical time to
+    the response headers in seconds. Existing limits for those hosts are replaced.
     """
 
-    Session = app.get_persistent_store_database(
-        "hydroshare_timeseries_manager", 
-        as_sessionmaker=True
-    )
+    if not host_limits:
+        return
+
+    now = datetime.datetime.now()
+    limit_table = HostConcurrencyLimit.__table__
+    hosts = list(host_limits)
+
+    with session_scope() as session:
+        try:
+            session.execute(limit_table.delete().where(limit_table.c.host.in_(hosts)))
+            session.execute(
+                limit_table.insert(),
+                [
+                    {
+                        "host": host,
+                        "concurrency_limit": concurrency_limit,
+                        "latency": latency,
+                        "date_updated": now
+                    } for host, (concurrency_limit, latency) in host_limits.items()
+                ]
+            )
+            session.commit()
+        except IntegrityError:
+            # Another process stored limits for the same hosts at the same time.
+            session.rollback()
 
-    session = Session()
 
-    wml_data = session.\
-        query(
-            TimeSeriesCatalog.wml_data
-        ).filter(
-            and_(
-                TimeSeriesCatalog.session_id == session_id,
-                TimeSeriesCatalog.timeseries_id == timeseries_id
+# ------------------------------- #
+#   DOWNLOAD QUEUE STATS ACTIONS  #
+# ------------------------------- #
+
+def record_download_queue_stats(process_key, queue_stats):
+    """
+    Replaces the download queue stats recorded by a process.
+
+    Queue stats is a dictionary of session IDs to their queued and running downloads
+    and bytes in flight; an empty dictionary clears the process's stats.
+    """
+
+    now = datetime.datetime.now()
+    stats_table = DownloadQueueStats.__table__
+
+    with session_scope() as session:
+        session.execute(stats_table.delete().where(stats_table.c.process_key == process_key))
+        if queue_stats:
+            session.execute(
+                stats_table.insert(),
+                [
+                    dict(session_stats, process_key=process_key, session_id=session_id, date_updated=now)
+                    for session_id, session_stats in queue_stats.items()
+                ]
             )
-        ).one()
 
-    engine = session.get_bind()
-    session.close()
-    engine.dispose()
 
-    return wml_data
+def get_recorded_download_queue_stats(session_id, max_age_seconds):
+    """
+    Gets the downloads of a session queued and running across all processes.
+
+    Stats not updated within max_age_seconds are ignored, since the process that
+    recorded them has stopped.
+    """
+
+    with session_scope() as session:
+        stats = session.\
+            query(
+                func.coalesce(func.sum(DownloadQueueStats.queued), 0),
+                func.coalesce(func.sum(DownloadQueueStats.in_flight), 0),
+                func.coalesce(func.sum(DownloadQueueStats.bytes_in_flight), 0)
+            ).filter(
+                and_(
+                    DownloadQueueStats.session_id == session_id,
+                    DownloadQueueStats.date_updated >=
+                    datetime.datetime.now() - datetime.timedelta(seconds=max_age_seconds)
+                )
+            ).one()
 
+    return {"queued": int(stats[0]), "in_flight": int(stats[1]), "bytes_in_flight": int(stats[2])}
 
-def get_resource_metadata(session_id):
+
+# ------------------------------ #
+#   PENDING TIMESERIES ACTIONS   #
+# ------------------------------ #
+
+def add_pending_timeseries(session_id, refts_id, timeseries_id):
     """
 
     """
 
-    Session = app.get_persistent_store_database(
-        "hydroshare_timeseries_manager", 
-        as_sessionmaker=True
-    )
+    with session_scope() as session:
+        new_pending_timeseries = PendingTimeSeries(
+            session_id=session_id,
+            refts_id=refts_id,
+            timeseries_id=timeseries_id
+        )
 
-    session = Session()
+        session.add(new_pending_timeseries)
 
-    site_query = session.\
-        query(
-            TimeSeriesCatalog.site_name
-        ).filter(
-            and_(
-                TimeSeriesCatalog.session_id == session_id,
-                TimeSeriesCatalog.selected == True,
-                TimeSeriesCatalog.status == "Ready"
-            )
-        ).distinct()
+def add_pending_timeseries_list(session_id, refts_id, timeseries_ids):
+    """
+    Adds many timeseries to the pending queue in one statement.
+    """
 
-    site_names = site_query.limit(5).all()
-    site_count = site_query.count()
+    if not timeseries_ids:
+        return
+
+    with session_scope() as session:
+        session.execute(
+            PendingTimeSeries.__table__.insert(),
+            [
+                {
+                    "session_id": session_id,
+                    "refts_id": refts_id,
+                    "timeseries_id": timeseries_id,
+                    "attempts": 0,
+                    "priority": PRIORITY_DEFAULT
+                } for timeseries_id in timeseries_ids
+            ]
+        )
 
-    variable_query = session.\
-        query(
-            TimeSeriesCatalog.variable_name
-        ).filter(
-            and_(
-                TimeSeriesCatalog.session_id == session_id,
-                TimeSeriesCatalog.selected == True,
-                TimeSeriesCatalog.status == "Ready"
-            )
-        ).distinct()
+def get_pending_timeseries(session_id, refts_id):
+    """
 
-    variable_names = variable_query.limit(5).all()
-    variable_count = variable_query.count()
+    """
 
-    sample_medium_query = session.\
-        query(
-            TimeSeriesCatalog.sample_medium
-        ).filter(
-            and_(
-                TimeSeriesCatalog.session_id == session_id,
-                TimeSeriesCatalog.selected == True,
-                TimeSeriesCatalog.status == "Ready"
-            )
-        ).distinct()
+    with session_scope() as session:
+        pending_timeseries = session.\
+            query(
+                PendingTimeSeries.timeseries_id
+            ).filter(
+                and_(
+                    PendingTimeSeries.session_id == session_id,
+                    PendingTimeSeries.refts_id == refts_id
+                )
+            ).all()
 
-    sample_mediums = sample_medium_query.limit(5).all()
+    return pending_timeseries
 
-    start_date = session.\
-        query(
-            TimeSeriesCatalog.begin_date
-        ).filter(
-            and_(
-                TimeSeriesCatalog.session_id == session_id,
-                TimeSeriesCatalog.selected == True,
-                TimeSeriesCatalog.status == "Ready"
-            )
-        ).order_by(TimeSeriesCatalog.begin_date.asc()).first()
+def remove_pending_timeseries(session_id, refts_id):
+    """
 
-    end_date = session.\
-        query(
-            TimeSeriesCatalog.end_date
-        ).filter(
-            and_(
-                TimeSeriesCatalog.session_id == session_id,
-                TimeSeriesCatalog.selected == True,
-                TimeSeriesCatalog.status == "Ready"
-            )
-        ).order_by(TimeSeriesCatalog.begin_date.desc()).first()
+    """
 
-    invalid_selected_count = session.\
-        query(
-            TimeSeriesCatalog
-        ).filter(
-            and_(
-                TimeSeriesCatalog.session_id == session_id,
-                TimeSeriesCatalog.selected == True,
-                TimeSeriesCatalog.status != "Ready"
+    with session_scope() as session:
+        pending_timeseries = session.\
+            query(
+                PendingTimeSeries.timeseries_id
+            ).filter(
+                and_(
+                    PendingTimeSeries.session_id == session_id,
+                    PendingTimeSeries.refts_id == refts_id
+                )
             )
-        ).count()
-
-    engine = session.get_bind()
-    session.close()
-    engine.dispose()
 
-    return site_names, site_count, variable_names, variable_count, sample_mediums, start_date, end_date, invalid_selected_count
+        pending_timeseries.delete()
 
 
-def get_refts(session_id):
+def count_pending_timeseries(session_id, refts_id):
+    """
+    Counts the pending timeseries of a REFTS import, including claimed ones.
     """
 
+    with session_scope() as session:
+        pending_count = session.\
+            query(
+                func.count(PendingTimeSeries.id)
+            ).filter(
+                and_(
+                    PendingTimeSeries.session_id == session_id,
+                    PendingTimeSeries.refts_id == refts_id
+                )
+            ).scalar()
+
+    return pending_count
+
+
+def claim_pending_timeseries(session_id, refts_id, limit, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Atomically claims a batch of pending timeseries.
+
+    Unclaimed rows and rows whose lease has expired are leased to a new token for
+    lease_seconds. On PostgreSQL the candidate rows are locked with FOR UPDATE SKIP
+    LOCKED, so concurrent workers claim different rows without waiting on each other.
+    SQLite serializes writers, so the same single UPDATE is atomic there. Rows are
+    claimed in priority order, then in the order they were queued. Rows that have
+    already been claimed MAX_CLAIM_ATTEMPTS times are not claimed again; see
+    fail_abandoned_pending_timeseries. Returns the lease token and the claimed
+    timeseries IDs, highest priority first.
     """
 
-    Session = app.get_persistent_store_database(
-        "hydroshare_timeseries_manager", 
-        as_sessionmaker=True
+    table = PendingTimeSeries.__table__
+    lease_token = str(uuid.uuid4())
+    now = datetime.datetime.now()
+
+    claimable = and_(
+        table.c.session_id == session_id,
+        table.c.refts_id == refts_id,
+        or_(table.c.lease_expires == None, table.c.lease_expires < now),
+        func.coalesce(table.c.attempts, 0) < MAX_CLAIM_ATTEMPTS
     )
 
-    session = Session()
+    with session_scope() as session:
+        candidates = select([table.c.id]).where(claimable).order_by(
+            desc(func.coalesce(table.c.priority, PRIORITY_DEFAULT)), table.c.id
+        ).limit(limit)
+        if session.bind.dialect.name == "postgresql":
+            candidates = candidates.with_for_update(skip_locked=True)
+
+        session.execute(
+            table.update().where(
+                and_(
+                    table.c.id.in_(candidates),
+                    claimable
+                )
+            ).values(
+                lease_token=lease_token,
+                lease_expires=now + datetime.timedelta(seconds=lease_seconds),
+                attempts=func.coalesce(table.c.attempts, 0) + 1
+            )
+        )
 
-    refts = session.\
-        query(
-            TimeSeriesCatalog.site_name,
-            TimeSeriesCatalog.site_code,
-            TimeSeriesCatalog.latitude,
-            TimeSeriesCatalog.longitude,
-            TimeSeriesCatalog.variable_name,
-            TimeSeriesCatalog.variable_code,
-            TimeSeriesCatalog.sample_medium,
-            TimeSeriesCatalog.begin_date,
-            TimeSeriesCatalog.end_date,
-            TimeSeriesCatalog.value_count,
-            TimeSeriesCatalog.method_link,
-            TimeSeriesCatalog.method_description,
-            TimeSeriesCatalog.network_name,
-            TimeSeriesCatalog.url,
-            TimeSeriesCatalog.service_type,
-            TimeSeriesCatalog.ref_type,
-            TimeSeriesCatalog.return_type
-        ).filter(
-            and_(
-                TimeSeriesCatalog.session_id == session_id,
-                TimeSeriesCatalog.selected == True
+        claimed_query = session.\
+            query(
+                PendingTimeSeries.timeseries_id
+            ).filter(
+                PendingTimeSeries.lease_token == lease_token
+            ).order_by(
+                desc(func.coalesce(PendingTimeSeries.priority, PRIORITY_DEFAULT)),
+                PendingTimeSeries.id
             )
-        ).all()
+        timeseries_ids = [x[0] for x in claimed_query.all()]
 
-    engine = session.get_bind()
-    session.close()
-    engine.dispose()
+    return lease_token, timeseries_ids
 
-    return refts
 
+def prioritize_visible_timeseries(session_id, timeseries_ids):
+    """
+    Moves the pending timeseries a user is looking at to the front of the queue.
+
+    The timeseries on the current page of the table get the visible priority. Pending
+    timeseries that were on an earlier page drop back to the selected priority if they
+    are selected and to the default priority otherwise. Rows already claimed by a
+    worker keep their place in its batch. The table polls this on every refresh, so
+    the pending rows involved are read first and nothing is written unless their
+    priorities change.
+    """
 
+    table = PendingTimeSeries.__table__
+    timeseries_ids = set(timeseries_ids)
 
-# ------------------------------ #
-#   PENDING TIMESERIES ACTIONS   #
-# ------------------------------ #
+    with session_scope() as session:
+        involved = table.c.priority == PRIORITY_VISIBLE
+        if timeseries_ids:
+            involved = or_(involved, table.c.timeseries_id.in_(timeseries_ids))
 
-def add_pending_timeseries(session_id, refts_id, timeseries_id):
+        pending_rows = session.execute(
+            select([table.c.timeseries_id, table.c.priority]).where(
+                and_(
+                    table.c.session_id == session_id,
+                    involved
+                )
+            )
+        ).fetchall()
+
+        hidden_ids = {x[0] for x in pending_rows if x[1] == PRIORITY_VISIBLE and x[0] not in timeseries_ids}
+        visible_ids = {x[0] for x in pending_rows if x[1] != PRIORITY_VISIBLE and x[0] in timeseries_ids}
+
+        if not hidden_ids and not visible_ids:
+            return
+
+        if hidden_ids:
+            session.execute(
+                table.update().where(
+                    and_(
+                        table.c.session_id == session_id,
+                        table.c.priority == PRIORITY_VISIBLE,
+                        table.c.timeseries_id.in_(hidden_ids)
+                    )
+                ).values(
+                    priority=case(
+                        [(table.c.timeseries_id.in_(_selected_timeseries_ids(session_id)), PRIORITY_SELECTED)],
+                        else_=PRIORITY_DEFAULT
+                    )
+                )
+            )
+
+        if visible_ids:
+            session.execute(
+                table.update().where(
+                    and_(
+                        table.c.session_id == session_id,
+                        table.c.timeseries_id.in_(visible_ids)
+                    )
+                ).values(
+                    priority=PRIORITY_VISIBLE
+                )
+            )
+
+
+def prioritize_selected_timeseries(session_id):
     """
+    Moves the selected pending timeseries of a session ahead of unselected ones.
 
+    Used after the selection changes. Timeseries on the current page keep the visible
+    priority. The selection changes on every click, so only the pending rows whose
+    priority no longer matches their selection are written.
     """
 
-    Session = app.get_persistent_store_database(
-        "hydroshare_timeseries_manager", 
-        as_sessionmaker=True
-    )
+    table = PendingTimeSeries.__table__
+
+    with session_scope() as session:
+        selected = table.c.timeseries_id.in_(_selected_timeseries_ids(session_id))
+
+        session.execute(
+            table.update().where(
+                and_(
+                    table.c.session_id == session_id,
+                    or_(
+                        and_(func.coalesce(table.c.priority, PRIORITY_DEFAULT) == PRIORITY_DEFAULT, selected),
+                        and_(table.c.priority == PRIORITY_SELECTED, not_(selected))
+                    )
+                )
+            ).values(
+                priority=case([(selected, PRIORITY_SELECTED)], else_=PRIORITY_DEFAULT)
+            )
+        )
 
-    session = Session()
 
-    new_pending_timeseries = PendingTimeSeries(
-        session_id=session_id,
-        refts_id=refts_id,
-        timeseries_id=timeseries_id
-    )
+def _selected_timeseries_ids(session_id):
+    """
+    Builds a subquery of the selected timeseries IDs of a session.
+    """
 
-    session.add(new_pending_timeseries)
+    catalog_table = TimeSeriesCatalog.__table__
 
-    session.commit()
+    return select([catalog_table.c.timeseries_id]).where(
+        and_(
+            catalog_table.c.session_id == session_id,
+            catalog_table.c.selected == True,
+            catalog_table.c.timeseries_id.isnot(None)
+        )
+    )
 
-    engine = session.get_bind()
-    session.close()
-    engine.dispose()
 
-def get_pending_timeseries(session_id, refts_id):
+def renew_pending_lease(lease_token, lease_seconds=DEFAULT_LEASE_SECONDS):
     """
+    Extends the lease of a batch of claimed timeseries.
 
+    Workers call this periodically while they process a batch. Returns the number of
+    rows still held by the lease; zero means the lease was lost.
     """
 
-    Session = app.get_persistent_store_database(
-        "hydroshare_timeseries_manager", 
-        as_sessionmaker=True
-    )
-
-    session = Session()
+    table = PendingTimeSeries.__table__
 
-    pending_timeseries = session.\
-        query(
-            PendingTimeSeries.timeseries_id
-        ).filter(
-            and_(
-                PendingTimeSeries.session_id == session_id,
-                PendingTimeSeries.refts_id == refts_id
+    with session_scope() as session:
+        result = session.execute(
+            table.update().where(
+                table.c.lease_token == lease_token
+            ).values(
+                lease_expires=datetime.datetime.now() + datetime.timedelta(seconds=lease_seconds)
             )
-        ).all()
-
-    session.commit()
+        )
 
-    engine = session.get_bind()
-    session.close()
-    engine.dispose()
+    return result.rowcount
 
-    return pending_timeseries
 
-def remove_pending_timeseries(session_id, refts_id):
+def complete_pending_timeseries(lease_token):
     """
-
+    Removes a batch of claimed timeseries from the queue once they are processed.
     """
 
-    Session = app.get_persistent_store_database(
-        "hydroshare_timeseries_manager", 
-        as_sessionmaker=True
-    )
+    table = PendingTimeSeries.__table__
 
-    session = Session()
+    with session_scope() as session:
+        session.execute(
+            table.delete().where(table.c.lease_token == lease_token)
+        )
 
-    pending_timeseries = session.\
-        query(
-            PendingTimeSeries.timeseries_id
-        ).filter(
-            and_(
-                PendingTimeSeries.session_id == session_id,
-                PendingTimeSeries.refts_id == refts_id
+
+def release_pending_timeseries(lease_token):
+    """
+    Returns a batch of claimed timeseries to the queue so another worker can claim it.
+    """
+
+    table = PendingTimeSeries.__table__
+
+    with session_scope() as session:
+        session.execute(
+            table.update().where(
+                table.c.lease_token == lease_token
+            ).values(
+                lease_token=None,
+                lease_expires=None
             )
         )
 
-    pending_timeseries.delete()
 
-    session.commit()
+def fail_abandoned_pending_timeseries(session_id, refts_id):
+    """
+    Fails pending timeseries whose leases have expired too many times.
+
+    A timeseries that keeps crashing or stalling its worker would otherwise be
+    requeued forever. Once it has been claimed MAX_CLAIM_ATTEMPTS times and its last
+    lease has expired or been released, it is marked Failed in the catalog and removed from the queue.
+    Returns the number of timeseries failed.
+    """
+
+    pending_table = PendingTimeSeries.__table__
+    catalog_table = TimeSeriesCatalog.__table__
 
-    engine = session.get_bind()
-    session.close()
-    engine.dispose()
+    abandoned = and_(
+        pending_table.c.session_id == session_id,
+        pending_table.c.refts_id == refts_id,
+        or_(pending_table.c.lease_expires == None, pending_table.c.lease_expires < datetime.datetime.now()),
+        func.coalesce(pending_table.c.attempts, 0) >= MAX_CLAIM_ATTEMPTS
+    )
 
+    with session_scope() as session:
+        abandoned_ids = [
+            x[0] for x in session.execute(select([pending_table.c.timeseries_id]).where(abandoned)).fetchall()
+        ]
+
+        if abandoned_ids:
+            session.execute(
+                catalog_table.update().where(
+                    and_(
+                        catalog_table.c.session_id == session_id,
+                        catalog_table.c.timeseries_id.in_(abandoned_ids)
+                    )
+                ).values(
+                    status="Failed",
+                    status_details=f"Processing did not finish after {MAX_CLAIM_ATTEMPTS} attempts"
+                )
+            )
+            session.execute(pending_table.delete().where(abandoned))
 
+    return len(abandoned_ids)
@@ -0,0 +1,87 @@
+import io
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+ZSTD_LEVEL = 6
+GZIP_LEVEL = 6
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def get_default_codec():
+    """
+    Gets the codec used for new payloads.
+
+    Payloads are compressed with zstd when the zstandard package is installed, and
+    with gzip otherwise.
+    """
+
+    return "zstd" if zstandard is not None else "gzip"
+
+
+def encode_payload(data, codec=None):
+    """
+    Compresses a WaterML payload.
+
+    Returns a tuple of the codec name and the encoded bytes.
+    """
+
+    codec = codec or get_default_codec()
+
+    if codec == "zstd":
+        encoded_data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    elif codec == "gzip":
+        encoded_data = gzip.compress(data, compresslevel=GZIP_LEVEL)
+    elif codec == "identity":
+        encoded_data = data
+    else:
+        raise ValueError(f"Unknown payload codec: {codec}")
+
+    return codec, encoded_data
+
+
+def decode_payload(codec, encoded_data):
+    """
+    Decompresses a stored WaterML payload into bytes.
+    """
+
+    if encoded_data is None:
+        return None
+
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("The zstandard package is required to read zstd payloads.")
+        return zstandard.ZstdDecompressor().decompress(encoded_data)
+    elif codec == "gzip":
+        return gzip.decompress(encoded_data)
+    elif codec in ("identity", None):
+        return bytes(encoded_data)
+    else:
+        raise ValueError(f"Unknown payload codec: {codec}")
+
+
+def open_payload_stream(codec, encoded_data):
+    """
+    Opens a stored WaterML payload as a decompressing file-like object.
+
+    Readers such as lxml's parser can consume the stream incrementally, so the full
+    decompressed payload never has to be held in memory at once. Payloads stored
+    without a codec are treated as uncompressed.
+    """
+
+    encoded_stream = io.BytesIO(encoded_data)
+
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("The zstandard package is required to read zstd payloads.")
+        return zstandard.ZstdDecompressor().stream_reader(encoded_stream, read_size=STREAM_CHUNK_SIZE)
+    elif codec == "gzip":
+        return gzip.GzipFile(fileobj=encoded_stream, mode="rb")
+    elif codec in ("identity", None):
+        return encoded_stream
+    else:
+        raise ValueError(f"Unknown payload codec: {codec}")
@@ -9,6 +9,14 @@
     var dataTable;
     var dtState;
     var recordsSelected;
+    var activeJobs = {};
+    var pageState = {
+        'search': null,
+        'length': null,
+        'order': null,
+        'start': 0,
+        'anchors': {}
+    };
 
     /*****************************************************************************************
      ************************************** FUNCTIONS ****************************************
@@ -31,11 +39,25 @@
                 'headers': {
                     'X-CSRFToken': getCookie('csrftoken')
                 },
-                'data': {
-                    'session-id': $('#session-id').text()
+                'data': function(data) {
+                    data['session-id'] = $('#session-id').text();
+                    var order = JSON.stringify(data.order);
+                    if (pageState.search !== data.search.value || pageState.length !== data.length || pageState.order !== order) {
+                        resetPageAnchors();
+                        pageState.search = data.search.value;
+                        pageState.length = data.length;
+                        pageState.order = order;
+                    };
+                    if (data.start in pageState.anchors) {
+                        data['seek-after'] = pageState.anchors[data.start];
+                    };
+                    pageState.start = data.start;
                 },
                 'dataSrc': function(json) {
                     recordsSelected = json.recordsSelected
+                    if (json.data.length === pageState.length) {
+                        pageState.anchors[pageState.start + pageState.length] = json.data[json.data.length - 1][19];
+                    };
                     for (var i = 0; i < json.data.length; i++) {
                         switch (json.data[i][0]) {
                             case 'Waiting':
@@ -113,6 +135,9 @@
                 <button id="btn-remove-selected" type="button" class="btn btn-primary">
                     <span class="glyphicon tool-glyph glyphicon-trash"></span>
                 </button>
+                <button id="btn-refresh-selected" type="button" class="btn btn-primary">
+                    <span class="glyphicon tool-glyph glyphicon-refresh"></span>
+                </button>
             </div>
             <button id="btn-create-resource" class="btn btn-success" type="button">Create Resource</button>
             <div class="loading-bar"></div>
@@ -131,6 +156,11 @@
         //loginTest();
     };
 
+    /* Forgets the last row of each page, which the next page seeks past instead of using an offset */
+    function resetPageAnchors() {
+        pageState.anchors = {};
+    };
+
     function updateTable() {
         dtState = {
             'top': $(dataTable.settings()[0].nScrollBody).scrollTop(),
@@ -195,6 +225,7 @@
             },
             url: '/apps/hydroshare-timeseries-manager/ajax/remove-timeseries/',
             success: function(response) {
+                resetPageAnchors();
                 updateTable();
             },
             error: function(response) {
@@ -203,6 +234,14 @@
         });
     };
 
+    function refreshSelectedRows() {
+        if (!(recordsSelected > 0)) {
+            alert('Please select at least one time series.');
+            return;
+        };
+        prepareSessionData(null, true);
+    };
+
     function addDataToSession(resourceId, aggregationId, reftsJson) {
         $.ajax({
             headers: {
@@ -217,6 +256,7 @@
             },
             url: '/apps/hydroshare-timeseries-manager/ajax/add-session-data/',
             success: function(response) {
+                resetPageAnchors();
                 updateTable();
                 if (response['success'] === true && response['refts_id'] !== null) {
                     prepareSessionData(response['refts_id']);
@@ -228,7 +268,7 @@
         });
     };
 
-    function prepareSessionData(reftsId) {
+    function prepareSessionData(reftsId, refresh) {
         $.ajax({
             headers: {
                 'X-CSRFToken': getCookie('csrftoken')
@@ -236,11 +276,17 @@
             type: 'POST',
             data: {
                 'sessionId': $('#session-id').text(),
-                'reftsId': reftsId
+                'reftsId': reftsId,
+                'refresh': refresh === true
             },
             url: '/apps/hydroshare-timeseries-manager/ajax/prepare-session-data/',
             success: function(response) {
-
+                if (response['success'] === true) {
+                    updateTable();
+                    checkJobProgress(response['job_id']);
+                } else if (response['message']) {
+                    alert(response['message']);
+                };
             },
             error: function(response) {
 
@@ -248,6 +294,59 @@
         });
     };
 
+    function checkJobProgress(jobId) {
+        $.ajax({
+            headers: {
+                'X-CSRFToken': getCookie('csrftoken')
+            },
+            type: 'POST',
+            data: {
+                'sessionId': $('#session-id').text(),
+                'jobId': jobId
+            },
+            url: '/apps/hydroshare-timeseries-manager/ajax/job-progress/',
+            success: function(response) {
+                if (response['success'] !== true) {
+                    delete activeJobs[jobId];
+                    updateLoadingBar();
+                    return;
+                };
+                var progress = response['progress'];
+                activeJobs[jobId] = progress;
+                if (progress['status'] === 'Complete' || progress['status'] === 'Failed') {
+                    delete activeJobs[jobId];
+                    updateTable();
+                } else {
+                    window.setTimeout(function() {
+                        checkJobProgress(jobId);
+                    }, 3000);
+                };
+                updateLoadingBar();
+            },
+            error: function(response) {
+                window.setTimeout(function() {
+                    checkJobProgress(jobId);
+                }, 3000);
+            }
+        });
+    };
+
+    function updateLoadingBar() {
+        var jobs = Object.values(activeJobs);
+        if (jobs.length === 0) {
+            $('.loading-bar').html('');
+            return;
+        };
+        var total = jobs.reduce((sum, job) => sum + job['total'], 0);
+        var completed = jobs.reduce((sum, job) => sum + job['completed'], 0);
+        var etas = jobs.map(job => job['eta']).filter(eta => eta !== null);
+        var eta = (etas.length === jobs.length) ? ` (about ${Math.ceil(Math.max(...etas))}s left)` : '';
+        $('.loading-bar').html(`
+            <img class="status-icon" src="/static/hydroshare_timeseries_manager/images/spinner.gif">
+            <div>Preparing ${completed} of ${total} time series${eta}</div>
+        `);
+    };
+
     function updateResourceMetadata() {
         $('#create-res-message').val('');
         $('#res-title').val('');
@@ -728,6 +827,9 @@
     /* Listener for removing all selected data in table */
     $(document).on('click', '#btn-remove-selected', removeSelectedRows);
 
+    /* Listener for refreshing all selected data in table */
+    $(document).on('click', '#btn-refresh-selected', refreshSelectedRows);
+
     /* Listener for updating default resource metadata */
     $(document).on('click', '#btn-create-resource', updateResourceMetadata);
 
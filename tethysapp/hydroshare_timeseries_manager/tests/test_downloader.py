@@ -0,0 +1,300 @@
+"""
+Unit tests for the download engine helpers that do not need a network or database.
+
+To run these tests:
+    Test command: "tethys test -f tethys_apps.tethysapp.hydroshare_timeseries_manager.tests.test_downloader"
+"""
+
+import time
+import asyncio
+import email.utils
+import unittest
+from unittest import mock
+from ..downloader import CircuitBreaker, CircuitOpenError, FairScheduler, AdaptiveConcurrencyLimit, \
+                         parse_retry_after
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("tethysapp.hydroshare_timeseries_manager.downloader.time.monotonic",
+                             side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.circuit_breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+
+    def open_circuit(self):
+        for _ in range(3):
+            self.circuit_breaker.before_request()
+            self.circuit_breaker.record_failure()
+
+    def test_stays_closed_below_threshold(self):
+        for _ in range(2):
+            self.circuit_breaker.record_failure()
+        self.circuit_breaker.before_request()
+        self.assertIsNone(self.circuit_breaker.opened_at)
+
+    def test_success_resets_failure_count(self):
+        self.circuit_breaker.record_failure()
+        self.circuit_breaker.record_failure()
+        self.circuit_breaker.record_success()
+        self.circuit_breaker.record_failure()
+        self.circuit_breaker.before_request()
+        self.assertEqual(self.circuit_breaker.failure_count, 1)
+
+    def test_opens_at_threshold(self):
+        self.open_circuit()
+        with self.assertRaises(CircuitOpenError):
+            self.circuit_breaker.before_request()
+
+    def test_lets_one_trial_through_after_reset_timeout(self):
+        self.open_circuit()
+        self.now += 30
+        self.circuit_breaker.before_request()
+        with self.assertRaises(CircuitOpenError):
+            self.circuit_breaker.before_request()
+
+    def test_successful_trial_closes_circuit(self):
+        self.open_circuit()
+        self.now += 30
+        self.circuit_breaker.before_request()
+        self.circuit_breaker.record_success()
+        self.circuit_breaker.before_request()
+        self.circuit_breaker.before_request()
+        self.assertIsNone(self.circuit_breaker.opened_at)
+
+    def test_failed_trial_reopens_circuit(self):
+        self.open_circuit()
+        self.now += 30
+        trial = self.circuit_breaker.before_request()
+        self.assertTrue(trial)
+        self.circuit_breaker.record_failure(trial)
+        with self.assertRaises(CircuitOpenError):
+            self.circuit_breaker.before_request()
+        self.now += 30
+        self.circuit_breaker.before_request()
+
+    def test_late_failures_do_not_delay_trial(self):
+        self.open_circuit()
+        self.now += 20
+        self.circuit_breaker.record_failure()
+        self.circuit_breaker.record_failure()
+        self.now += 10
+        self.assertTrue(self.circuit_breaker.before_request())
+
+    def test_check_does_not_claim_trial(self):
+        self.open_circuit()
+        with self.assertRaises(CircuitOpenError):
+            self.circuit_breaker.check()
+        self.now += 30
+        self.circuit_breaker.check()
+        self.circuit_breaker.check()
+        self.assertTrue(self.circuit_breaker.before_request())
+        with self.assertRaises(CircuitOpenError):
+            self.circuit_breaker.check()
+
+    def test_released_trial_lets_another_through(self):
+        self.open_circuit()
+        self.now += 30
+        self.circuit_breaker.before_request()
+        self.circuit_breaker.release_trial()
+        self.circuit_breaker.before_request()
+
+
+class FairSchedulerTestCase(unittest.TestCase):
+
+    @staticmethod
+    def queue_downloads(scheduler, session_key, count, granted):
+
+        async def acquire():
+            await scheduler.acquire(session_key)
+            granted.append(session_key)
+
+        return [asyncio.ensure_future(acquire()) for _ in range(count)]
+
+    def test_sessions_take_turns(self):
+
+        async def run():
+            scheduler = FairScheduler(slots=1, session_max_requests=10, session_max_bytes=1024)
+            granted = []
+            self.queue_downloads(scheduler, "large", 10, granted)
+            await asyncio.sleep(0)
+            self.queue_downloads(scheduler, "small", 3, granted)
+            await asyncio.sleep(0)
+            for _ in range(12):
+                scheduler.release(granted[-1])
+                await asyncio.sleep(0)
+            return granted
+
+        granted = asyncio.run(run())
+        self.assertEqual(granted[:7], ["large", "large", "small", "large", "small", "large", "small"])
+        self.assertEqual(len(granted), 13)
+
+    def test_session_request_cap(self):
+
+        async def run():
+            scheduler = FairScheduler(slots=10, session_max_requests=2, session_max_bytes=1024)
+            granted = []
+            self.queue_downloads(scheduler, "a", 5, granted)
+            self.queue_downloads(scheduler, "b", 1, granted)
+            await asyncio.sleep(0)
+            return scheduler.get_stats(), granted
+
+        stats, granted = asyncio.run(run())
+        self.assertEqual(sorted(granted), ["a", "a", "b"])
+        self.assertEqual(stats["a"], {"queued": 3, "in_flight": 2, "bytes_in_flight": 0})
+
+    def test_session_byte_cap(self):
+
+        async def run():
+            scheduler = FairScheduler(slots=10, session_max_requests=10, session_max_bytes=1024)
+            granted = []
+            session_queue = scheduler.get_session_queue("a")
+            session_queue.hold(1024)
+            self.queue_downloads(scheduler, "a", 2, granted)
+            await asyncio.sleep(0)
+            self.assertEqual(granted, [])
+            session_queue.release(1024)
+            await asyncio.sleep(0)
+            return granted
+
+        self.assertEqual(asyncio.run(run()), ["a", "a"])
+
+    def test_cancelled_download_leaves_queue(self):
+
+        async def run():
+            scheduler = FairScheduler(slots=1, session_max_requests=10, session_max_bytes=1024)
+            granted = []
+            tasks = self.queue_downloads(scheduler, "a", 2, granted)
+            await asyncio.sleep(0)
+            tasks[1].cancel()
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.get_stats()["a"]["queued"], 0)
+            scheduler.release("a")
+            return scheduler
+
+        self.assertEqual(asyncio.run(run()).get_stats(), {})
+
+    def test_idle_sessions_are_removed(self):
+
+        async def run():
+            scheduler = FairScheduler(slots=2, session_max_requests=10, session_max_bytes=1024)
+            granted = []
+            self.queue_downloads(scheduler, "a", 2, granted)
+            await asyncio.sleep(0)
+            scheduler.release("a")
+            scheduler.release("a")
+            return scheduler
+
+        scheduler = asyncio.run(run())
+        self.assertEqual(scheduler.get_stats(), {})
+        self.assertEqual(scheduler.in_use, 0)
+
+
+class AdaptiveConcurrencyLimitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("tethysapp.hydroshare_timeseries_manager.downloader.time.monotonic",
+                             side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_initial_limit_is_clamped(self):
+        self.assertEqual(AdaptiveConcurrencyLimit(0, 10).limit, 1.0)
+        self.assertEqual(AdaptiveConcurrencyLimit(50, 10).limit, 10.0)
+
+    def test_success_raises_limit_by_one_per_round(self):
+        host_limit = AdaptiveConcurrencyLimit(4, 50)
+        for _ in range(4):
+            host_limit.record_success(0.1)
+        self.assertAlmostEqual(host_limit.limit, 4.9, delta=0.1)
+
+    def test_limit_does_not_exceed_maximum(self):
+        host_limit = AdaptiveConcurrencyLimit(5, 5)
+        host_limit.record_success(0.1)
+        self.assertEqual(host_limit.limit, 5.0)
+
+    def test_failure_halves_limit(self):
+        host_limit = AdaptiveConcurrencyLimit(8, 50)
+        host_limit.record_failure()
+        self.assertEqual(host_limit.limit, 4.0)
+
+    def test_limit_does_not_drop_below_one(self):
+        host_limit = AdaptiveConcurrencyLimit(1, 50)
+        host_limit.record_failure()
+        self.assertEqual(host_limit.limit, 1.0)
+
+    def test_burst_of_failures_decreases_once(self):
+        host_limit = AdaptiveConcurrencyLimit(8, 50, latency=2.0)
+        for _ in range(5):
+            host_limit.record_failure()
+        self.assertEqual(host_limit.limit, 4.0)
+        self.now += 2.0
+        host_limit.record_failure()
+        self.assertEqual(host_limit.limit, 2.0)
+
+    def test_slow_response_decreases_limit(self):
+        host_limit = AdaptiveConcurrencyLimit(8, 50, latency=0.1)
+        host_limit.record_success(1.0)
+        self.assertEqual(host_limit.limit, 4.0)
+
+    def test_latency_is_smoothed(self):
+        host_limit = AdaptiveConcurrencyLimit(8, 50)
+        host_limit.record_success(1.0)
+        self.assertEqual(host_limit.latency, 1.0)
+        host_limit.record_success(2.0)
+        self.assertAlmostEqual(host_limit.latency, 1.2)
+
+    def test_acquire_waits_for_release(self):
+
+        async def run():
+            host_limit = AdaptiveConcurrencyLimit(2, 50)
+            await host_limit.acquire()
+            await host_limit.acquire()
+            waiter = asyncio.ensure_future(host_limit.acquire())
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            host_limit.release()
+            await asyncio.wait_for(waiter, 1)
+            self.assertEqual(host_limit.in_flight, 2)
+
+        asyncio.run(run())
+
+    def test_raised_limit_wakes_waiters(self):
+
+        async def run():
+            host_limit = AdaptiveConcurrencyLimit(1, 50)
+            await host_limit.acquire()
+            waiter = asyncio.ensure_future(host_limit.acquire())
+            await asyncio.sleep(0)
+            host_limit.record_success(0.1)
+            await asyncio.wait_for(waiter, 1)
+            self.assertEqual(host_limit.in_flight, 2)
+
+        asyncio.run(run())
+
+
+class ParseRetryAfterTestCase(unittest.TestCase):
+
+    def test_missing(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after(""))
+
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after("120"), 120.0)
+        self.assertEqual(parse_retry_after("1.5"), 1.5)
+
+    def test_negative_seconds(self):
+        self.assertEqual(parse_retry_after("-5"), 0.0)
+
+    def test_http_date(self):
+        retry_after = parse_retry_after(email.utils.formatdate(time.time() + 60, usegmt=True))
+        self.assertAlmostEqual(retry_after, 60, delta=2)
+
+    def test_past_http_date(self):
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0.0)
+
+    def test_invalid(self):
+        self.assertIsNone(parse_retry_after("soon"))
@@ -0,0 +1,212 @@
+"""
+Tests for the prepare jobs against a temporary SQLite database, with downloads and
+validation replaced by fakes.
+
+To run these tests:
+    Test command: "tethys test -f tethys_apps.tethysapp.hydroshare_timeseries_manager.tests.test_jobs"
+"""
+
+import os
+import datetime
+import tempfile
+import unittest
+import urllib.parse
+from unittest import mock
+from concurrent.futures import Future, ThreadPoolExecutor
+from .. import jobs
+from ..model import configure_engine, init_hydroshare_timeseries_manager_db, add_timeseries_references, \
+                    get_timeseries_request_data, get_wml_data, get_wml_series_states, get_wml_series_key, \
+                    add_prepare_job, get_prepare_job, add_pending_timeseries_list, count_pending_timeseries, \
+                    session_scope, TimeSeriesCatalog
+from ..payload_codec import decode_payload
+
+
+SESSION_ID = "session"
+URL = "http://his.example.com/rest/"
+
+
+def summarize_values(wml_data):
+    """
+    Prepares a fake WaterML payload, a comma separated list of value dates.
+    """
+
+    value_dates = [datetime.datetime.fromisoformat(x) for x in wml_data.decode("utf-8").split(",") if x]
+
+    return wml_data, True, "Valid", {"value_count": len(value_dates), "last_value_date": max(value_dates, default=None)}
+
+
+def fake_prepare_wml(response_data, service_type, wml_version, workspace):
+    return summarize_values(response_data)
+
+
+def fake_prepare_wml_windows(response_list, service_type, wml_version, workspace, cached_payload=None):
+    wml_parts = [decode_payload(*cached_payload)] if cached_payload is not None else []
+    wml_parts.extend(response_list)
+    return summarize_values(b",".join(x for x in wml_parts if x))
+
+
+class FakeDownloadEngine:
+    """
+    Answers REST requests with the server's value dates that fall in the requested window.
+    """
+
+    def __init__(self, value_dates):
+
+        self.value_dates = value_dates
+        self.requested_windows = []
+
+    def submit_each(self, download_requests):
+        download_futures = []
+        for download_request in download_requests:
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(download_request["url"]).query)
+            start_date = datetime.datetime.fromisoformat(query["start_date"][0])
+            end_date = datetime.datetime.fromisoformat(query["end_date"][0])
+            self.requested_windows.append((start_date, end_date))
+            response_data = ",".join(
+                x.isoformat() for x in self.value_dates if start_date <= x <= end_date
+            ).encode("utf-8")
+            download_future = Future()
+            download_future.set_result((
+                response_data, download_request["timeseries_id"],
+                {"error": None, "bytes": len(response_data), "elapsed": 0.0}
+            ))
+            download_futures.append(download_future)
+        return download_futures
+
+    def release(self, result, keep_body=False):
+        pass
+
+    def save_host_limits(self):
+        pass
+
+
+class PrepareTimeseriesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        engine = configure_engine(f"sqlite:///{os.path.join(temp_dir.name, 'catalog.db')}")
+        self.addCleanup(engine.dispose)
+        init_hydroshare_timeseries_manager_db(engine, first_time=True)
+
+        self.value_dates = [datetime.datetime(2020, 1, day) for day in (1, 2, 3)]
+        self.download_engine = FakeDownloadEngine(self.value_dates)
+        validation_pool = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(validation_pool.shutdown)
+
+        patcher = mock.patch.multiple(
+            jobs,
+            get_download_engine=lambda: self.download_engine,
+            get_validation_pool=lambda: validation_pool,
+            get_validation_workers=lambda: 1,
+            get_app_workspace=lambda: None,
+            prepare_wml=fake_prepare_wml,
+            prepare_wml_windows=fake_prepare_wml_windows
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        add_timeseries_references(SESSION_ID, [{
+            "timeseries_id": "ts-1",
+            "site_code": "site",
+            "variable_code": "variable",
+            "begin_date": self.value_dates[0],
+            "end_date": self.value_dates[-1],
+            "value_count": len(self.value_dates),
+            "return_type": "WaterML 1.1",
+            "service_type": "REST",
+            "url": URL
+        }])
+
+    def prepare(self, refresh=False):
+        self.download_engine.requested_windows = []
+        result = jobs.prepare_timeseries(SESSION_ID, ["ts-1"], refresh)
+        self.assertEqual((result["ready"], result["failed"]), (1, 0))
+        return self.download_engine.requested_windows
+
+    def test_import_fetches_full_window(self):
+        self.assertEqual(self.prepare(), [(self.value_dates[0], self.value_dates[-1])])
+        self.assertEqual(get_timeseries_request_data(SESSION_ID, "ts-1").status, "Ready")
+
+    def test_repeated_refresh_only_fetches_tail(self):
+        self.prepare()
+
+        for day in (4, 5):
+            self.value_dates.append(datetime.datetime(2020, 1, day))
+            requested_windows = self.prepare(refresh=True)
+
+            self.assertEqual(len(requested_windows), 1)
+            self.assertEqual(requested_windows[0][0], datetime.datetime(2020, 1, day - 1, 0, 0, 1))
+            request_data = get_timeseries_request_data(SESSION_ID, "ts-1")
+            self.assertEqual(request_data.end_date, datetime.datetime(2020, 1, day))
+            self.assertEqual(request_data.value_count, day)
+            self.assertEqual(
+                get_wml_data(SESSION_ID, "ts-1")[0],
+                ",".join(x.isoformat() for x in self.value_dates).encode("utf-8")
+            )
+
+        series_key = get_wml_series_key(URL, "site", "variable", "WaterML 1.1", "REST")
+        self.assertEqual(get_wml_series_states([series_key])[series_key].value_count, 5)
+
+    def test_refresh_without_state_fetches_full_window(self):
+        self.prepare()
+        self.value_dates.append(datetime.datetime(2020, 1, 4))
+
+        with mock.patch.object(jobs, "get_wml_series_states", return_value={}):
+            requested_windows = self.prepare(refresh=True)
+
+        self.assertEqual(requested_windows, [(self.value_dates[0], datetime.datetime(2020, 1, 3))])
+
+
+class RunPrepareJobTestCase(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        engine = configure_engine(f"sqlite:///{os.path.join(temp_dir.name, 'catalog.db')}")
+        self.addCleanup(engine.dispose)
+        init_hydroshare_timeseries_manager_db(engine, first_time=True)
+
+        self.timeseries_ids = ["ts-1", "ts-2", "ts-3"]
+        add_timeseries_references(SESSION_ID, [{
+            "timeseries_id": timeseries_id,
+            "site_code": timeseries_id,
+            "variable_code": "variable",
+            "return_type": "WaterML 1.1",
+            "service_type": "REST",
+            "url": URL
+        } for timeseries_id in self.timeseries_ids])
+        add_prepare_job("job", SESSION_ID, "refts", len(self.timeseries_ids))
+        add_pending_timeseries_list(SESSION_ID, "refts", self.timeseries_ids)
+        self.prepared_batches = []
+
+    def run_job(self, failing_batches):
+        def fake_prepare_timeseries(session_id, timeseries_id_list, refresh=False):
+            self.prepared_batches.append(timeseries_id_list)
+            if failing_batches(timeseries_id_list):
+                raise RuntimeError("connection reset")
+            return {"ready": len(timeseries_id_list), "failed": 0, "downloads": {"bytes": 0}}
+
+        with mock.patch.object(jobs, "prepare_timeseries", fake_prepare_timeseries):
+            while jobs.run_prepare_job("job", SESSION_ID, "refts", chunk_size=3, lease_seconds=300):
+                pass
+
+        return get_prepare_job(SESSION_ID, "job")
+
+    def test_failed_batch_is_prepared_per_timeseries(self):
+        prepare_job = self.run_job(lambda timeseries_id_list: len(timeseries_id_list) > 1)
+
+        self.assertEqual(self.prepared_batches, [self.timeseries_ids] + [[x] for x in self.timeseries_ids])
+        self.assertEqual((prepare_job.status, prepare_job.ready_count, prepare_job.failed_count), ("Complete", 3, 0))
+        self.assertEqual(count_pending_timeseries(SESSION_ID, "refts"), 0)
+
+    def test_timeseries_that_keeps_failing_records_its_error(self):
+        prepare_job = self.run_job(lambda timeseries_id_list: "ts-2" in timeseries_id_list)
+
+        self.assertEqual((prepare_job.status, prepare_job.ready_count, prepare_job.failed_count), ("Complete", 2, 1))
+        with session_scope() as session:
+            catalog_row = session.query(TimeSeriesCatalog.status, TimeSeriesCatalog.status_details).filter(
+                TimeSeriesCatalog.session_id == SESSION_ID,
+                TimeSeriesCatalog.timeseries_id == "ts-2"
+            ).one()
+        self.assertEqual(tuple(catalog_row), ("Failed", "RuntimeError: connection reset"))
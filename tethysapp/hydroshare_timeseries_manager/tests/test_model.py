@@ -0,0 +1,492 @@
+"""
+Tests for the catalog and queue actions against a temporary SQLite database.
+
+To run these tests:
+    Test command: "tethys test -f tethys_apps.tethysapp.hydroshare_timeseries_manager.tests.test_model"
+"""
+
+import os
+import datetime
+import tempfile
+import hashlib
+import unittest
+from unittest import mock
+from ..model import configure_engine, init_hydroshare_timeseries_manager_db, session_scope, TimeSeriesCatalog, \
+                    add_timeseries_references, update_timeseries_reference, update_timeseries_references, get_wml_data, \
+                    get_timeseries_references, update_timeseries_selections, remove_timeseries_references, \
+                    catalog_search_filter, TimeSeriesPayload, get_wml_stream, get_wml_storage_stats, \
+                    get_resource_metadata, PendingTimeSeries, add_pending_timeseries_list, claim_pending_timeseries, \
+                    renew_pending_lease, complete_pending_timeseries, release_pending_timeseries, \
+                    count_pending_timeseries, fail_abandoned_pending_timeseries, MAX_CLAIM_ATTEMPTS, \
+                    prioritize_visible_timeseries, prioritize_selected_timeseries, WmlCacheEntry, WmlCachePayload, \
+                    add_cached_wml
+from .. import model
+
+
+SESSION_ID = "session"
+
+
+class ModelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        engine = configure_engine(f"sqlite:///{os.path.join(temp_dir.name, 'catalog.db')}")
+        self.addCleanup(engine.dispose)
+        init_hydroshare_timeseries_manager_db(engine, first_time=True)
+
+    @staticmethod
+    def build_reference(index, **fields):
+        timeseries_reference = {
+            "timeseries_id": f"ts-{index:03d}",
+            "site_name": f"Site {index % 4}",
+            "site_code": f"site-{index:03d}",
+            "variable_name": "Discharge" if index % 2 else "Temperature",
+            "variable_code": "variable",
+            "sample_medium": "Surface Water",
+            "begin_date": datetime.datetime(2000, 1, 1) + datetime.timedelta(days=index),
+            "end_date": datetime.datetime(2010, 1, 1) + datetime.timedelta(days=index),
+            "value_count": 100 + index,
+            "latitude": 40.0 + index / 100,
+            "longitude": -111.0 - index / 100,
+            "return_type": "WaterML 1.1",
+            "service_type": "SOAP",
+            "url": "http://his.example.com/soap/"
+        }
+        timeseries_reference.update(fields)
+        return timeseries_reference
+
+    def add_references(self, count, session_id=SESSION_ID, **fields):
+        return add_timeseries_references(
+            session_id, [self.build_reference(index, **fields) for index in range(count)]
+        )
+
+    @staticmethod
+    def get_catalog_rows(session_id=SESSION_ID):
+        with session_scope() as session:
+            catalog_rows = session.\
+                query(
+                    TimeSeriesCatalog
+                ).filter(
+                    TimeSeriesCatalog.session_id == session_id
+                ).order_by(
+                    TimeSeriesCatalog.timeseries_id
+                ).all()
+            catalog_rows = [
+                {column.name: getattr(x, column.name) for column in TimeSeriesCatalog.__table__.columns}
+                for x in catalog_rows
+            ]
+        return catalog_rows
+
+
+class AddTimeseriesReferencesTestCase(ModelTestCase):
+
+    def test_inserts_references_with_defaults(self):
+        created_ids = self.add_references(3)
+        self.assertEqual(created_ids, ["ts-000", "ts-001", "ts-002"])
+        catalog_rows = self.get_catalog_rows()
+        self.assertEqual([x["timeseries_id"] for x in catalog_rows], created_ids)
+        self.assertEqual({(x["status"], x["selected"]) for x in catalog_rows}, {("Waiting", False)})
+        self.assertEqual(catalog_rows[2]["value_count"], 102)
+        self.assertAlmostEqual(catalog_rows[2]["latitude"], 40.02)
+
+    def test_skips_duplicates_of_existing_references(self):
+        self.add_references(3)
+        created_ids = add_timeseries_references(SESSION_ID, [
+            self.build_reference(2, timeseries_id="ts-duplicate"),
+            self.build_reference(3)
+        ])
+        self.assertEqual(created_ids, ["ts-003"])
+        self.assertEqual(len(self.get_catalog_rows()), 4)
+
+    def test_skips_duplicates_within_list(self):
+        created_ids = add_timeseries_references(SESSION_ID, [
+            self.build_reference(0),
+            self.build_reference(0, timeseries_id="ts-duplicate")
+        ])
+        self.assertEqual(created_ids, ["ts-000"])
+
+    def test_duplicates_are_per_session(self):
+        self.add_references(2)
+        self.assertEqual(self.add_references(2, session_id="other-session"), ["ts-000", "ts-001"])
+
+    def test_missing_numbers_load_as_null(self):
+        add_timeseries_references(SESSION_ID, [self.build_reference(0, value_count=None, latitude=None)])
+        catalog_row = self.get_catalog_rows()[0]
+        self.assertIsNone(catalog_row["value_count"])
+        self.assertIsNone(catalog_row["latitude"])
+
+    def test_empty_list(self):
+        self.assertEqual(add_timeseries_references(SESSION_ID, []), [])
+
+
+class UpdateTimeseriesReferencesTestCase(ModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_references(4)
+
+    def test_updates_references_with_different_fields(self):
+        update_timeseries_references(SESSION_ID, [
+            ("ts-000", {"status": "Ready", "status_details": "Valid"}),
+            ("ts-001", {"status": "Failed", "status_details": "Invalid"}),
+            ("ts-002", {"end_date": datetime.datetime(2020, 1, 1), "value_count": 7})
+        ])
+        catalog_rows = self.get_catalog_rows()
+        self.assertEqual(
+            [(x["status"], x["status_details"]) for x in catalog_rows[:2]], [("Ready", "Valid"), ("Failed", "Invalid")]
+        )
+        self.assertEqual(catalog_rows[2]["status"], "Waiting")
+        self.assertEqual((catalog_rows[2]["end_date"], catalog_rows[2]["value_count"]), (datetime.datetime(2020, 1, 1), 7))
+        self.assertEqual(catalog_rows[3]["status"], "Waiting")
+
+    def test_none_fields_are_unchanged(self):
+        update_timeseries_reference(SESSION_ID, "ts-000", status="Ready")
+        catalog_row = self.get_catalog_rows()[0]
+        self.assertEqual(catalog_row["status"], "Ready")
+        self.assertEqual(catalog_row["site_name"], "Site 0")
+        self.assertEqual(catalog_row["value_count"], 100)
+
+    def test_only_updates_session(self):
+        self.add_references(1, session_id="other-session")
+        update_timeseries_reference(SESSION_ID, "ts-000", status="Ready")
+        self.assertEqual(self.get_catalog_rows("other-session")[0]["status"], "Waiting")
+
+    def test_stores_payload_with_status(self):
+        update_timeseries_references(SESSION_ID, [
+            ("ts-000", {"status": "Ready", "wml_data": b"<timeSeriesResponse/>"}),
+            ("ts-001", {"wml_data": b"<timeSeriesResponse></timeSeriesResponse>"})
+        ])
+        self.assertEqual(self.get_catalog_rows()[0]["status"], "Ready")
+        self.assertEqual(get_wml_data(SESSION_ID, "ts-000"), (b"<timeSeriesResponse/>",))
+        self.assertEqual(get_wml_data(SESSION_ID, "ts-001"), (b"<timeSeriesResponse></timeSeriesResponse>",))
+        self.assertEqual(get_wml_data(SESSION_ID, "ts-002"), (None,))
+
+    def test_no_changes(self):
+        update_timeseries_references(SESSION_ID, [("ts-000", {"status": None})])
+        self.assertEqual(self.get_catalog_rows()[0]["status"], "Waiting")
+
+
+class GetTimeseriesReferencesTestCase(ModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_references(23)
+
+    def get_page_ids(self, length, offset, column=None, order=None, search_value="", seek_after=None):
+        results = get_timeseries_references(SESSION_ID, search_value, length, offset, column, order, seek_after)
+        return [x[19] for x in results[3]]
+
+    def assert_seek_matches_offset(self, column=None, order=None, search_value="", length=5):
+        offset_pages = []
+        seek_pages = []
+        for offset in range(0, 25, length):
+            seek_after = seek_pages[-1][-1] if seek_pages else None
+            offset_pages.append(self.get_page_ids(length, offset, column, order, search_value))
+            seek_pages.append(self.get_page_ids(length, 0, column, order, search_value, seek_after))
+            if not offset_pages[-1]:
+                break
+        self.assertEqual(seek_pages, offset_pages)
+        return [x for page in offset_pages for x in page]
+
+    def test_seek_paging_matches_offset_paging(self):
+        self.assertEqual(self.assert_seek_matches_offset(), [f"ts-{index:03d}" for index in range(23)])
+
+    def test_seek_paging_matches_offset_paging_on_sort_column_with_ties(self):
+        for order in ("asc", "desc"):
+            with self.subTest(order=order):
+                self.assertEqual(len(self.assert_seek_matches_offset(column=1, order=order)), 23)
+
+    def test_seek_paging_matches_offset_paging_with_search(self):
+        self.assertEqual(len(self.assert_seek_matches_offset(column=10, order="desc", search_value="discharge")), 11)
+
+    def test_seek_paging_matches_offset_paging_with_empty_sort_values(self):
+        empty_ids = [f"ts-{index:03d}" for index in range(0, 23, 3)]
+        with session_scope() as session:
+            session.query(TimeSeriesCatalog).filter(
+                TimeSeriesCatalog.timeseries_id.in_(empty_ids)
+            ).update({TimeSeriesCatalog.latitude: None}, synchronize_session=False)
+        for order in ("asc", "desc"):
+            for length in (3, 5):
+                with self.subTest(order=order, length=length):
+                    page_ids = self.assert_seek_matches_offset(column=3, order=order, length=length)
+                    self.assertEqual(sorted(page_ids), [f"ts-{index:03d}" for index in range(23)])
+                    if order == "asc":
+                        self.assertEqual(page_ids[-len(empty_ids):], empty_ids)
+                    else:
+                        self.assertEqual(page_ids[:len(empty_ids)], empty_ids[::-1])
+
+    def test_seek_after_missing_row_uses_offset(self):
+        self.assertEqual(self.get_page_ids(5, 5, seek_after="ts-missing"), self.get_page_ids(5, 5))
+
+    def test_counts(self):
+        update_timeseries_selections(SESSION_ID, "ts-001", None, True)
+        update_timeseries_selections(SESSION_ID, "ts-002", None, True)
+        full_count, filtered_count, selected_count, results = get_timeseries_references(
+            SESSION_ID, "Site 1", 5, 0, None, None
+        )
+        self.assertEqual((full_count, filtered_count, selected_count), (23, 6, 2))
+        self.assertEqual([x[19] for x in results], ["ts-001", "ts-005", "ts-009", "ts-013", "ts-017"])
+        self.assertTrue(results[0][20])
+
+    def test_sorts_by_column(self):
+        page_ids = self.get_page_ids(3, 0, column=10, order="desc")
+        self.assertEqual(page_ids, ["ts-022", "ts-021", "ts-020"])
+
+
+class CatalogSearchTestCase(ModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_references(3)
+        add_timeseries_references(SESSION_ID, [
+            self.build_reference(3, site_name="Logan River at Mendon Road"),
+            self.build_reference(4, site_name="Blacksmith Fork", variable_name="Gage height 100%_max")
+        ])
+
+    def search(self, search_value):
+        with session_scope() as session:
+            search_query = session.\
+                query(
+                    TimeSeriesCatalog.timeseries_id
+                ).filter(
+                    TimeSeriesCatalog.session_id == SESSION_ID,
+                    catalog_search_filter(session, search_value)
+                ).order_by(
+                    TimeSeriesCatalog.timeseries_id
+                )
+            timeseries_ids = [x[0] for x in search_query.all()]
+        return timeseries_ids
+
+    def test_uses_fts5_index(self):
+        with session_scope() as session:
+            search_filter = str(catalog_search_filter(session, "logan"))
+        self.assertIn("MATCH", search_filter)
+
+    def test_matches_substring_ignoring_case(self):
+        self.assertEqual(self.search("MENDON"), ["ts-003"])
+        self.assertEqual(self.search("iver at mend"), ["ts-003"])
+
+    def test_matches_any_search_column(self):
+        self.assertEqual(self.search("temperature"), ["ts-000", "ts-002"])
+        self.assertEqual(self.search("Gage height"), ["ts-004"])
+
+    def test_short_search_falls_back_to_like(self):
+        self.assertEqual(self.search("Fo"), ["ts-004"])
+
+    def test_special_characters(self):
+        self.assertEqual(self.search("100%_"), ["ts-004"])
+        self.assertEqual(self.search("%"), ["ts-004"])
+        self.assertEqual(self.search('"logan'), [])
+
+    def test_index_follows_updates_and_deletes(self):
+        update_timeseries_reference(SESSION_ID, "ts-000", site_name="Little Bear River")
+        self.assertEqual(self.search("little bear"), ["ts-000"])
+        remove_timeseries_references(SESSION_ID, False, "ts-000")
+        self.assertEqual(self.search("little bear"), [])
+
+    def test_select_by_search(self):
+        update_timeseries_selections(SESSION_ID, None, "logan", True)
+        self.assertEqual([x["timeseries_id"] for x in self.get_catalog_rows() if x["selected"]], ["ts-003"])
+
+
+class TimeseriesPayloadTestCase(ModelTestCase):
+
+    wml_data = b'<timeSeriesResponse>' + b"".join(
+        b'<value dateTime="2000-01-01T00:%02d:00">%d</value>' % (i % 60, i) for i in range(2000)
+    ) + b'</timeSeriesResponse>'
+
+    def setUp(self):
+        super().setUp()
+        self.add_references(3)
+        update_timeseries_references(SESSION_ID, [
+            ("ts-000", {"wml_data": self.wml_data}),
+            ("ts-001", {"wml_data": self.wml_data})
+        ])
+
+    def test_payloads_are_stored_compressed_outside_catalog(self):
+        self.assertNotIn("wml_data", TimeSeriesCatalog.__table__.c)
+        with session_scope() as session:
+            stored_sizes = [x[0] for x in session.query(TimeSeriesPayload.stored_size).all()]
+        self.assertEqual(len(stored_sizes), 2)
+        self.assertTrue(all(x < len(self.wml_data) for x in stored_sizes))
+
+    def test_reads_payload(self):
+        self.assertEqual(get_wml_data(SESSION_ID, "ts-000"), (self.wml_data,))
+        with get_wml_stream(SESSION_ID, "ts-000") as payload_stream:
+            self.assertEqual(payload_stream.read(), self.wml_data)
+        self.assertIsNone(get_wml_stream(SESSION_ID, "ts-002"))
+
+    def test_replaces_payload(self):
+        update_timeseries_reference(SESSION_ID, "ts-000", wml_data=b"<timeSeriesResponse/>")
+        self.assertEqual(get_wml_data(SESSION_ID, "ts-000"), (b"<timeSeriesResponse/>",))
+        self.assertEqual(get_wml_storage_stats(SESSION_ID)[0], 2)
+
+    def test_storage_stats(self):
+        payload_count, raw_size, stored_size = get_wml_storage_stats(SESSION_ID)
+        self.assertEqual((payload_count, raw_size), (2, 2 * len(self.wml_data)))
+        self.assertLess(stored_size, raw_size)
+
+    def test_removing_references_removes_payloads(self):
+        remove_timeseries_references(SESSION_ID, False, "ts-000")
+        self.assertEqual(get_wml_data(SESSION_ID, "ts-000"), (None,))
+        self.assertEqual(get_wml_storage_stats(SESSION_ID)[0], 1)
+
+
+class GetResourceMetadataTestCase(ModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_references(10)
+        update_timeseries_references(SESSION_ID, [
+            (f"ts-{index:03d}", {"selected": True, "status": "Ready" if index < 6 else "Failed"})
+            for index in range(8)
+        ])
+
+    def test_summarizes_selected_ready_references(self):
+        site_names, site_count, variable_names, variable_count, sample_mediums, begin_date, end_date, \
+            invalid_count = get_resource_metadata(SESSION_ID)
+        self.assertEqual(site_names, ["Site 0", "Site 1", "Site 2", "Site 3"])
+        self.assertEqual(site_count, 4)
+        self.assertEqual(variable_names, ["Discharge", "Temperature"])
+        self.assertEqual(variable_count, 2)
+        self.assertEqual(sample_mediums, ["Surface Water"])
+        self.assertEqual(begin_date, datetime.datetime(2000, 1, 1))
+        self.assertEqual(end_date, datetime.datetime(2010, 1, 6))
+        self.assertEqual(invalid_count, 2)
+
+    def test_lists_first_five_names(self):
+        update_timeseries_references(SESSION_ID, [
+            (f"ts-{index:03d}", {"site_name": f"Station {index}"}) for index in range(6)
+        ])
+        site_names, site_count = get_resource_metadata(SESSION_ID)[:2]
+        self.assertEqual(site_names, [f"Station {index}" for index in range(5)])
+        self.assertEqual(site_count, 6)
+
+    def test_nothing_selected(self):
+        update_timeseries_selections(SESSION_ID, None, None, False)
+        self.assertEqual(get_resource_metadata(SESSION_ID), ([], 0, [], 0, [], None, None, 0))
+
+
+class PendingModelTestCase(ModelTestCase):
+
+    refts_id = "refts"
+
+    def setUp(self):
+        super().setUp()
+        self.timeseries_ids = self.add_references(6)
+        add_pending_timeseries_list(SESSION_ID, self.refts_id, self.timeseries_ids)
+
+    def claim(self, limit=3, lease_seconds=300):
+        return claim_pending_timeseries(SESSION_ID, self.refts_id, limit, lease_seconds)
+
+    @staticmethod
+    def expire_leases():
+        with session_scope() as session:
+            session.query(PendingTimeSeries).update(
+                {PendingTimeSeries.lease_expires: datetime.datetime.now() - datetime.timedelta(seconds=1)},
+                synchronize_session=False
+            )
+
+
+class PendingTimeseriesTestCase(PendingModelTestCase):
+
+    def test_claims_do_not_overlap(self):
+        first_token, first_ids = self.claim()
+        second_token, second_ids = self.claim()
+        self.assertNotEqual(first_token, second_token)
+        self.assertEqual(first_ids, self.timeseries_ids[:3])
+        self.assertEqual(second_ids, self.timeseries_ids[3:])
+        self.assertEqual(self.claim()[1], [])
+        self.assertEqual(count_pending_timeseries(SESSION_ID, self.refts_id), 6)
+
+    def test_expired_lease_is_claimed_again(self):
+        self.claim()
+        self.expire_leases()
+        self.assertEqual(self.claim(limit=6)[1], self.timeseries_ids)
+
+    def test_renewed_lease_is_kept(self):
+        lease_token = self.claim()[0]
+        self.expire_leases()
+        self.assertEqual(renew_pending_lease(lease_token), 3)
+        self.assertEqual(self.claim(limit=6)[1], self.timeseries_ids[3:])
+
+    def test_complete_removes_batch(self):
+        lease_token = self.claim()[0]
+        complete_pending_timeseries(lease_token)
+        self.assertEqual(count_pending_timeseries(SESSION_ID, self.refts_id), 3)
+        self.assertEqual(renew_pending_lease(lease_token), 0)
+
+    def test_release_returns_batch(self):
+        lease_token = self.claim()[0]
+        release_pending_timeseries(lease_token)
+        self.assertEqual(self.claim(limit=6)[1], self.timeseries_ids)
+
+    def test_abandoned_timeseries_fail_after_max_attempts(self):
+        for _ in range(MAX_CLAIM_ATTEMPTS):
+            self.assertEqual(len(self.claim(limit=1)[1]), 1)
+            self.expire_leases()
+        self.assertEqual(fail_abandoned_pending_timeseries(SESSION_ID, self.refts_id), 1)
+        self.assertEqual(count_pending_timeseries(SESSION_ID, self.refts_id), 5)
+        catalog_row = self.get_catalog_rows()[0]
+        self.assertEqual(catalog_row["status"], "Failed")
+        self.assertEqual(self.claim(limit=6)[1], self.timeseries_ids[1:])
+
+
+class PendingPriorityTestCase(PendingModelTestCase):
+
+    def test_claims_visible_then_selected_first(self):
+        update_timeseries_selections(SESSION_ID, "ts-004", None, True)
+        prioritize_selected_timeseries(SESSION_ID)
+        prioritize_visible_timeseries(SESSION_ID, ["ts-005", "ts-002"])
+        self.assertEqual(self.claim(limit=6)[1], ["ts-002", "ts-005", "ts-004", "ts-000", "ts-001", "ts-003"])
+
+    def test_hidden_timeseries_drop_back(self):
+        update_timeseries_selections(SESSION_ID, "ts-005", None, True)
+        prioritize_visible_timeseries(SESSION_ID, ["ts-004", "ts-005"])
+        prioritize_visible_timeseries(SESSION_ID, ["ts-001"])
+        self.assertEqual(self.claim(limit=6)[1], ["ts-001", "ts-005", "ts-000", "ts-002", "ts-003", "ts-004"])
+
+    def test_deselected_timeseries_drop_back(self):
+        update_timeseries_selections(SESSION_ID, "ts-003", None, True)
+        prioritize_selected_timeseries(SESSION_ID)
+        update_timeseries_selections(SESSION_ID, "ts-003", None, False)
+        prioritize_selected_timeseries(SESSION_ID)
+        self.assertEqual(self.claim(limit=6)[1], self.timeseries_ids)
+
+    def test_claimed_batch_is_ordered_by_priority(self):
+        prioritize_visible_timeseries(SESSION_ID, ["ts-001"])
+        self.assertEqual(self.claim(limit=2)[1], ["ts-001", "ts-000"])
+
+
+class WmlCacheTestCase(ModelTestCase):
+
+    def get_cache_entries(self):
+        with session_scope() as session:
+            return dict(session.query(WmlCacheEntry.request_key, WmlCacheEntry.payload_hash).all())
+
+    def test_add_replaces_request_entries(self):
+        add_cached_wml({"a": b"first", "b": b"second"})
+        add_cached_wml({"a": b"second"})
+        self.assertEqual(self.get_cache_entries(), {
+            "a": hashlib.sha256(b"second").hexdigest(),
+            "b": hashlib.sha256(b"second").hexdigest()
+        })
+        with session_scope() as session:
+            self.assertEqual(session.query(WmlCachePayload).count(), 2)
+
+    def test_concurrent_entry_does_not_drop_batch(self):
+        insert_ignoring_conflicts = model._insert_ignoring_conflicts
+
+        def insert_after_other_writer(session, table, constraint, rows):
+            if table is WmlCacheEntry.__table__:
+                session.execute(table.insert(), [{"request_key": "a", "payload_hash": "other"}])
+            insert_ignoring_conflicts(session, table, constraint, rows)
+
+        with mock.patch.object(model, "_insert_ignoring_conflicts", insert_after_other_writer):
+            add_cached_wml({"a": b"first", "b": b"second"})
+
+        self.assertEqual(self.get_cache_entries(), {
+            "a": "other",
+            "b": hashlib.sha256(b"second").hexdigest()
+        })
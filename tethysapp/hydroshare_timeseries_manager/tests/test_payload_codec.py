@@ -0,0 +1,61 @@
+"""
+Unit tests for the WaterML payload codec.
+
+To run these tests:
+    Test command: "tethys test -f tethys_apps.tethysapp.hydroshare_timeseries_manager.tests.test_payload_codec"
+"""
+
+import unittest
+from .. import payload_codec
+from ..payload_codec import get_default_codec, encode_payload, decode_payload, open_payload_stream
+
+
+WML_DATA = b'<?xml version="1.0" encoding="utf-8"?><timeSeriesResponse>' + b"".join(
+    b'<value dateTime="2000-01-01T00:%02d:00">%d.5</value>' % (i % 60, i) for i in range(20000)
+) + b"</timeSeriesResponse>"
+
+CODECS = ["gzip", "identity"] + (["zstd"] if payload_codec.zstandard is not None else [])
+
+
+class PayloadCodecTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        for codec in CODECS:
+            with self.subTest(codec=codec):
+                stored_codec, encoded_data = encode_payload(WML_DATA, codec)
+                self.assertEqual(stored_codec, codec)
+                self.assertEqual(decode_payload(stored_codec, encoded_data), WML_DATA)
+
+    def test_stream_round_trip(self):
+        for codec in CODECS:
+            with self.subTest(codec=codec):
+                with open_payload_stream(*encode_payload(WML_DATA, codec)) as payload_stream:
+                    chunks = iter(lambda: payload_stream.read(4096), b"")
+                    self.assertEqual(b"".join(chunks), WML_DATA)
+
+    def test_compressed_codecs_shrink_payload(self):
+        for codec in CODECS:
+            if codec != "identity":
+                with self.subTest(codec=codec):
+                    self.assertLess(len(encode_payload(WML_DATA, codec)[1]), len(WML_DATA) / 4)
+
+    def test_default_codec(self):
+        stored_codec, encoded_data = encode_payload(WML_DATA)
+        self.assertEqual(stored_codec, get_default_codec())
+        self.assertEqual(decode_payload(stored_codec, encoded_data), WML_DATA)
+
+    def test_payload_without_codec_is_uncompressed(self):
+        self.assertEqual(decode_payload(None, memoryview(WML_DATA)), WML_DATA)
+        with open_payload_stream(None, WML_DATA) as payload_stream:
+            self.assertEqual(payload_stream.read(), WML_DATA)
+
+    def test_missing_payload(self):
+        self.assertIsNone(decode_payload("gzip", None))
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            encode_payload(WML_DATA, "brotli")
+        with self.assertRaises(ValueError):
+            decode_payload("brotli", WML_DATA)
+        with self.assertRaises(ValueError):
+            open_payload_stream("brotli", WML_DATA)
@@ -0,0 +1,134 @@
+"""
+Unit tests for the WaterML utilities that do not need a network or database.
+
+To run these tests:
+    Test command: "tethys test -f tethys_apps.tethysapp.hydroshare_timeseries_manager.tests.test_utilities"
+"""
+
+import datetime
+import unittest
+from lxml import etree
+from ..utilities import split_time_window, merge_wml_windows, parse_refts_date, MAX_TIME_WINDOWS
+
+
+WML_NS = "http://www.cuahsi.org/waterML/1.1/"
+
+
+def build_wml(*values_lists):
+    """
+    Builds a timeSeriesResponse with one values element per list of value dates.
+    """
+
+    return etree.fromstring(
+        f'<timeSeriesResponse xmlns="{WML_NS}"><timeSeries>' + "".join(
+            f'<values count="{len(value_dates)}"><method methodID="1"/>' + "".join(
+                f'<value dateTime="{value_date}">1</value>' for value_date in value_dates
+            ) + '<qualityControlLevel/></values>' for value_dates in values_lists
+        ) + '</timeSeries></timeSeriesResponse>'
+    )
+
+
+def get_values(wml_tree):
+    return [
+        [x.get("dateTime") for x in values.iter(f"{{{WML_NS}}}value")]
+        for values in wml_tree.iter(f"{{{WML_NS}}}values")
+    ]
+
+
+class SplitTimeWindowTestCase(unittest.TestCase):
+
+    begin_date = datetime.datetime(2000, 1, 1)
+    end_date = datetime.datetime(2010, 1, 1)
+
+    def test_single_window_at_or_below_limit(self):
+        self.assertEqual(
+            split_time_window(self.begin_date, self.end_date, 1000, 1000), [(self.begin_date, self.end_date)]
+        )
+
+    def test_single_window_without_dates_or_count(self):
+        self.assertEqual(split_time_window(None, self.end_date, 5000, 1000), [(None, self.end_date)])
+        self.assertEqual(split_time_window(self.begin_date, None, 5000, 1000), [(self.begin_date, None)])
+        self.assertEqual(
+            split_time_window(self.begin_date, self.end_date, None, 1000), [(self.begin_date, self.end_date)]
+        )
+        self.assertEqual(
+            split_time_window(self.begin_date, self.end_date, 5000, 0), [(self.begin_date, self.end_date)]
+        )
+
+    def test_windows_cover_range_without_overlap(self):
+        time_windows = split_time_window(self.begin_date, self.end_date, 2500, 1000)
+        self.assertEqual(len(time_windows), 3)
+        self.assertEqual(time_windows[0][0], self.begin_date)
+        self.assertEqual(time_windows[-1][1], self.end_date)
+        for (_, previous_end), (next_start, _) in zip(time_windows, time_windows[1:]):
+            self.assertEqual(next_start - previous_end, datetime.timedelta(seconds=1))
+        for start_date, end_date in time_windows:
+            self.assertLess(start_date, end_date)
+            self.assertEqual(start_date.microsecond, 0)
+
+    def test_window_count_is_capped(self):
+        time_windows = split_time_window(self.begin_date, self.end_date, 10 ** 9, 1)
+        self.assertEqual(len(time_windows), MAX_TIME_WINDOWS)
+
+    def test_short_range_is_not_split(self):
+        end_date = self.begin_date + datetime.timedelta(seconds=3)
+        self.assertEqual(split_time_window(self.begin_date, end_date, 5000, 1000), [(self.begin_date, end_date)])
+
+
+class MergeWmlWindowsTestCase(unittest.TestCase):
+
+    def test_single_window_is_unchanged(self):
+        wml_tree = build_wml(["2000-01-01", "2000-01-02"])
+        self.assertEqual(get_values(merge_wml_windows([wml_tree])), [["2000-01-01", "2000-01-02"]])
+
+    def test_values_are_appended_in_order(self):
+        wml_tree = merge_wml_windows([
+            build_wml(["2000-01-01", "2000-01-02"]),
+            build_wml(["2000-01-03"]),
+            build_wml(["2000-01-04", "2000-01-05"])
+        ])
+        self.assertEqual(get_values(wml_tree), [["2000-01-01", "2000-01-02", "2000-01-03", "2000-01-04", "2000-01-05"]])
+
+    def test_values_are_inserted_before_trailing_elements(self):
+        wml_tree = merge_wml_windows([build_wml(["2000-01-01"]), build_wml(["2000-01-02"])])
+        values = next(wml_tree.iter(f"{{{WML_NS}}}values"))
+        self.assertEqual(
+            [etree.QName(x).localname for x in values], ["method", "value", "value", "qualityControlLevel"]
+        )
+
+    def test_empty_first_window(self):
+        wml_tree = merge_wml_windows([build_wml([]), build_wml(["2000-01-02"])])
+        self.assertEqual(get_values(wml_tree), [["2000-01-02"]])
+
+    def test_count_is_updated(self):
+        wml_tree = merge_wml_windows([build_wml(["2000-01-01"]), build_wml(["2000-01-02", "2000-01-03"])])
+        self.assertEqual(next(wml_tree.iter(f"{{{WML_NS}}}values")).get("count"), "3")
+
+    def test_extra_values_elements_are_appended(self):
+        wml_tree = merge_wml_windows([
+            build_wml(["2000-01-01"]),
+            build_wml(["2000-01-02"], ["2000-01-02"])
+        ])
+        self.assertEqual(get_values(wml_tree), [["2000-01-01", "2000-01-02"], ["2000-01-02"]])
+
+
+class ParseReftsDateTestCase(unittest.TestCase):
+
+    def test_formats(self):
+        for value in ("2000-01-02T03:04:05", "2000-01-02T03:04:05Z", "2000-01-02 03:04:05"):
+            with self.subTest(value=value):
+                self.assertEqual(parse_refts_date(value), datetime.datetime(2000, 1, 2, 3, 4, 5))
+        self.assertEqual(parse_refts_date("2000-01-02"), datetime.datetime(2000, 1, 2))
+
+    def test_offset_is_converted_to_naive_utc(self):
+        self.assertEqual(parse_refts_date("2000-01-02T03:04:05-07:00"), datetime.datetime(2000, 1, 2, 10, 4, 5))
+
+    def test_aware_datetime_is_converted_to_naive_utc(self):
+        value = datetime.datetime(2000, 1, 2, 3, 4, 5, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+        self.assertEqual(parse_refts_date(value), datetime.datetime(2000, 1, 2, 1, 4, 5))
+
+    def test_invalid(self):
+        for value in (None, "", "yesterday"):
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    parse_refts_date(value)
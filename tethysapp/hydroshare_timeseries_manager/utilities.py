@@ -1,21 +1,29 @@
 import json
 import uuid
 import requests
-import asyncio
 import zipfile
 import io
 import os
+import math
 import shutil
 import sqlite3
 import itertools
-from aiohttp import ClientSession
+import datetime
+import threading
 from lxml import etree
 from .app import HydroshareTimeseriesManager as app
-from .model import add_timeseries_reference, get_wml_data, get_refts
+from .model import add_timeseries_references, get_wml_data, get_wml_stream, get_refts, \
+    _to_number
+from .downloader import get_download_engine, open_response
+from .payload_codec import decode_payload
 
 hydroshare_url = app.get_custom_setting("hydroshare_url")
 hydroserver_url = app.get_custom_setting("hydroserver_url")
 
+MAX_TIME_WINDOWS = 32
+
+_wml_schemas = threading.local()
+
 
 class d(dict):
     """
@@ -98,38 +106,66 @@ def add_refts_to_session(refts, session_id):
     and add it to a session.
     """
 
-    timeseries_id_list = []
+    timeseries_references = []
     for ts in refts["timeSeriesReferenceFile"]["referencedTimeSeries"]:
         try:
-            timeseries_id = str(uuid.uuid4())
-            add_timeseries_reference(
-                session_id=session_id,
-                timeseries_id=timeseries_id,
-                begin_date=str(d(ts)["beginDate"]),
-                end_date=str(d(ts)["endDate"]),
-                value_count=str(d(ts)["valueCount"]),
-                sample_medium=str(d(ts)["sampleMedium"]),
-                site_name=str(d(ts)["site"]["siteName"]),
-                site_code=str(d(ts)["site"]["siteCode"]),
-                latitude=str(d(ts)["site"]["latitude"]),
-                longitude=str(d(ts)["site"]["longitude"]),
-                variable_name=str(d(ts)["variable"]["variableName"]),
-                variable_code=str(d(ts)["variable"]["variableCode"]),
-                method_description=str(d(ts)["method"]["methodDescription"]),
-                method_link=str(d(ts)["method"]["methodLink"]),
-                network_name=str(d(ts)["requestInfo"]["networkName"]),
-                ref_type=str(d(ts)["requestInfo"]["refType"]),
-                return_type=str(d(ts)["requestInfo"]["returnType"]),
-                service_type=str(d(ts)["requestInfo"]["serviceType"]),
-                url=str(d(ts)["requestInfo"]["url"])
-            )
-            timeseries_id_list.append(timeseries_id)
-        except:
+            timeseries_references.append({
+                "timeseries_id": str(uuid.uuid4()),
+                "begin_date": parse_refts_date(d(ts)["beginDate"]),
+                "end_date": parse_refts_date(d(ts)["endDate"]),
+                "value_count": _to_number(d(ts)["valueCount"], int),
+                "sample_medium": str(d(ts)["sampleMedium"]),
+                "site_name": str(d(ts)["site"]["siteName"]),
+                "site_code": str(d(ts)["site"]["siteCode"]),
+                "latitude": _to_number(d(ts)["site"]["latitude"], float),
+                "longitude": _to_number(d(ts)["site"]["longitude"], float),
+                "variable_name": str(d(ts)["variable"]["variableName"]),
+                "variable_code": str(d(ts)["variable"]["variableCode"]),
+                "method_description": str(d(ts)["method"]["methodDescription"]),
+                "method_link": str(d(ts)["method"]["methodLink"]),
+                "network_name": str(d(ts)["requestInfo"]["networkName"]),
+                "ref_type": str(d(ts)["requestInfo"]["refType"]),
+                "return_type": str(d(ts)["requestInfo"]["returnType"]),
+                "service_type": str(d(ts)["requestInfo"]["serviceType"]),
+                "url": str(d(ts)["requestInfo"]["url"])
+            })
+        except (KeyError, ValueError, TypeError, AttributeError):
             continue
 
+    timeseries_id_list = add_timeseries_references(session_id, timeseries_references)
+
     return timeseries_id_list
 
 
+def parse_refts_date(value):
+    """
+    Parses a REFTS date string.
+
+    REFTS files from HydroClient and HydroShare use ISO 8601 dates with or without a
+    time component. Dates with a UTC offset are converted to naive UTC, so they compare
+    with the rest of the catalog. Raises a ValueError for missing or malformed dates.
+    """
+
+    if isinstance(value, datetime.datetime):
+        parsed_date = value
+    else:
+        value = str(value).strip().replace("Z", "")
+        for date_format in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S%z",
+                            "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+            try:
+                parsed_date = datetime.datetime.strptime(value, date_format)
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError(f"Unrecognized REFTS date: {value}")
+
+    if parsed_date.tzinfo is not None:
+        parsed_date = parsed_date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return parsed_date
+
+
 def get_refts_from_hydroshare(resource_id, aggregation_path):
     """
     Gets REFTS data from HydroShare.
@@ -166,76 +202,78 @@ def get_refts_from_hydroshare(resource_id, aggregation_path):
     return refts_list
 
 
+def build_soap_request(refts):
+    """
+    Builds a download request for a WaterOneFlow SOAP service.
+
+    The request calls GetValuesObject for the location, variable, and dates in the
+    REFTS entry.
+    """
+
+    download_request = {
+        "timeseries_id": refts["timeseries_id"],
+        "session_id": refts.get("session_id"),
+        "method": "POST",
+        "url": refts["url"],
+        "headers": {
+            "SOAPAction": f"http://www.cuahsi.org/his/{refts['version']}/ws/GetValuesObject",
+            "Content-Type": "text/xml; charset=utf-8"
+        },
+        "data": f'''
+            <soap-env:Envelope xmlns:soap-env="http://schemas.xmlsoap.org/soap/envelope/">
+              <soap-env:Body>
+                <ns0:GetValuesObject xmlns:ns0="http://www.cuahsi.org/his/{refts['version']}/ws/">
+                  <ns0:location>{refts['location']}</ns0:location>
+                  <ns0:variable>{refts['variable']}</ns0:variable>
+                  <ns0:startDate>{refts['start_date']}</ns0:startDate>
+                  <ns0:endDate>{refts['end_date']}</ns0:endDate>
+                  <ns0:authToken>{refts['auth_token']}</ns0:authToken>
+                </ns0:GetValuesObject>
+              </soap-env:Body>
+            </soap-env:Envelope>
+        '''
+    }
+
+    return download_request
+
+
+def build_rest_request(refts):
+    """
+    Builds a download request for a WaterOneFlow REST service.
+
+    REST requests are a plain GET of the URL stored in the REFTS entry.
+    """
+
+    download_request = {
+        "timeseries_id": refts["timeseries_id"],
+        "session_id": refts.get("session_id"),
+        "method": "GET",
+        "url": refts["url"]
+    }
+
+    return download_request
+
+
 def download_soap_wml(refts_list):
-    async def fetch_all(refts_list):
-        tasks = []
-        async with ClientSession() as session:
-            for refts in refts_list:
-                task = asyncio.ensure_future(fetch(refts, session))
-                tasks.append(task)
-            responses = await asyncio.gather(*tasks)
-            return responses
+    """
+    Downloads WaterML from WaterOneFlow SOAP services.
 
-    async def fetch(refts, session):
-        try:
-            async with session.post(
-                    refts['url'],
-                    headers = {
-                        "SOAPAction": f"http://www.cuahsi.org/his/{refts['version']}/ws/GetValuesObject",
-                        "Content-Type": "text/xml; charset=utf-8"
-                    },
-                    data = f'''
-                        <soap-env:Envelope xmlns:soap-env="http://schemas.xmlsoap.org/soap/envelope/">
-                          <soap-env:Body>
-                            <ns0:GetValuesObject xmlns:ns0="http://www.cuahsi.org/his/{refts['version']}/ws/">
-                              <ns0:location>{refts['location']}</ns0:location>
-                              <ns0:variable>{refts['variable']}</ns0:variable>
-                              <ns0:startDate>{refts['start_date']}</ns0:startDate>
-                              <ns0:endDate>{refts['end_date']}</ns0:endDate>
-                              <ns0:authToken>{refts['auth_token']}</ns0:authToken>
-                            </ns0:GetValuesObject>
-                          </soap-env:Body>
-                        </soap-env:Envelope>
-                    '''
-                ) as response:
-                response = await response.read()
-                print("done")
-                return (response, refts["timeseries_id"],)
-        except:
-            return (b"", refts["timeseries_id"],)
+    Requests are sent through the shared download engine. Returns a list of
+    (response body, timeseries ID, timings) tuples in the order of the REFTS list.
+    """
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    future = asyncio.ensure_future(fetch_all(refts_list))
-    result = loop.run_until_complete(future)
-    return result
+    return get_download_engine().download([build_soap_request(refts) for refts in refts_list])
 
 
 def download_rest_wml(refts_list):
-    async def fetch_all(refts_list):
-        tasks = []
-        async with ClientSession() as session:
-            for refts in refts_list:
-                task = asyncio.ensure_future(fetch(refts, session))
-                tasks.append(task)
-            responses = await asyncio.gather(*tasks)
-            return responses
+    """
+    Downloads WaterML from WaterOneFlow REST services.
 
-    async def fetch(refts, session):
-        try:
-            async with session.get(
-                    refts['url'],
-                ) as response:
-                response = await response.read()
-                return (response, refts["timeseries_id"],)
-        except:
-            return (b"", refts["timeseries_id"],)
+    Requests are sent through the shared download engine. Returns a list of
+    (response body, timeseries ID, timings) tuples in the order of the REFTS list.
+    """
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    future = asyncio.ensure_future(fetch_all(refts_list))
-    result = loop.run_until_complete(future)
-    return result
+    return get_download_engine().download([build_rest_request(refts) for refts in refts_list])
 
 
 def extract_soap_wml(soap_data, wml_version, unzip):
@@ -263,6 +301,36 @@ def extract_soap_wml(soap_data, wml_version, unzip):
     return wml_data
 
 
+def stream_extract_soap_wml(soap_source, wml_version):
+    """
+    Extracts the timeSeriesResponse from a WaterOneFlow SOAP response as it is read.
+
+    The source can be bytes, a path, or a file-like object such as an HTTP stream or
+    a temporary file. The envelope is parsed incrementally, elements outside the
+    timeSeriesResponse are discarded once they have been read, and reading stops as
+    soon as the timeSeriesResponse is complete. Returns the parsed element, which can
+    be validated without being serialized and parsed again.
+    """
+
+    wml_namespace = "http://www.cuahsi.org/waterML/1.1/" if wml_version == "WaterML 1.1" else \
+                    "http://www.cuahsi.org/waterML/1.0/"
+    wml_tag = f"{{{wml_namespace}}}timeSeriesResponse"
+
+    if isinstance(soap_source, bytes):
+        soap_source = io.BytesIO(soap_source)
+
+    wml_depth = 0
+    for event, element in etree.iterparse(soap_source, events=("start", "end"), huge_tree=True):
+        if element.tag == wml_tag:
+            wml_depth += 1 if event == "start" else -1
+            if event == "end" and wml_depth == 0:
+                return element
+        elif event == "end" and wml_depth == 0:
+            element.clear()
+
+    raise ValueError("SOAP response contains no timeSeriesResponse")
+
+
 def extract_rest_wml(rest_data, unzip):
 
     if unzip:
@@ -280,36 +348,258 @@ def extract_rest_wml(rest_data, unzip):
     return wml_data
 
 
+def prepare_wml(response_data, service_type, wml_version, workspace):
+    """
+    Extracts and validates WaterML from a WaterOneFlow response.
+
+    This function only works on the response it is given, as bytes or spooled to disk
+    by the downloader, so it can run in a worker process. SOAP envelopes are parsed
+    incrementally, and the extracted tree is validated directly and serialized once,
+    for storage. Returns the WaterML bytes (None if extraction failed), whether the
+    WaterML is valid, the status details to store with it, and its summary from
+    get_wml_summary (None if extraction failed).
+    """
+
+    try:
+        with open_response(response_data) as response_file:
+            if service_type == "SOAP":
+                wml_data = None
+                wml_tree = stream_extract_soap_wml(response_file, wml_version)
+            else:
+                wml_data = extract_rest_wml(response_file.read(), unzip=False)
+                wml_tree = etree.fromstring(wml_data)
+    except Exception as err:
+        return None, False, f"Extraction failed: {type(err).__name__}: {err}", None
+
+    validation_result = validate_wml_data(wml_tree, wml_version, workspace)
+
+    return wml_data or etree.tostring(wml_tree), validation_result["valid"], validation_result["status_details"], \
+        get_wml_summary(wml_tree)
+
+
+def get_wml_summary(wml_tree):
+    """
+    Summarizes the values of a timeSeriesResponse.
+
+    Returns the number of values and the date of the last one, or None if there are no
+    values or the date cannot be read. Values are in date order within each values
+    element, so only the last value of each is read.
+    """
+
+    ns = wml_tree.tag[:wml_tree.tag.index("}") + 1] if wml_tree.tag.startswith("{") else ""
+    value_count = 0
+    last_value_date = None
+
+    for values_element in wml_tree.iter(f"{ns}values"):
+        value_elements = values_element.findall(f"{ns}value")
+        value_count += len(value_elements)
+        if not value_elements:
+            continue
+        try:
+            value_date = parse_refts_date(value_elements[-1].get("dateTime"))
+        except ValueError:
+            continue
+        if last_value_date is None or value_date > last_value_date:
+            last_value_date = value_date
+
+    return {"value_count": value_count, "last_value_date": last_value_date}
+
+
+def split_time_window(begin_date, end_date, value_count, max_value_count):
+    """
+    Splits the date range of a timeseries into windows of about max_value_count values.
+
+    Values are assumed to be spread evenly over the range. Windows do not overlap; each
+    one ends a second before the next begins, and there are at most MAX_TIME_WINDOWS of
+    them. Timeseries without dates or a value count, or not above the limit, get a
+    single window covering the whole range.
+    """
+
+    if not value_count or not max_value_count or value_count <= max_value_count or \
+            begin_date is None or end_date is None:
+        return [(begin_date, end_date)]
+
+    window_count = min(MAX_TIME_WINDOWS, math.ceil(value_count / max_value_count))
+    window_span = (end_date - begin_date) / window_count
+
+    if window_span < datetime.timedelta(seconds=2):
+        return [(begin_date, end_date)]
+
+    window_starts = [begin_date] + [
+        (begin_date + window_span * i).replace(microsecond=0) for i in range(1, window_count)
+    ]
+    window_ends = [window_start - datetime.timedelta(seconds=1) for window_start in window_starts[1:]] + [end_date]
+
+    return list(zip(window_starts, window_ends))
+
+
+def merge_wml_windows(wml_trees):
+    """
+    Merges the WaterML of consecutive time windows of one timeseries.
+
+    The trees are timeSeriesResponse elements in date order. The values of each later
+    window are added after the last value of the matching values element of the first
+    window, and values elements the first window does not have are appended to its
+    timeSeries. Returns the first tree, with the merged values.
+    """
+
+    wml_tree = wml_trees[0]
+    ns = wml_tree.tag[:wml_tree.tag.index("}") + 1]
+    timeseries_element = next(wml_tree.iter(f"{ns}timeSeries"))
+    merged_values_list = list(timeseries_element.iter(f"{ns}values"))
+
+    for window_tree in wml_trees[1:]:
+        for i, window_values in enumerate(list(window_tree.iter(f"{ns}values"))):
+            if i >= len(merged_values_list):
+                timeseries_element.append(window_values)
+                merged_values_list.append(window_values)
+                continue
+            merged_values = merged_values_list[i]
+            value_elements = merged_values.findall(f"{ns}value")
+            position = merged_values.index(value_elements[-1]) + 1 if value_elements else 0
+            merged_values[position:position] = window_values.findall(f"{ns}value")
+
+    for merged_values in merged_values_list:
+        if merged_values.get("count") is not None:
+            merged_values.set("count", str(len(merged_values.findall(f"{ns}value"))))
+
+    return wml_tree
+
+
+def prepare_wml_windows(response_list, service_type, wml_version, workspace, cached_payload=None):
+    """
+    Extracts, merges, and validates WaterML downloaded in several time windows.
+
+    The responses are those of one timeseries split with split_time_window, in date
+    order. Each is extracted, the windows are merged into one document, and that
+    document is validated and serialized once. A refresh passes the codec and stored
+    bytes of the series' previous payload as the cached payload, and the responses are
+    merged after it. Returns the same values as prepare_wml.
+    """
+
+    try:
+        wml_trees = [etree.fromstring(decode_payload(*cached_payload))] if cached_payload is not None else []
+        for response_data in response_list:
+            with open_response(response_data) as response_file:
+                if service_type == "SOAP":
+                    wml_trees.append(stream_extract_soap_wml(response_file, wml_version))
+                else:
+                    wml_trees.append(etree.parse(response_file).getroot())
+        wml_tree = merge_wml_windows(wml_trees)
+    except Exception as err:
+        return None, False, f"Extraction failed: {type(err).__name__}: {err}", None
+
+    validation_result = validate_wml_data(wml_tree, wml_version, workspace)
+
+    return etree.tostring(wml_tree), validation_result["valid"], validation_result["status_details"], \
+        get_wml_summary(wml_tree)
+
+
 def validate_wml(session_id, timeseries_id, wml_version):
+    """
+    Validates the WaterML stored for a timeseries reference.
 
-    wml_data = get_wml_data(session_id=session_id, timeseries_id=timeseries_id)
+    Payloads that are still in memory should be checked with validate_wml_data
+    instead, which avoids reading them back from the database.
+    """
+
+    wml_stream = get_wml_stream(session_id=session_id, timeseries_id=timeseries_id)
+
+    if wml_stream is None:
+        return False
+
+    with wml_stream:
+        return validate_wml_source(wml_stream, wml_version)
+
+
+def get_wml_schema(wml_version, workspace=None):
+    """
+    Gets the compiled WaterML 1.0 or 1.1 schema.
+
+    Each schema is compiled once and reused until its file in the app workspace
+    changes, so edited schemas are picked up without a restart. Compiled schemas are
+    kept per thread, since lxml records validation errors on the schema object.
+    """
 
     wml_version = "1" if "WaterML 1.1" in wml_version else "0"
+    schema_path = f"{workspace or get_app_workspace()}/wml_1_{wml_version}_schema.xsd"
+    schema_mtime = os.stat(schema_path).st_mtime_ns
 
-    wml_schema = etree.XMLSchema(etree.parse(f"{get_app_workspace()}/wml_1_{wml_version}_schema.xsd"))
+    if not hasattr(_wml_schemas, "registry"):
+        _wml_schemas.registry = {}
+
+    cached_schema = _wml_schemas.registry.get(schema_path)
+
+    if cached_schema is None or cached_schema[0] != schema_mtime:
+        cached_schema = (schema_mtime, etree.XMLSchema(etree.parse(schema_path)))
+        _wml_schemas.registry[schema_path] = cached_schema
+
+    return cached_schema[1]
+
+
+def load_wml_schemas(workspace=None):
+    """
+    Compiles both WaterML schemas ahead of the first validation.
+
+    Used to initialize validation worker processes.
+    """
+
+    for wml_version in ("WaterML 1.0", "WaterML 1.1"):
+        get_wml_schema(wml_version, workspace)
+
+
+def validate_wml_data(wml_data, wml_version, workspace=None):
+    """
+    Validates WaterML against the WaterML 1.0 or 1.1 schema.
+
+    The WaterML can be bytes, a path or file-like object, or an element or tree that
+    has already been parsed, such as the one returned by stream_extract_soap_wml.
+    Errors for unexpected elements and timeOffset attributes are ignored, since many
+    services return them. Returns whether the WaterML is valid, the list of remaining
+    errors, and the status details to store with the timeseries.
+    """
+
+    wml_schema = get_wml_schema(wml_version, workspace)
 
     try:
-        wml_schema.assertValid(etree.fromstring(wml_data[0]))
-        return True
+        if isinstance(wml_data, bytes):
+            wml_data = etree.fromstring(wml_data)
+        elif not isinstance(wml_data, (etree._Element, etree._ElementTree)):
+            wml_data = etree.parse(wml_data)
+        wml_schema.assertValid(wml_data)
+        error_list = []
     except etree.DocumentInvalid as err:
-        error_list = str(err.error_log).split("<string>")[1:]
+        error_list = [f":{error.line}:{error.column}:{error.message}" for error in err.error_log]
         error_list = [error for error in error_list if 
             "This element is not expected." not in error and
             "timeOffset" not in error
         ]
+    except Exception as err:
+        error_list = [f"{type(err).__name__}: {err}"]
 
-        if not error_list:
-            return True
-        else:
-            print("**************************************")
-            print("\n".join(error_list))
-            print("**************************************")
-            return False
-    except:
+    return {
+        "valid": not error_list,
+        "errors": error_list,
+        "status_details": f"WaterML validation failed: {error_list[0].lstrip(':')}" if error_list else "None"
+    }
+
+
+def validate_wml_source(wml_source, wml_version, workspace=None):
+    """
+    Validates WaterML against the WaterML 1.0 or 1.1 schema.
+
+    The source can be a path or a file-like object. Returns True if the WaterML is
+    valid and prints the validation errors otherwise.
+    """
+
+    validation_result = validate_wml_data(wml_source, wml_version, workspace)
+
+    if not validation_result["valid"]:
         print("**************************************")
-        print("Unknown Validation Error")
+        print("\n".join(validation_result["errors"]))
         print("**************************************")
-        return False
+
+    return validation_result["valid"]
 
 
 def create_refts_file(session_id, workspace, refts_metadata):